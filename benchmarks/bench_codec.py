@@ -0,0 +1,94 @@
+"""Compare per-item float/Decimal conversion and JSON serialization costs
+
+Usage: python benchmarks/bench_codec.py [items]
+
+Times, per reading item: a JSON round trip with parse_float=Decimal (the
+usual quick fix), the generic recursive converters, the compiled reading
+codec, and boto3's TypeSerializer on the result, which every put pays
+anyway. Then times an API page of Decimal items through json and orjson.
+"""
+import json
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda'))
+
+from boto3.dynamodb.types import TypeSerializer  # noqa: E402
+
+from shared import codec  # noqa: E402
+from shared.schema import reading_codec, reading_key  # noqa: E402
+
+DEFAULT_ITEMS = 50_000
+PAGE_SIZE = 500
+
+def make_items(n, seed=0):
+    """Generate n processed reading items as the preprocessor writes them"""
+    rng = random.Random(seed)
+    items = []
+    for i in range(n):
+        timestamp = f"2024-05-01T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.{i % 1000:03d}"
+        items.append(dict({
+            'temperature': {'value': round(rng.gauss(70, 8), 2), 'status': 'normal',
+                            'threshold': 80.0},
+            'vibration': {'value': round(rng.gammavariate(2.0, 0.2), 3), 'status': 'normal',
+                          'threshold': 0.8},
+            'processed': True,
+            'processedAt': timestamp
+        }, **reading_key(f"device-{i % 500}", timestamp)))
+    return items
+
+def json_round_trip(item):
+    return json.loads(json.dumps(item), parse_float=Decimal)
+
+def per_item_us(fn, items):
+    start = time.perf_counter()
+    results = [fn(item) for item in items]
+    return results, (time.perf_counter() - start) / len(items) * 1e6
+
+def main(n):
+    items = make_items(n)
+    serializer = TypeSerializer()
+
+    print(f"{'encode':<22} {'us/item':>8} {'speedup':>8}")
+    baseline = expected = None
+    for name, fn in (('json round trip', json_round_trip),
+                     ('generic to_item', codec.to_item),
+                     ('reading_codec', reading_codec.encode)):
+        encoded, us = per_item_us(fn, items)
+        expected = expected or encoded
+        assert encoded == expected
+        baseline = baseline or us
+        print(f"{name:<22} {us:>8.2f} {baseline / us:>7.1f}x")
+    _, us = per_item_us(lambda item: {k: serializer.serialize(v) for k, v in item.items()},
+                        encoded)
+    print(f"{'TypeSerializer':<22} {us:>8.2f}")
+
+    print(f"\n{'decode':<22} {'us/item':>8} {'speedup':>8}")
+    baseline = None
+    for name, fn in (('generic from_item', codec.from_item),
+                     ('reading_codec', reading_codec.decode)):
+        decoded, us = per_item_us(fn, encoded)
+        assert decoded == items
+        baseline = baseline or us
+        print(f"{name:<22} {us:>8.2f} {baseline / us:>7.1f}x")
+
+    pages = [{'items': encoded[i:i + PAGE_SIZE], 'count': PAGE_SIZE}
+             for i in range(0, len(encoded), PAGE_SIZE)]
+    print(f"\n{'dumps page of ' + str(PAGE_SIZE):<22} {'us/item':>8} {'speedup':>8}")
+    backends = [('json', lambda page: json.dumps(page, default=codec.json_default,
+                                                separators=(',', ':'), ensure_ascii=False))]
+    if codec.orjson is not None:
+        backends.append(('orjson', codec.dumps))
+    baseline = None
+    for name, fn in backends:
+        bodies, us = per_item_us(fn, pages)
+        us /= PAGE_SIZE
+        assert json.loads(bodies[0])['items'] == items[:PAGE_SIZE]
+        baseline = baseline or us
+        print(f"{name:<22} {us:>8.2f} {baseline / us:>7.1f}x")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ITEMS)
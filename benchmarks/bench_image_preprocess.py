@@ -0,0 +1,157 @@
+"""Compare Rekognition latency, payload size and defect verdicts with and
+without the image preprocessing stage
+
+Usage:
+    python benchmarks/bench_image_preprocess.py --generate DIR [--frames N]
+    python benchmarks/bench_image_preprocess.py DIR [--detector local|rekognition]
+
+A dataset directory holds image files plus labels.json with a "frames"
+object mapping each file name to {"camera": ..., "defect": true|false} and
+an optional "roi" object of per-camera regions. --generate writes a synthetic
+labelled set of camera sequences with and without scratch defects. The
+local detector flags red scratch pixels so the comparison runs offline; use
+--detector rekognition to measure against the real service.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+from PIL import Image, ImageDraw
+
+ROOT = os.path.join(os.path.dirname(__file__), '..', 'lambda')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'image_analysis'))
+os.environ.setdefault('DYNAMODB_TABLE', 'benchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import image_analysis  # noqa: E402
+from shared import clients  # noqa: E402
+from preprocess import FramePreprocessor  # noqa: E402
+
+# Region of interest used for the synthetic cameras
+SYNTHETIC_ROI = [0.25, 0.2, 0.75, 0.8]
+
+def generate(directory, frames, seed=0):
+    """Write a synthetic labelled dataset of camera frame sequences"""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    labels = {}
+    for i in range(frames):
+        camera = f"camera-{i % 4}"
+        # Runs of near-identical frames, as a line camera produces
+        defect = (i // 8) % 3 == 0
+        image = Image.new('RGB', (1920, 1080), (rng.randint(90, 94),) * 3)
+        draw = ImageDraw.Draw(image)
+        draw.rectangle([560, 260, 1360, 820], fill=(160, 160, 165))
+        if defect:
+            x = 700 + (i // 8) * 37 % 400
+            draw.line([x, 320, x + 240, 700], fill=(200, 30, 30), width=8)
+        # Sensor noise outside the part should not defeat static-frame skipping
+        for _ in range(200):
+            px, py = rng.randrange(1920), rng.randrange(1080)
+            draw.point((px, py), fill=(rng.randrange(256),) * 3)
+        name = f"{camera}-{i:05d}.jpg"
+        image.save(os.path.join(directory, name), format='JPEG', quality=92)
+        labels[name] = {'camera': camera, 'defect': defect}
+    with open(os.path.join(directory, 'labels.json'), 'w') as f:
+        json.dump({'roi': {f"camera-{c}": SYNTHETIC_ROI for c in range(4)},
+                   'frames': labels}, f, indent=2)
+
+def local_detect(image_bytes):
+    """Offline stand-in for detect_labels that spots red scratch pixels"""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft('RGB', (640, 640))
+        pixels = image.convert('RGB').resize((320, 180)).tobytes()
+    red = sum(1 for i in range(0, len(pixels), 3)
+              if pixels[i] > 150 and pixels[i + 1] < 90 and pixels[i + 2] < 90)
+    labels = [{'Name': 'Machine', 'Confidence': 97.0}]
+    if red >= 3:
+        labels.append({'Name': 'Scratch', 'Confidence': 92.0})
+    return {'Labels': labels}
+
+def rekognition_detect(image_bytes):
+    return clients.client('rekognition').detect_labels(
+        Image={'Bytes': image_bytes}, MaxLabels=10, MinConfidence=70
+    )
+
+def run(directory, detect, preprocessor):
+    with open(os.path.join(directory, 'labels.json')) as f:
+        dataset = json.load(f)
+
+    verdicts, latencies, sent = {}, [], []
+    calls = 0
+    last = {}
+    for name, label in sorted(dataset['frames'].items()):
+        with open(os.path.join(directory, name), 'rb') as f:
+            image_bytes = f.read()
+        camera = label['camera']
+
+        start = time.perf_counter()
+        if preprocessor is None:
+            analysis = image_analysis.build_analysis(name, detect(image_bytes))
+            sent.append(len(image_bytes))
+            calls += 1
+        else:
+            prepared, _, thumbnail = preprocessor.prepare(camera, image_bytes)
+            previous = last.get(camera)
+            if previous is not None and preprocessor.is_static(previous[0], thumbnail):
+                analysis = previous[1]
+            else:
+                analysis = image_analysis.build_analysis(name, detect(prepared))
+                sent.append(len(prepared))
+                calls += 1
+            last[camera] = (thumbnail, analysis)
+        latencies.append(time.perf_counter() - start)
+        verdicts[name] = image_analysis.has_defects(analysis)
+
+    correct = sum(verdicts[n] == l['defect'] for n, l in dataset['frames'].items())
+    return {
+        'verdicts': verdicts,
+        'accuracy': correct / len(verdicts),
+        'calls': calls,
+        'mean_bytes': statistics.mean(sent) if sent else 0,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': sorted(latencies)[int(len(latencies) * 0.99) - 1] * 1000,
+        'total_s': sum(latencies)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    parser.add_argument('--generate', action='store_true')
+    parser.add_argument('--frames', type=int, default=96)
+    parser.add_argument('--detector', choices=('local', 'rekognition'), default='local')
+    parser.add_argument('--max-dimension', type=int, default=1024)
+    parser.add_argument('--diff-threshold', type=float, default=12.0)
+    args = parser.parse_args()
+
+    if args.generate:
+        generate(args.directory, args.frames)
+        print(f"Wrote {args.frames} frames to {args.directory}")
+        return
+
+    with open(os.path.join(args.directory, 'labels.json')) as f:
+        rois = json.load(f).get('roi', {})
+    detect = local_detect if args.detector == 'local' else rekognition_detect
+    preprocessor = FramePreprocessor(max_dimension=args.max_dimension, rois=rois,
+                                     diff_threshold=args.diff_threshold)
+
+    baseline = run(args.directory, detect, None)
+    prepared = run(args.directory, detect, preprocessor)
+    agreement = sum(baseline['verdicts'][n] == v for n, v in prepared['verdicts'].items())
+
+    print(f"{'':>14} {'calls':>6} {'bytes/call':>11} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'total s':>8} {'accuracy':>9}")
+    for name, result in (('full frame', baseline), ('preprocessed', prepared)):
+        print(f"{name:>14} {result['calls']:>6} {result['mean_bytes']:>11.0f} "
+              f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} "
+              f"{result['total_s']:>8.2f} {result['accuracy']:>9.3f}")
+    print(f"has_defects agreement: {agreement}/{len(prepared['verdicts'])}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+"""Drive the Lambda handlers end to end against in-process AWS stubs
+
+Usage:
+    python benchmarks/bench_pipeline.py [handlers...] [--batch-size N] [--batches N]
+        [--latency SERVICE=MS[:JITTER[:PER_ITEM]] ...] [--save FILE] [--compare FILE]
+        [--events FILE] [--record FILE]
+
+Each handler runs in its own interpreter so peak RSS is its own, against
+the stubs in benchmarks/stubs.py (s3, dynamodb, sns, sagemaker,
+rekognition), which sleep per call when given a latency. Batched handlers
+get --batches events of --batch-size records; the alert and API handlers,
+and preprocessor_iot (direct IoT rule messages), get --batches x
+--batch-size single-record events. preprocessor_sqs feeds the preprocessor
+SQS messages holding --readings readings each instead of S3 objects. One warm-up event is run
+first, so these are warm numbers; see startup_profile.py for cold starts.
+
+A record's latency is the duration of the invocation that carried it, since
+all records of a batch complete together. --save writes the results as
+JSON and --compare prints the change against a saved run.
+
+--events replays recorded events instead of generated ones, for a single
+handler: batched records are regrouped into events of --batch-size, and
+each record is used once, so --batches is capped by what was recorded.
+Each line of the file is an event, or {"event": ..., "objects": {...}}
+with the base64 bodies of the S3 objects its records reference, keyed by
+"bucket/key". --record writes the events of a run in that format.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..', 'lambda')
+
+HANDLERS = ('preprocessor', 'preprocessor_sqs', 'preprocessor_iot', 'ml_processor',
+            'image_analysis', 'alert_processor', 'api')
+SERVICES = ('s3', 'dynamodb', 'sns', 'sagemaker', 'rekognition')
+
+ENVIRONMENT = {
+    'DYNAMODB_TABLE': 'bench',
+    'ANOMALY_TOPIC_ARN': 'arn:aws:sns:us-east-1:000000000000:anomalies',
+    'ALERT_TOPIC': 'arn:aws:sns:us-east-1:000000000000:alerts',
+    'SAGEMAKER_ENDPOINT': 'bench-endpoint',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'bench',
+    'AWS_SECRET_ACCESS_KEY': 'bench'
+}
+
+DEVICES = 200
+
+def reading(rng, device, moment):
+    """A raw sensor reading as devices publish it"""
+    return {
+        'device_id': f"device-{device}",
+        'device_type': 'press' if device % 2 else 'lathe',
+        'timestamp': moment.isoformat(),
+        'temperature': round(rng.gauss(70, 8), 2),
+        'vibration': round(rng.gammavariate(2.0, 0.2), 3)
+    }
+
+def processed(rng, device, moment):
+    """A processed reading as the preprocessor emits it"""
+    raw = reading(rng, device, moment)
+    status = lambda value, warning, critical: \
+        'critical' if value > critical else 'warning' if value > warning else 'normal'
+    return {
+        'deviceId': raw['device_id'],
+        'timestamp': raw['timestamp'],
+        'temperature': {'value': raw['temperature'], 'threshold': 80,
+                        'status': status(raw['temperature'], 80, 90)},
+        'vibration': {'value': raw['vibration'], 'threshold': 0.8,
+                      'status': status(raw['vibration'], 0.8, 1.0)}
+    }
+
+class Scenario:
+    """Builds the events for one handler; invocations() yields (event, records)"""
+
+    def __init__(self, stubs, args):
+        self.stubs = stubs
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.clock = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+    def tick(self, seconds=1):
+        self.clock += timedelta(seconds=seconds)
+        return self.clock
+
+class PreprocessorScenario(Scenario):
+    module = 'preprocessor'
+
+    def event(self, n):
+        records = []
+        for i in range(n):
+            lines = [json.dumps(reading(self.rng, self.rng.randrange(DEVICES), self.tick()))
+                     for _ in range(self.args.readings)]
+            key = f"sensors/{uuid.uuid4().hex}.ndjson"
+            body = '\n'.join(lines).encode('utf-8')
+            self.stubs.s3.add_object('raw', key, body)
+            records.append({
+                'eventSource': 'aws:s3',
+                's3': {'bucket': {'name': 'raw'},
+                       'object': {'key': key, 'size': len(body), 'sequencer': f"{i:016x}"}}
+            })
+        return {'Records': records}
+
+    def invocations(self, batches, size):
+        for _ in range(batches):
+            yield self.event(size), size
+
+class PreprocessorSQSScenario(PreprocessorScenario):
+    def invocations(self, batches, size):
+        for _ in range(batches):
+            yield {'Records': [
+                {'eventSource': 'aws:sqs', 'messageId': str(uuid.uuid4()),
+                 'body': json.dumps([reading(self.rng, self.rng.randrange(DEVICES), self.tick())
+                                     for _ in range(self.args.readings)])}
+                for _ in range(size)
+            ]}, size
+
+class PreprocessorIoTScenario(PreprocessorScenario):
+    def invocations(self, batches, size):
+        for _ in range(batches * size):
+            yield reading(self.rng, self.rng.randrange(DEVICES), self.tick()), 1
+
+class MLScenario(Scenario):
+    module = 'ml_processor'
+
+    def invocations(self, batches, size):
+        for _ in range(batches):
+            yield {'Records': [
+                {'eventSource': 'aws:sqs', 'messageId': str(uuid.uuid4()),
+                 'body': json.dumps(processed(self.rng, self.rng.randrange(DEVICES), self.tick()))}
+                for _ in range(size)
+            ]}, size
+
+class ImageScenario(Scenario):
+    module = 'image_analysis'
+    CAMERAS = 8
+
+    def __init__(self, stubs, args):
+        super().__init__(stubs, args)
+        from PIL import Image, ImageDraw
+
+        # A few distinct scenes per camera; consecutive frames repeat them
+        # with sensor noise, as a line camera does
+        self.scenes = []
+        for scene in range(16):
+            image = Image.new('RGB', (640, 480), (90 + scene * 5,) * 3)
+            draw = ImageDraw.Draw(image)
+            draw.rectangle([100 + scene * 10, 80, 500, 400 - scene * 8], fill=(160, 160, 170))
+            self.scenes.append(image)
+        self.frame = 0
+
+    def frame_bytes(self, camera):
+        image = self.scenes[(self.frame // 6 + camera) % len(self.scenes)].copy()
+        for _ in range(50):
+            image.putpixel((self.rng.randrange(640), self.rng.randrange(480)),
+                           (self.rng.randrange(256),) * 3)
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=85)
+        self.frame += 1
+        return output.getvalue()
+
+    def invocations(self, batches, size):
+        for _ in range(batches):
+            records = []
+            for i in range(size):
+                camera = i % self.CAMERAS
+                key = f"camera-{camera}/{uuid.uuid4().hex}.jpg"
+                body = self.frame_bytes(camera)
+                self.stubs.s3.add_object('images', key, body)
+                records.append({
+                    'eventSource': 'aws:s3',
+                    's3': {'bucket': {'name': 'images'},
+                           'object': {'key': key, 'size': len(body), 'sequencer': f"{i:016x}"}}
+                })
+            yield {'Records': records}, size
+
+class AlertScenario(Scenario):
+    module = 'alert_processor'
+
+    def invocations(self, batches, size):
+        for _ in range(batches * size):
+            # A storm: a few devices stay hot and keep alerting
+            detail = processed(self.rng, self.rng.randrange(20), self.tick())
+            detail['temperature'].update(value=95.0, status='critical'
+                                         if self.rng.random() < 0.3 else 'warning')
+            detail['type'] = 'sensor'
+            yield {'detail-type': 'Sensor Alert', 'detail': detail}, 1
+
+class ApiScenario(Scenario):
+    module = 'api'
+
+    def __init__(self, stubs, args):
+        super().__init__(stubs, args)
+        from shared.schema import alert_item, reading_item, registration_item
+        table = stubs.table
+        for device in range(DEVICES):
+            device_id = f"device-{device}"
+            table.add_item(registration_item(device_id, 'press'))
+            for i in range(50):
+                moment = self.tick(60)
+                table.add_item(reading_item(processed(self.rng, device, moment)))
+                if i % 10 == 0:
+                    # Most alerts in the history are closed
+                    table.add_item(alert_item({
+                        'alertId': uuid.UUID(int=self.rng.getrandbits(128)).hex,
+                        'timestamp': moment.replace(tzinfo=None).isoformat(),
+                        'deviceId': device_id, 'type': 'sensor',
+                        'severity': self.rng.choice(('warning', 'critical')),
+                        'status': 'new' if i == 40 else 'resolved'
+                    }))
+
+    def invocations(self, batches, size):
+        routes = [
+            ('/devices', lambda device: {'limit': '50'}),
+            ('/alerts', lambda device: {'deviceId': device}),
+            ('/alerts', lambda device: {'severity': 'critical', 'limit': '50'}),
+            ('/alerts', lambda device: {'deviceId': device, 'status': 'open', 'count': 'true'}),
+            ('/metrics', lambda device: {'deviceId': device, 'resolution': 'raw', 'limit': '100',
+                                         'from': '2024-05-01T00:00:00',
+                                         'to': '2024-05-09T00:00:00'}),
+            ('/metrics', lambda device: {'deviceId': device, 'from': '2024-05-01T00:00:00',
+                                         'to': '2024-05-02T00:00:00'})
+        ]
+        for _ in range(batches * size):
+            path, params = self.rng.choice(routes)
+            device = f"device-{self.rng.randrange(DEVICES)}"
+            yield {'httpMethod': 'GET', 'path': path,
+                   'queryStringParameters': params(device)}, 1
+
+class RecordedScenario(Scenario):
+    """Replays the events of an --events file"""
+
+    def __init__(self, stubs, args, module):
+        super().__init__(stubs, args)
+        self.module = module
+        self.events = []
+        with open(args.events) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if 'event' not in entry:
+                    entry = {'event': entry}
+                for path, body in entry.get('objects', {}).items():
+                    bucket, _, key = path.partition('/')
+                    stubs.s3.add_object(bucket, key, base64.b64decode(body))
+                self.events.append(entry['event'])
+        self.records = [record for event in self.events for record in event.get('Records', [])]
+        self.position = 0
+
+    def invocations(self, batches, size):
+        # Replaying a record twice would hit the handlers' idempotency checks
+        if not self.records:
+            for event in self.events[self.position:self.position + batches * size]:
+                self.position += 1
+                yield event, 1
+            return
+        for _ in range(batches):
+            records = self.records[self.position:self.position + size]
+            if not records:
+                return
+            self.position += len(records)
+            yield {'Records': records}, len(records)
+
+SCENARIOS = {
+    'preprocessor': PreprocessorScenario,
+    'preprocessor_sqs': PreprocessorSQSScenario,
+    'preprocessor_iot': PreprocessorIoTScenario,
+    'ml_processor': MLScenario,
+    'image_analysis': ImageScenario,
+    'alert_processor': AlertScenario,
+    'api': ApiScenario
+}
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def run_worker(args):
+    """Run one handler in this process and print its results as JSON"""
+    module = SCENARIOS[args.worker].module
+    sys.path[:0] = [HERE, ROOT, os.path.join(ROOT, module)]
+    os.environ.update({k: v for k, v in ENVIRONMENT.items() if k not in os.environ})
+    import stubs as stub_module
+
+    latencies = {service: stub_module.Latency.parse(spec)
+                 for service, spec in parse_latencies(args.latency).items()}
+    stubs = stub_module.install(latencies, table_name=os.environ['DYNAMODB_TABLE'])
+    if args.events:
+        scenario = RecordedScenario(stubs, args, module)
+    else:
+        scenario = SCENARIOS[args.worker](stubs, args)
+    record = open(args.record, 'w') if args.record else None
+    handler = __import__(module).handler
+
+    # Handlers print per-invocation stats; keep them out of the results
+    devnull = open(os.devnull, 'w')
+
+    def invoke(event):
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            return handler(event, None)
+        except Exception as e:
+            return {'error': str(e)}
+        finally:
+            sys.stdout = stdout
+
+    warmup, _ = next(scenario.invocations(1, 1))
+    invoke(warmup)
+    for stub in (stubs.s3, stubs.sns, stubs.sagemaker, stubs.rekognition, stubs.table):
+        stub.calls.clear()
+
+    durations, invocations, records, errors = [], [], 0, 0
+    elapsed = cpu = 0.0
+    for event, count in scenario.invocations(args.batches, args.batch_size):
+        if record:
+            record.write(json.dumps(recorded(stubs, event)) + '\n')
+        start, start_cpu = time.perf_counter(), time.process_time()
+        response = invoke(event)
+        duration = time.perf_counter() - start
+        invocations.append((duration, time.process_time() - start_cpu, count))
+        elapsed += duration
+        cpu += invocations[-1][1]
+        records += count
+        durations.extend([duration] * count)
+        if 'error' in response or response.get('statusCode', 200) >= 500:
+            errors += count
+        else:
+            errors += len(response.get('batchItemFailures', []))
+
+    if record:
+        record.close()
+
+    results = {
+        'records': records,
+        'errors': errors,
+        'seconds': elapsed,
+        'cpu_seconds': cpu,
+        'records_per_s': records / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(durations, 0.50) * 1000,
+        'p99_ms': percentile(durations, 0.99) * 1000,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'calls': stubs.calls()
+    }
+    if args.detail:
+        # Wall and CPU seconds and record count of every invocation
+        results['invocations'] = invocations
+    print(json.dumps(results))
+
+def recorded(stubs, event):
+    """An event as --record writes it, with the S3 objects it references"""
+    objects = {}
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:s3':
+            bucket, key = record['s3']['bucket']['name'], record['s3']['object']['key']
+            data = stubs.s3.objects[(bucket, key)][0]
+            objects[f"{bucket}/{key}"] = base64.b64encode(data).decode('ascii')
+    return {'event': event, 'objects': objects} if objects else event
+
+def parse_latencies(specs):
+    latencies = {}
+    for spec in specs or []:
+        service, _, value = spec.partition('=')
+        if service not in SERVICES or not value:
+            raise SystemExit(f"--latency expects SERVICE=MS[:JITTER[:PER_ITEM]] "
+                             f"with SERVICE one of {', '.join(SERVICES)}")
+        latencies[service] = value
+    return latencies
+
+def run(name, args, extra=()):
+    """Run one handler in a fresh interpreter"""
+    command = [sys.executable, os.path.abspath(__file__), '--worker', name,
+               '--batch-size', str(args.batch_size), '--batches', str(args.batches),
+               '--readings', str(args.readings), '--seed', str(args.seed)]
+    for spec in args.latency or []:
+        command += ['--latency', spec]
+    for option in ('events', 'record'):
+        if getattr(args, option, None):
+            command += [f"--{option}", getattr(args, option)]
+    command += list(extra)
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"{name} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def compare(results, baseline):
+    print(f"\n{'vs baseline':>16} {'records/s':>12} {'p50 ms':>10} {'p99 ms':>10} {'RSS MB':>10}")
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = lambda key: (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+        print(f"{name:>16} {change('records_per_s'):>+11.1f}% {change('p50_ms'):>+9.1f}% "
+              f"{change('p99_ms'):>+9.1f}% {change('peak_rss_mb'):>+9.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('handlers', nargs='*', help=f"any of: {', '.join(HANDLERS)}")
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--readings', type=int, default=20,
+                        help='readings per S3 object or SQS message for the preprocessor')
+    parser.add_argument('--latency', action='append', metavar='SERVICE=MS[:JITTER[:PER_ITEM]]')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--events', help='replay recorded events (one handler only)')
+    parser.add_argument('--record', help='write the events of the run (one handler only)')
+    parser.add_argument('--worker', choices=HANDLERS, help=argparse.SUPPRESS)
+    parser.add_argument('--detail', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    unknown = set(args.handlers) - set(HANDLERS)
+    if unknown:
+        parser.error(f"unknown handler(s): {', '.join(sorted(unknown))}")
+    if (args.events or args.record) and len(args.handlers) != 1:
+        parser.error('--events and --record take exactly one handler')
+    parse_latencies(args.latency)
+
+    results = {name: run(name, args) for name in args.handlers or HANDLERS}
+
+    print(f"{'handler':>16} {'records':>8} {'errors':>7} {'records/s':>10} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'RSS MB':>7}  calls")
+    for name, result in results.items():
+        calls = '; '.join(f"{service} " + ' '.join(f"{op}={n}" for op, n in ops.items())
+                          for service, ops in result['calls'].items())
+        print(f"{name:>16} {result['records']:>8} {result['errors']:>7} "
+              f"{result['records_per_s']:>10.1f} {result['p50_ms']:>8.1f} "
+              f"{result['p99_ms']:>8.1f} {result['peak_rss_mb']:>7.1f}  {calls}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'config': {k: getattr(args, k) for k in
+                                  ('batch_size', 'batches', 'readings', 'latency', 'seed')},
+                       'results': results}, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
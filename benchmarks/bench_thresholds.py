@@ -0,0 +1,85 @@
+"""Compare scalar and vectorized sensor threshold classification
+
+The vectorized path includes mapping every row's device id to its state
+slot, a dict lookup per row that takes most of its time; gathering the
+limits and classifying are single NumPy operations.
+
+Usage: python benchmarks/bench_thresholds.py [sizes...]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+LAMBDA = os.path.join(os.path.dirname(__file__), '..', 'lambda')
+sys.path[:0] = [LAMBDA, os.path.join(LAMBDA, 'preprocessor')]
+
+from shared.device_state import DeviceStateStore  # noqa: E402
+from thresholds import ThresholdTable, classify, classify_scalar  # noqa: E402
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+DEVICES = 500
+
+def make_readings(n, seed=0):
+    """Generate n synthetic temperature/vibration readings"""
+    rng = np.random.default_rng(seed)
+    return {
+        'device_ids': [f"device-{i % DEVICES}" for i in range(n)],
+        'temperature': rng.normal(70, 8, n).tolist(),
+        'vibration': rng.gamma(2.0, 0.2, n).tolist()
+    }
+
+def scalar_path(readings, table):
+    codes = []
+    for device_id, temp, vib in zip(readings['device_ids'],
+                                    readings['temperature'],
+                                    readings['vibration']):
+        t = classify_scalar(temp, *table.get('temperature', device_id))
+        v = classify_scalar(vib, *table.get('vibration', device_id))
+        codes.append(max(t, v))
+    return np.array(codes, dtype=np.int8)
+
+def vectorized_path(readings, table):
+    """Classify as the preprocessor does, from limits held in a device state store"""
+    states = DeviceStateStore({f"{metric}_{level}": 'd' for metric in table.defaults
+                               for level in ('warning', 'critical')})
+    for device_id in dict.fromkeys(readings['device_ids']):
+        states.set(device_id, **table.resolve(device_id))
+    slots = np.asarray(states.slots(readings['device_ids']))
+    codes = [
+        classify(readings[metric], states.values(f"{metric}_warning", slots),
+                 states.values(f"{metric}_critical", slots))
+        for metric in ('temperature', 'vibration')
+    ]
+    return np.maximum(*codes)
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def main(sizes):
+    tables = {
+        'defaults': ThresholdTable(),
+        'per-device': ThresholdTable(by_device={
+            f"device-{i}": {'temperature': (70.0, 80.0)} for i in range(0, DEVICES, 7)
+        })
+    }
+    print(f"{'rows':>10} {'thresholds':>12} {'scalar s':>10} {'vector s':>10} {'speedup':>8}")
+    for n in sizes:
+        readings = make_readings(n)
+        for name, table in tables.items():
+            expected, scalar_s = timed(scalar_path, readings, table)
+            actual, vector_s = timed(vectorized_path, readings, table)
+            assert np.array_equal(expected, actual)
+            print(f"{n:>10} {name:>12} {scalar_s:>10.4f} {vector_s:>10.4f} "
+                  f"{scalar_s / vector_s:>7.1f}x")
+
+    # Raw kernel cost once values are already columnar
+    values = np.asarray(make_readings(sizes[-1])['temperature'])
+    _, kernel_s = timed(classify, values, 75.0, 85.0)
+    print(f"classify kernel on {sizes[-1]} pre-built values: {kernel_s:.4f}s")
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
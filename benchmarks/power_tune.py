@@ -0,0 +1,230 @@
+"""Tune the Lambda profiles in lambda_profiles.json by replaying events
+
+Usage:
+    python benchmarks/power_tune.py [handlers...] [--events HANDLER=FILE ...]
+        [--batch-sizes N,N,...] [--memory MB,MB,...] [--rate [HANDLER=]N ...]
+        [--max-latency [HANDLER=]S ...] [--arm-cpu-factor F] [--latency SERVICE=MS...] [--write]
+
+Power tuning in the manner of AWS Lambda Power Tuning, run locally. Each
+handler replays events at every --batch-sizes value through the
+bench_pipeline.py worker, in a fresh interpreter against the stubs, with
+the service latencies of --latency (realistic in-region defaults unless
+given). --events replays events recorded with bench_pipeline.py --record,
+or captured in production in the same format; otherwise events are
+generated. Handlers that are not fed from a queue run one record per
+event.
+
+Memory settings are not run but modelled from what each invocation spent:
+Lambda allocates CPU in proportion to memory, one full vCPU at 1769 MB,
+and the handlers' CPU work runs on one core, so at M MB an invocation
+takes cpu_time * max(1, 1769 / M) plus its time waiting on services.
+--arm-cpu-factor scales the CPU part on arm64 against the host the
+harness runs on (1.0 unless measured, e.g. by running this on Graviton).
+Memory below 1.25 x the handler's peak RSS is never picked. Cost is the
+billed milliseconds at each architecture's GB-second price plus the
+request price, per record.
+
+For each handler the cheapest setting is picked whose records wait at
+most --max-latency seconds: the time to fill a batch at --rate records per
+second plus the p99 invocation duration. Queue-fed functions also get a
+concurrency cap of twice what the rate needs, which the queue absorbs;
+synchronous ones stay unreserved, as a cap would turn bursts into errors.
+--write stores the picks in the profiles file; batch settings are only
+written for event sources the profile declares.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import bench_pipeline  # noqa: E402
+from bench_pipeline import percentile  # noqa: E402
+
+PROFILES = os.path.join(HERE, '..', 'lambda_profiles.json')
+
+# Handler scenario -> (profile, event source feeding it, or None)
+TUNED = {
+    'preprocessor_sqs': ('preprocessor', 'sqs'),
+    'preprocessor_iot': ('preprocessor', None),
+    'ml_processor': ('ml_processor', 'sqs'),
+    'image_analysis': ('image_analysis', None),
+    'alert_processor': ('alert_processor', None),
+    'api': ('api', None)
+}
+DEFAULT_HANDLERS = ('preprocessor_sqs', 'ml_processor', 'image_analysis', 'alert_processor',
+                    'api')
+
+DEFAULT_LATENCY = ('s3=20:10', 'dynamodb=5:3:0.2', 'sns=15:5', 'sagemaker=40:20:0.5',
+                   'rekognition=250:100')
+
+# Memory at which a function gets one full vCPU
+FULL_VCPU_MB = 1769
+RSS_HEADROOM = 1.25
+CONCURRENCY_HEADROOM = 2
+
+# us-east-1 prices: per GB-second by architecture, and per request
+GB_SECOND_PRICE = {'x86_64': 0.0000166667, 'arm64': 0.0000133334}
+REQUEST_PRICE = 0.0000002
+
+def measure(name, batch_size, args):
+    """Run one handler at one batch size and return the worker's results"""
+    options = SimpleNamespace(batch_size=batch_size, batches=args.batches,
+                              readings=args.readings, seed=args.seed,
+                              latency=args.latency or DEFAULT_LATENCY,
+                              events=args.events.get(name))
+    if TUNED[name][1] is None:
+        # One record per event; keep the record count of the batched runs
+        options.batches, options.batch_size = args.batches * batch_size, 1
+    return bench_pipeline.run(name, options, ['--detail'])
+
+def model(result, memory, architecture, args):
+    """Duration and cost of the measured invocations at memory MB"""
+    slowdown = max(1.0, FULL_VCPU_MB / memory)
+    if architecture == 'arm64':
+        slowdown *= args.arm_cpu_factor
+    durations, cost, records = [], 0.0, 0
+    for wall, cpu, count in result['invocations']:
+        duration = cpu * slowdown + max(0.0, wall - cpu)
+        durations.append(duration)
+        cost += math.ceil(duration * 1000) / 1000 * memory / 1024 * \
+            GB_SECOND_PRICE[architecture] + REQUEST_PRICE
+        records += count
+    return {
+        'memory_size': memory,
+        'architecture': architecture,
+        'mean_ms': sum(durations) / len(durations) * 1000,
+        'p99_ms': percentile(durations, 0.99) * 1000,
+        'cost_per_million': cost / records * 1e6
+    }
+
+def tune(name, args):
+    """Measure every batch size and pick the cheapest setting within budget"""
+    profile, source = TUNED[name]
+    rate = args.rate.get(name, args.rate[None])
+    budget = args.max_latency.get(name, args.max_latency[None])
+    options = []
+    for batch_size in args.batch_sizes if source else [1]:
+        result = measure(name, batch_size, args)
+        if not result['invocations']:
+            print(f"{name}: no events to replay at batch size {batch_size}", file=sys.stderr)
+            continue
+        floor = result['peak_rss_mb'] * RSS_HEADROOM
+        fill = (batch_size - 1) / rate if source else 0.0
+        for memory in args.memory:
+            if memory < floor:
+                continue
+            for architecture in GB_SECOND_PRICE:
+                option = model(result, memory, architecture, args)
+                option.update(batch_size=batch_size, fill_s=fill,
+                              within_budget=fill + option['p99_ms'] / 1000 <= budget)
+                options.append(option)
+    if not options:
+        return None
+    feasible = [option for option in options if option['within_budget']] or options
+    best = min(feasible, key=lambda option: (option['cost_per_million'], option['p99_ms']))
+
+    pick = {'memory_size': best['memory_size'], 'architecture': best['architecture']}
+    if source:
+        # Lambda waits at most the window for a batch to fill; SQS batches of
+        # more than 10 need a window of at least a second
+        window = min(300, math.ceil(best['fill_s']))
+        if source == 'sqs' and best['batch_size'] > 10:
+            window = max(1, window)
+        pick['event_sources'] = {source: {'batch_size': best['batch_size'],
+                                          'max_batching_window': window}}
+        needed = rate / best['batch_size'] * best['mean_ms'] / 1000
+        pick['reserved_concurrency'] = max(2, math.ceil(needed * CONCURRENCY_HEADROOM))
+    return {'profile': profile, 'source': source, 'rate': rate, 'budget': budget,
+            'options': options, 'best': best, 'pick': pick}
+
+def report(name, tuned):
+    source = tuned['source'] or 'one record per event'
+    print(f"\n{name} -> {tuned['profile']} ({source}, {tuned['rate']:g} records/s, "
+          f"budget {tuned['budget']:g} s)")
+    print(f"  {'batch':>5} {'memory':>6} {'arch':>6} {'mean ms':>8} {'p99 ms':>8} "
+          f"{'$/1M rec':>9}")
+    for option in tuned['options']:
+        mark = '*' if option is tuned['best'] else ' ' if option['within_budget'] else '-'
+        print(f"{mark} {option['batch_size']:>5} {option['memory_size']:>6} "
+              f"{option['architecture']:>6} {option['mean_ms']:>8.1f} {option['p99_ms']:>8.1f} "
+              f"{option['cost_per_million']:>9.3f}")
+    print(f"  pick: {json.dumps(tuned['pick'])}")
+
+def write(path, results):
+    """Store the picks in the profiles file"""
+    with open(path) as f:
+        profiles = json.load(f)
+    for tuned in results.values():
+        profile = profiles[tuned['profile']]
+        pick = tuned['pick']
+        profile.update(memory_size=pick['memory_size'], architecture=pick['architecture'])
+        declared = profile.get('event_sources', {})
+        for source, settings in pick.get('event_sources', {}).items():
+            if source in declared:
+                declared[source].update(settings)
+        if 'reserved_concurrency' in pick:
+            profile['reserved_concurrency'] = pick['reserved_concurrency']
+    with open(path, 'w') as f:
+        json.dump(profiles, f, indent=4)
+        f.write('\n')
+
+def keyed(specs, parse, default):
+    """Parse repeated [HANDLER=]VALUE options; None keys the default"""
+    values = {None: default}
+    for spec in specs or []:
+        name, value = spec.split('=', 1) if '=' in spec else (None, spec)
+        values[name] = parse(value)
+    return values
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('handlers', nargs='*', help=f"any of: {', '.join(TUNED)}")
+    parser.add_argument('--events', action='append', metavar='HANDLER=FILE')
+    parser.add_argument('--batch-sizes', default='1,10,50,100,250')
+    parser.add_argument('--memory', default='256,512,1024,1536,1769,2048,3008')
+    parser.add_argument('--rate', action='append', metavar='[HANDLER=]N',
+                        help='records per second arriving (default 100)')
+    parser.add_argument('--max-latency', action='append', metavar='[HANDLER=]S',
+                        help='seconds a record may wait for its result (default 5)')
+    parser.add_argument('--arm-cpu-factor', type=float, default=1.0)
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--readings', type=int, default=20)
+    parser.add_argument('--latency', action='append', metavar='SERVICE=MS[:JITTER[:PER_ITEM]]')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profiles', default=PROFILES)
+    parser.add_argument('--write', action='store_true')
+    args = parser.parse_args()
+
+    handlers = args.handlers or DEFAULT_HANDLERS
+    unknown = set(handlers) - set(TUNED)
+    if unknown:
+        parser.error(f"unknown handler(s): {', '.join(sorted(unknown))}")
+    profiles = [TUNED[name][0] for name in handlers]
+    if len(set(profiles)) != len(profiles):
+        parser.error('tune one handler per profile')
+    args.batch_sizes = [int(size) for size in args.batch_sizes.split(',')]
+    args.memory = [int(memory) for memory in args.memory.split(',')]
+    args.rate = keyed(args.rate, float, 100.0)
+    args.max_latency = keyed(args.max_latency, float, 5.0)
+    args.events = {name: path for name, path in keyed(args.events, str, None).items() if name}
+    bench_pipeline.parse_latencies(args.latency)
+
+    results = {}
+    for name in handlers:
+        tuned = tune(name, args)
+        if tuned is None:
+            continue
+        results[name] = tuned
+        report(name, tuned)
+
+    if args.write:
+        write(args.profiles, results)
+        print(f"\nwrote {os.path.relpath(args.profiles)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Profile Lambda cold-start cost: module import time per handler, broken
+down by top-level package, and first-use cost of each AWS client
+
+Usage:
+    python benchmarks/startup_profile.py [--repeat N] [--output FILE]
+    python benchmarks/startup_profile.py --baseline FILE [--max-regression PCT]
+
+Every measurement runs in a fresh interpreter so nothing is cached between
+handlers. With --baseline the run exits non-zero when a handler's import or
+client init time grew by more than --max-regression percent (plus a small
+absolute allowance for noise); CI compares against a baseline saved with
+--output on the same runner type. The first client created in a process also
+pays for the boto3 session, so client times are only comparable per handler.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+
+# Handler module, and the clients its main code path creates on first use
+HANDLERS = {
+    'preprocessor': ('preprocessor', ['client:s3', 'client:sns', 'table']),
+    'ml_processor': ('ml_processor', ['client:sagemaker-runtime', 'table']),
+    'image_analysis': ('image_analysis', ['client:s3', 'client:rekognition', 'table']),
+    'alert_processor': ('alert_processor', ['client:sns', 'table']),
+    'api': ('api', ['table'])
+}
+
+# Milliseconds a measurement may grow before counting as a regression
+NOISE_MS = 15
+
+PROBE = """
+import json, sys, time
+sys.path[:0] = [{root!r}, {directory!r}]
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+from shared import clients
+init = {{}}
+for spec in {clients!r}:
+    kind, _, service = spec.partition(':')
+    begin = time.perf_counter()
+    clients.table() if kind == 'table' else getattr(clients, kind)(service)
+    init[spec] = (time.perf_counter() - begin) * 1000
+print(json.dumps({{'import_ms': (imported - start) * 1000, 'clients_ms': init}}))
+"""
+
+def probe(name):
+    """Import one handler in a fresh interpreter and time it"""
+    module, services = HANDLERS[name]
+    directory = os.path.join(ROOT, name)
+    env = dict(os.environ, DYNAMODB_TABLE=os.environ.get('DYNAMODB_TABLE', 'profile'),
+               AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+               AWS_ACCESS_KEY_ID=os.environ.get('AWS_ACCESS_KEY_ID', 'profile'),
+               AWS_SECRET_ACCESS_KEY=os.environ.get('AWS_SECRET_ACCESS_KEY', 'profile'))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         PROBE.format(root=ROOT, directory=directory, module=module, clients=services)],
+        cwd=directory, env=env, capture_output=True, text=True, check=True
+    )
+    measured = json.loads(result.stdout.strip().splitlines()[-1])
+    measured['packages_ms'] = package_times(result.stderr)
+    return measured
+
+def package_times(importtime):
+    """Sum -X importtime self times by top-level package, in milliseconds"""
+    totals = {}
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + int(self_us) / 1000
+    return totals
+
+def profile(name, repeat):
+    runs = [probe(name) for _ in range(repeat)]
+    packages = {}
+    for run in runs:
+        for package, ms in run['packages_ms'].items():
+            packages.setdefault(package, []).append(ms)
+    return {
+        'import_ms': statistics.median(run['import_ms'] for run in runs),
+        'clients_ms': {
+            spec: statistics.median(run['clients_ms'][spec] for run in runs)
+            for spec in runs[0]['clients_ms']
+        },
+        'packages_ms': {
+            package: statistics.median(values + [0] * (repeat - len(values)))
+            for package, values in sorted(packages.items(),
+                                          key=lambda item: -sum(item[1]))[:10]
+        }
+    }
+
+def regressions(results, baseline, max_regression):
+    """List measurements that grew beyond the allowed regression"""
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        pairs = [('import', result['import_ms'], before['import_ms'])]
+        pairs += [(spec, ms, before['clients_ms'][spec])
+                  for spec, ms in result['clients_ms'].items()
+                  if spec in before.get('clients_ms', {})]
+        for label, now, then in pairs:
+            if now > then * (1 + max_regression / 100) + NOISE_MS:
+                found.append(f"{name} {label}: {then:.1f} ms -> {now:.1f} ms")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('handlers', nargs='*', help=f"any of: {', '.join(HANDLERS)}")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--max-regression', type=float, default=20.0)
+    args = parser.parse_args()
+    unknown = set(args.handlers) - set(HANDLERS)
+    if unknown:
+        parser.error(f"unknown handler(s): {', '.join(sorted(unknown))}")
+
+    results = {name: profile(name, args.repeat) for name in args.handlers or HANDLERS}
+
+    print(f"{'handler':>16} {'import ms':>10} {'clients ms':>11}  top packages (self ms)")
+    for name, result in results.items():
+        top = ', '.join(f"{p} {ms:.0f}" for p, ms in list(result['packages_ms'].items())[:4])
+        print(f"{name:>16} {result['import_ms']:>10.1f} "
+              f"{sum(result['clients_ms'].values()):>11.1f}  {top}")
+        for spec, ms in result['clients_ms'].items():
+            print(f"{'':>16} {spec:>22} {ms:>8.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.max_regression)
+        for line in found:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if found else 0)
+
+if __name__ == '__main__':
+    main()
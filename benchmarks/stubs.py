@@ -0,0 +1,455 @@
+"""In-process stand-ins for the AWS services the handlers call
+
+Each stub implements just the API surface the handlers use, keeps its data
+in memory, counts calls, and can sleep per call to model service latency.
+install() registers them with shared.clients so handler code runs
+unchanged. The stubs accept anything the handlers send; they do not
+enforce service limits or DynamoDB's type rules.
+"""
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+class Latency:
+    """Per-call delay: a fixed part, uniform jitter and a per-item part"""
+
+    def __init__(self, ms=0.0, jitter_ms=0.0, per_item_ms=0.0, seed=None):
+        self.ms = ms
+        self.jitter_ms = jitter_ms
+        self.per_item_ms = per_item_ms
+        self.random = random.Random(seed)
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse 'ms[:jitter_ms[:per_item_ms]]'"""
+        return cls(*(float(part) for part in spec.split(':')))
+
+    def wait(self, items=1):
+        delay = self.ms + self.per_item_ms * items
+        if self.jitter_ms:
+            delay += self.random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+class Stub:
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, name, items=1):
+        with self._lock:
+            self.calls[name] += 1
+        self.latency.wait(items)
+
+class Body(io.BytesIO):
+    """A StreamingBody look-alike"""
+
+    def iter_lines(self, chunk_size=1024, keepends=False):
+        for line in self:
+            yield line if keepends else line.rstrip(b'\r\n')
+
+class S3Stub(Stub):
+    def __init__(self, latency=None):
+        super().__init__(latency)
+        self.objects = {}
+
+    def add_object(self, bucket, key, data, content_type=None):
+        """Seed an object without counting a call"""
+        self.objects[(bucket, key)] = (data, content_type, None)
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, ContentEncoding=None, **kwargs):
+        self._call('PutObject')
+        data = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        self.objects[(Bucket, Key)] = (data, ContentType, ContentEncoding)
+        return {'ETag': '"' + hashlib.md5(data).hexdigest() + '"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call('GetObject')
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+        data, content_type, encoding = self.objects[(Bucket, Key)]
+        response = {'Body': Body(data), 'ContentLength': len(data),
+                    'ContentType': content_type or 'binary/octet-stream'}
+        if encoding:
+            response['ContentEncoding'] = encoding
+        return response
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self._call('ListObjectsV2')
+        contents = [{'Key': key, 'Size': len(data)}
+                    for (bucket, key), (data, _, _) in sorted(self.objects.items())
+                    if bucket == Bucket and key.startswith(Prefix)]
+        return {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': False}
+
+    def get_paginator(self, operation):
+        # Every listing fits in one page
+        stub = self
+        class Paginator:
+            def paginate(self, **kwargs):
+                yield getattr(stub, operation)(**kwargs)
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        self._call('DeleteObjects', len(Delete['Objects']))
+        for obj in Delete['Objects']:
+            self.objects.pop((Bucket, obj['Key']), None)
+        return {'Deleted': [{'Key': obj['Key']} for obj in Delete['Objects']]}
+
+class SNSStub(Stub):
+    def __init__(self, latency=None):
+        super().__init__(latency)
+        self.messages = []
+
+    def publish(self, TopicArn, Message, **kwargs):
+        self._call('Publish')
+        self.messages.append((TopicArn, Message, kwargs.get('MessageAttributes', {})))
+        return {'MessageId': str(len(self.messages))}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self._call('PublishBatch', len(PublishBatchRequestEntries))
+        for entry in PublishBatchRequestEntries:
+            self.messages.append((TopicArn, entry['Message'], entry.get('MessageAttributes', {})))
+        return {'Successful': [{'Id': entry['Id'], 'MessageId': entry['Id']}
+                               for entry in PublishBatchRequestEntries], 'Failed': []}
+
+class SageMakerStub(Stub):
+    """Scores {"deviceId", "features"} payloads, singly or as "instances" """
+
+    def invoke_endpoint(self, EndpointName, Body, ContentType=None, **kwargs):
+        request = json.loads(Body)
+        instances = request.get('instances')
+        self._call('InvokeEndpoint', len(instances) if instances is not None else 1)
+        if instances is not None:
+            result = {'predictions': [self.score(instance) for instance in instances]}
+        else:
+            result = self.score(request)
+        return {'Body': io.BytesIO(json.dumps(result).encode('utf-8')),
+                'ContentType': 'application/json'}
+
+    @staticmethod
+    def score(payload):
+        temperature, vibration = (list(payload.get('features', [])) + [0, 0])[:2]
+        risk = min(1.0, max(0.0, (temperature - 60) / 40 * 0.6 + vibration * 0.4))
+        return {'failureProbability': round(risk, 4), 'label': int(risk > 0.5)}
+
+class RekognitionStub(Stub):
+    """Labels every image as Machine; about one in ten also gets a Scratch"""
+
+    def detect_labels(self, Image, MaxLabels=10, MinConfidence=70, **kwargs):
+        self._call('DetectLabels')
+        source = Image.get('Bytes') or json.dumps(Image.get('S3Object')).encode('utf-8')
+        digest = hashlib.sha1(source).digest()
+        labels = [{'Name': 'Machine', 'Confidence': 97.5}]
+        if digest[0] < 26:
+            labels.append({'Name': 'Scratch', 'Confidence': 80 + digest[1] % 20})
+        return {'Labels': labels[:MaxLabels]}
+
+class TableStub(Stub):
+    """A DynamoDB table with a (deviceId, timestamp) key, via the resource API
+
+    Supports conditional put/update, batch get/write through meta.client,
+    query with key conditions, filters, Limit, ExclusiveStartKey, projections,
+    Select='COUNT' and ScanIndexForward, segmented scan and batch_writer.
+    Queries with IndexName filter the whole table instead, ordered by the
+    index keys when indexes maps the index name to its (partition, sort)
+    attribute names.
+    """
+
+    def __init__(self, name='bench', key_names=('deviceId', 'timestamp'), latency=None,
+                 indexes=None):
+        super().__init__(latency)
+        self.name = name
+        self.key_names = key_names
+        self.indexes = indexes or {}
+        self.partitions = {}
+        self.meta = type('Meta', (), {'client': _TableClient(self)})()
+
+    def item_count(self):
+        return sum(len(partition) for partition in self.partitions.values())
+
+    def add_item(self, item):
+        """Seed an item without counting a call"""
+        self._put(item)
+
+    def _key(self, item):
+        return tuple(item.get(name) for name in self.key_names)
+
+    def _get(self, key):
+        partition = self.partitions.get(key[0], {})
+        return partition.get(key[1:] if len(key) > 1 else None)
+
+    def _put(self, item):
+        key = self._key(item)
+        partition = self.partitions.setdefault(key[0], {})
+        partition[key[1:] if len(key) > 1 else None] = dict(item)
+
+    def _delete(self, key):
+        self.partitions.get(key[0], {}).pop(key[1:] if len(key) > 1 else None, None)
+
+    def put_item(self, Item, ConditionExpression=None, **kwargs):
+        self._call('PutItem')
+        with self._lock:
+            if ConditionExpression is not None and \
+               not evaluate(ConditionExpression, self._get(self._key(Item))):
+                raise _conditional_failure('PutItem')
+            self._put(Item)
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        self._call('GetItem')
+        item = self._get(self._key(Key))
+        return {'Item': dict(item)} if item is not None else {}
+
+    def delete_item(self, Key, ConditionExpression=None, **kwargs):
+        self._call('DeleteItem')
+        with self._lock:
+            if ConditionExpression is not None and \
+               not evaluate(ConditionExpression, self._get(self._key(Key))):
+                raise _conditional_failure('DeleteItem')
+            self._delete(self._key(Key))
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None,
+                    ExpressionAttributeNames=None, ConditionExpression=None, **kwargs):
+        self._call('UpdateItem')
+        values = ExpressionAttributeValues or {}
+        names = ExpressionAttributeNames or {}
+        with self._lock:
+            current = self._get(self._key(Key))
+            if ConditionExpression is not None and not evaluate(ConditionExpression, current):
+                raise _conditional_failure('UpdateItem')
+            item = dict(current or Key)
+            for action, clause in re.findall(r'\b(SET|ADD|REMOVE)\b\s+(.*?)(?=\b(?:SET|ADD|REMOVE)\b|$)',
+                                             UpdateExpression):
+                for part in (p.strip() for p in clause.split(',') if p.strip()):
+                    if action == 'SET':
+                        name, value = (s.strip() for s in part.split('=', 1))
+                        # The value is a placeholder or another attribute's path
+                        item[names.get(name, name)] = values[value] if value.startswith(':') \
+                            else item.get(names.get(value, value))
+                    elif action == 'ADD':
+                        name, value = part.split()
+                        name = names.get(name, name)
+                        item[name] = item.get(name, 0) + values[value]
+                    else:
+                        item.pop(names.get(part, part), None)
+            self._put(item)
+        return {}
+
+    def query(self, KeyConditionExpression, IndexName=None, Limit=None, ExclusiveStartKey=None,
+              ProjectionExpression=None, ExpressionAttributeNames=None, FilterExpression=None,
+              Select=None, ScanIndexForward=True, **kwargs):
+        self._call('Query')
+        index_names = self.indexes.get(IndexName, ())
+        # Items sort by the index keys, then by the table keys
+        order = lambda item: tuple(item.get(name) for name in index_names) + self._key(item)
+        with self._lock:
+            if IndexName is None:
+                partition_value = _partition_value(KeyConditionExpression, self.key_names[0])
+                candidates = self.partitions.get(partition_value, {}).values()
+            else:
+                candidates = [item for partition in self.partitions.values()
+                              for item in partition.values()
+                              if all(name in item for name in index_names)]
+            items = sorted((dict(item) for item in candidates
+                            if evaluate(KeyConditionExpression, item)),
+                           key=order, reverse=not ScanIndexForward)
+
+        if ExclusiveStartKey is not None:
+            start = order(ExclusiveStartKey)
+            items = [item for item in items
+                     if (order(item) > start if ScanIndexForward else order(item) < start)]
+        response = {}
+        if Limit is not None and len(items) > Limit:
+            items = items[:Limit]
+            response['LastEvaluatedKey'] = {name: items[-1][name]
+                                            for name in self.key_names + tuple(index_names)}
+        # Like DynamoDB, the filter applies after Limit
+        if FilterExpression is not None:
+            items = [item for item in items if evaluate(FilterExpression, item)]
+        if Select == 'COUNT':
+            response['Count'] = len(items)
+            return response
+        if ProjectionExpression:
+            names = ExpressionAttributeNames or {}
+            paths = [names.get(p.strip(), p.strip()) for p in ProjectionExpression.split(',')]
+            items = [{p: item[p] for p in paths if p in item} for item in items]
+        response.update({'Items': items, 'Count': len(items)})
+        return response
+
+    def scan(self, Limit=None, ExclusiveStartKey=None, Segment=None, TotalSegments=None,
+             **kwargs):
+        self._call('Scan')
+        with self._lock:
+            items = sorted((dict(item) for partition in self.partitions.values()
+                            for item in partition.values()), key=self._key)
+        if TotalSegments:
+            items = [item for item in items
+                     if hash(item[self.key_names[0]]) % TotalSegments == Segment]
+        if ExclusiveStartKey is not None:
+            start = self._key(ExclusiveStartKey)
+            items = [item for item in items if self._key(item) > start]
+        response = {}
+        if Limit is not None and len(items) > Limit:
+            items = items[:Limit]
+            response['LastEvaluatedKey'] = {name: items[-1][name] for name in self.key_names}
+        response.update({'Items': items, 'Count': len(items)})
+        return response
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self)
+
+class _TableClient:
+    """The low-level calls reached through Table.meta.client"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems[self.table.name]['Keys']
+        self.table._call('BatchGetItem', len(keys))
+        found = [dict(item) for item in map(self.table._get, map(self.table._key, keys))
+                 if item is not None]
+        return {'Responses': {self.table.name: found}, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems):
+        requests = RequestItems[self.table.name]
+        self.table._call('BatchWriteItem', len(requests))
+        with self.table._lock:
+            for request in requests:
+                if 'PutRequest' in request:
+                    self.table._put(request['PutRequest']['Item'])
+                else:
+                    self.table._delete(self.table._key(request['DeleteRequest']['Key']))
+        return {'UnprocessedItems': {}}
+
+class _BatchWriter:
+    def __init__(self, table):
+        self.table = table
+        self.requests = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for start in range(0, len(self.requests), 25):
+            self.table.meta.client.batch_write_item(
+                RequestItems={self.table.name: self.requests[start:start + 25]}
+            )
+
+    def put_item(self, Item):
+        self.requests.append({'PutRequest': {'Item': Item}})
+
+    def delete_item(self, Key):
+        self.requests.append({'DeleteRequest': {'Key': Key}})
+
+def _conditional_failure(operation):
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                  'Message': 'The conditional request failed'}}, operation)
+
+def _partition_value(condition, name):
+    """Find the equality on the partition key in a key condition"""
+    if type(condition).__name__ == 'And':
+        for part in condition._values:
+            value = _partition_value(part, name)
+            if value is not None:
+                return value
+        return None
+    if type(condition).__name__ == 'Equals' and getattr(condition._values[0], 'name', None) == name:
+        return condition._values[1]
+    return None
+
+def _number(value):
+    return Decimal(str(value)) if isinstance(value, float) else value
+
+def evaluate(condition, item):
+    """Evaluate a boto3 condition object against an item (None when absent)"""
+    kind = type(condition).__name__
+    values = condition._values
+    if kind == 'And':
+        return evaluate(values[0], item) and evaluate(values[1], item)
+    if kind == 'Or':
+        return evaluate(values[0], item) or evaluate(values[1], item)
+    if kind == 'Not':
+        return not evaluate(values[0], item)
+
+    name = values[0].name
+    present = item is not None and name in item
+    if kind == 'AttributeNotExists':
+        return not present
+    if kind == 'AttributeExists':
+        return present
+    if not present:
+        return False
+
+    actual = _number(item[name])
+    operands = [_number(v) for v in values[1:]]
+    try:
+        if kind == 'Equals':
+            return actual == operands[0]
+        if kind == 'NotEquals':
+            return actual != operands[0]
+        if kind == 'LessThan':
+            return actual < operands[0]
+        if kind == 'LessThanEquals':
+            return actual <= operands[0]
+        if kind == 'GreaterThan':
+            return actual > operands[0]
+        if kind == 'GreaterThanEquals':
+            return actual >= operands[0]
+        if kind == 'Between':
+            return operands[0] <= actual <= operands[1]
+        if kind == 'BeginsWith':
+            return isinstance(actual, str) and actual.startswith(operands[0])
+        if kind == 'In':
+            return actual in operands[0]
+        if kind == 'Contains':
+            return operands[0] in actual
+    except TypeError:
+        return False
+    raise NotImplementedError(f"Unsupported condition: {kind}")
+
+class Stubs:
+    """The set of installed stubs"""
+
+    def __init__(self, latencies=None, table_name='bench', indexes=None):
+        latencies = latencies or {}
+        self.s3 = S3Stub(latencies.get('s3'))
+        self.sns = SNSStub(latencies.get('sns'))
+        self.sagemaker = SageMakerStub(latencies.get('sagemaker'))
+        self.rekognition = RekognitionStub(latencies.get('rekognition'))
+        self.table = TableStub(table_name, latency=latencies.get('dynamodb'), indexes=indexes)
+
+    def calls(self):
+        """Return call counts per service and operation"""
+        return {
+            service: dict(stub.calls)
+            for service, stub in (('s3', self.s3), ('sns', self.sns),
+                                  ('sagemaker', self.sagemaker),
+                                  ('rekognition', self.rekognition),
+                                  ('dynamodb', self.table))
+            if stub.calls
+        }
+
+def install(latencies=None, table_name='bench'):
+    """Create stubs and register them with shared.clients"""
+    from shared import clients
+    from shared.schema import INDEXES
+
+    stubs = Stubs(latencies, table_name, INDEXES)
+    clients.reset()
+    clients.override('s3', stubs.s3)
+    clients.override('sns', stubs.sns)
+    clients.override('sagemaker-runtime', stubs.sagemaker)
+    clients.override('rekognition', stubs.rekognition)
+    clients.override(table_name, stubs.table, kind='table')
+    return stubs
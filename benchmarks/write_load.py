@@ -0,0 +1,192 @@
+"""Check that the reading write path stays under DynamoDB's partition limits
+
+Usage:
+    python benchmarks/write_load.py [--rate N] [--devices N] [--hot-devices N]
+        [--hot-share F] [--hot-shards N] [--seconds N]
+    python benchmarks/write_load.py --table NAME [--threads N] ...
+    python benchmarks/write_load.py --stub [--latency MS[:JITTER[:PER_ITEM]]] ...
+
+By default nothing is written: --seconds of traffic at --rate readings per
+second is generated, --hot-share of it from --hot-devices chatty devices
+registered with --hot-shards write shards, and every reading is keyed both
+the old way (deviceId / ISO timestamp) and with shared.schema.reading_key.
+The report gives the write units per second of the hottest partition key
+under each layout against the 1000 WCU/s a single partition accepts;
+adaptive capacity can raise a table's throughput but never that of one
+key. Readings get millisecond timestamps; readings of one device in the
+same millisecond share a key under either layout.
+
+With --table the same traffic is written to a real table through
+BufferedWriter from --threads writers, and the counts of batch writes,
+retries of throttled (unprocessed) items and items that never got written
+are reported; run it against a scratch table provisioned like production. --stub writes to the
+in-process table from stubs.py instead, which only exercises the path.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'lambda'), HERE]
+
+from shared.schema import reading_item, reading_key
+
+# Write units a single partition accepts per second
+PARTITION_WCU = 1000
+
+def sample_reading(device_id, moment):
+    """A processed reading as the preprocessor stores it"""
+    return {
+        'deviceId': device_id,
+        'timestamp': moment.isoformat(),
+        'deviceType': 'press',
+        'temperature': {'value': 71.25, 'threshold': 80, 'status': 'normal'},
+        'vibration': {'value': 0.412, 'threshold': 0.8, 'status': 'normal'},
+        'processedAt': moment.isoformat()
+    }
+
+def item_size(item):
+    """Approximate DynamoDB item size: attribute names plus values"""
+    size = 0
+    for name, value in item.items():
+        size += len(name.encode('utf-8'))
+        if isinstance(value, dict):
+            size += 3 + item_size(value)
+        elif isinstance(value, str):
+            size += len(value.encode('utf-8'))
+        else:
+            # Numbers take about one byte per two digits plus one
+            size += len(str(value)) // 2 + 2
+    return size
+
+def traffic(args, rng):
+    """Yield (device_id, shards, moment) for every reading, second by second"""
+    start = datetime(2024, 5, 1, 23, 59, 30, tzinfo=timezone.utc)
+    hot_rate = args.rate * args.hot_share / max(1, args.hot_devices)
+    cold_rate = args.rate * (1 - args.hot_share) / max(1, args.devices - args.hot_devices)
+    for second in range(args.seconds):
+        base = start + timedelta(seconds=second)
+        for device in range(args.hot_devices):
+            for _ in range(poisson(rng, hot_rate)):
+                yield f"hot-{device}", args.hot_shards, offset(rng, base)
+        for _ in range(poisson(rng, cold_rate * (args.devices - args.hot_devices))):
+            yield f"device-{rng.randrange(args.devices)}", 1, offset(rng, base)
+
+def poisson(rng, mean):
+    if mean > 50:
+        return max(0, round(rng.gauss(mean, math.sqrt(mean))))
+    limit, k, p = math.exp(-mean), 0, rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+def offset(rng, base):
+    return base + timedelta(milliseconds=rng.randrange(1000))
+
+def model(args):
+    """Write units per partition key and second under both layouts"""
+    rng = random.Random(args.seed)
+    wcu = math.ceil(item_size(reading_item(
+        sample_reading('device-0', datetime.now(timezone.utc)))) / 1024)
+    legacy, sharded = Counter(), Counter()
+    readings = 0
+    for device_id, shards, moment in traffic(args, rng):
+        readings += 1
+        second = int(moment.timestamp())
+        legacy[(device_id, second)] += wcu
+        sharded[(reading_key(device_id, moment, shards)['deviceId'], second)] += wcu
+
+    def hottest(counts):
+        (key, _), peak = counts.most_common(1)[0]
+        return {'partition': key, 'wcu_per_second': peak,
+                'limit': PARTITION_WCU, 'throttled': peak > PARTITION_WCU}
+
+    return {
+        'readings': readings,
+        'readings_per_second': round(readings / args.seconds, 1),
+        'wcu_per_item': wcu,
+        'legacy': hottest(legacy),
+        'sharded': hottest(sharded),
+        'partitions': len({key for key, _ in sharded})
+    }
+
+def load(args, table):
+    """Write the traffic through BufferedWriter at the target rate"""
+    from shared.metrics import Metrics
+    from shared.utils import BufferedWriter
+
+    rng = random.Random(args.seed)
+    readings = [reading_item(sample_reading(device_id, moment), shards)
+                for device_id, shards, moment in traffic(args, rng)]
+
+    def write(part):
+        writer = BufferedWriter(table)
+        begin = time.perf_counter()
+        for i, item in enumerate(part):
+            # Pace each writer to its share of the rate
+            delay = begin + i * args.threads / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            writer.put(item)
+        return len(writer.flush())
+
+    out = io.StringIO()
+    instrumentation = Metrics('write_load', sample_rate=1, out=out)
+
+    @instrumentation.invocation
+    def run(event, context):
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            return sum(pool.map(write, [readings[i::args.threads]
+                                        for i in range(args.threads)]))
+
+    start = time.perf_counter()
+    failed = run(None, None)
+    elapsed = time.perf_counter() - start
+    record = json.loads(out.getvalue())
+    return {
+        'readings': len(readings),
+        'seconds': round(elapsed, 2),
+        'readings_per_second': round(len(readings) / elapsed, 1),
+        'batch_writes': record.get('BatchWrites', 0),
+        'retries': record.get('DynamoDBRetries', 0),
+        'failed': failed
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=5000, help='readings per second')
+    parser.add_argument('--devices', type=int, default=200000)
+    parser.add_argument('--hot-devices', type=int, default=10)
+    parser.add_argument('--hot-share', type=float, default=0.2)
+    parser.add_argument('--hot-shards', type=int, default=8)
+    parser.add_argument('--seconds', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--table')
+    parser.add_argument('--stub', action='store_true')
+    parser.add_argument('--latency', default='0')
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.table:
+        from shared import clients
+        result = load(args, clients.table(args.table))
+    elif args.stub:
+        import stubs
+        result = load(args, stubs.TableStub(latency=stubs.Latency.parse(args.latency)))
+    else:
+        result = model(args)
+    print(json.dumps(result, indent=2))
+    throttled = result['sharded']['throttled'] if 'sharded' in result else result['failed']
+    return 1 if throttled else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
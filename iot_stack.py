@@ -1,27 +1,55 @@
 from aws_cdk import (
     Stack,
+    BundlingOptions,
     Duration,
     CfnOutput,
     RemovalPolicy,
     aws_iot as iot,
     aws_s3 as s3,
     aws_lambda as lambda_,
+    aws_lambda_event_sources as lambda_event_sources,
+    aws_kinesis as kinesis,
+    aws_sqs as sqs,
     aws_dynamodb as dynamodb,
     aws_iam as iam,
     aws_apigateway as apigateway,
     aws_sagemaker as sagemaker,
     aws_sns as sns,
+    aws_sns_subscriptions as subscriptions,
     aws_cloudwatch as cloudwatch,
     aws_events as events,
     aws_events_targets as targets
 )
 from constructs import Construct
+import json
 import os
 
+# Per-function memory, architecture, timeout, concurrency and event source
+# batching, keyed by handler module; tune with benchmarks/power_tune.py
+PROFILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda_profiles.json')
+
+ARCHITECTURES = {
+    'arm64': lambda_.Architecture.ARM_64,
+    'x86_64': lambda_.Architecture.X86_64
+}
+
+# Wheels of the functions' dependencies are fetched for the target
+# architecture, so the layer builds without emulation
+LAYER_BUNDLING = (
+    'pip install -r requirements.txt -t /asset-output/python --only-binary=:all: '
+    '--implementation cp --python-version 3.9 --platform manylinux2014_{platform} && '
+    'mkdir -p /asset-output/python/shared && cp *.py /asset-output/python/shared/'
+)
+
 class IoTMLStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        # Another profiles file can be given per deployment (cdk -c lambda_profiles=FILE)
+        with open(self.node.try_get_context('lambda_profiles') or PROFILES) as f:
+            self.profiles = json.load(f)
+        self.layers = {}
+
         # S3 Buckets
         self.raw_data_bucket = s3.Bucket(
             self, 'RawDataBucket',
@@ -64,12 +92,42 @@ class IoTMLStack(Stack):
             stream_specification=dynamodb.StreamViewType.NEW_AND_OLD_IMAGES
         )
 
+        # Sparse indexes, in the order they were introduced: device registration
+        # items, then open alerts by severity and by device. See
+        # lambda/shared/schema.py for the key layout of every entity in the table.
+        # DynamoDB creates one index per table update, so a deployed table is
+        # upgraded one index per deploy (cdk deploy -c table_indexes=2, then 3);
+        # the handlers need all of them before new code takes traffic.
+        indexes = (
+            ('device-index', 'entity', 'deviceId'),
+            ('open-alerts', 'openSeverity', 'openedAt'),
+            ('open-device-alerts', 'openDeviceId', 'openedAt')
+        )
+        table_indexes = int(self.node.try_get_context('table_indexes') or len(indexes))
+        for index_name, partition_key, sort_key in indexes[:table_indexes]:
+            self.device_table.add_global_secondary_index(
+                index_name=index_name,
+                partition_key=dynamodb.Attribute(
+                    name=partition_key,
+                    type=dynamodb.AttributeType.STRING
+                ),
+                sort_key=dynamodb.Attribute(
+                    name=sort_key,
+                    type=dynamodb.AttributeType.STRING
+                )
+            )
+
         # SNS Topics
         self.alert_topic = sns.Topic(
             self, 'AlertTopic',
             display_name='IoT Alerts'
         )
 
+        self.anomaly_topic = sns.Topic(
+            self, 'AnomalyTopic',
+            display_name='IoT Anomalies'
+        )
+
         # Lambda Functions
         self.preprocessor_lambda = self.create_lambda(
             'PreprocessorLambda',
@@ -77,8 +135,9 @@ class IoTMLStack(Stack):
             'preprocessor.handler',
             {
                 'PROCESSED_BUCKET': self.processed_data_bucket.bucket_name,
-                'DEVICE_TABLE': self.device_table.table_name,
-                'ALERT_TOPIC': self.alert_topic.topic_arn
+                'DYNAMODB_TABLE': self.device_table.table_name,
+                'ALERT_TOPIC': self.alert_topic.topic_arn,
+                'ANOMALY_TOPIC_ARN': self.anomaly_topic.topic_arn
             }
         )
 
@@ -87,7 +146,7 @@ class IoTMLStack(Stack):
             'lambda/image_analysis',
             'image_analysis.handler',
             {
-                'DEVICE_TABLE': self.device_table.table_name,
+                'DYNAMODB_TABLE': self.device_table.table_name,
                 'ALERT_TOPIC': self.alert_topic.topic_arn
             }
         )
@@ -97,7 +156,7 @@ class IoTMLStack(Stack):
             'lambda/alert_processor',
             'alert_processor.handler',
             {
-                'DEVICE_TABLE': self.device_table.table_name,
+                'DYNAMODB_TABLE': self.device_table.table_name,
                 'ALERT_TOPIC': self.alert_topic.topic_arn
             }
         )
@@ -107,7 +166,7 @@ class IoTMLStack(Stack):
             'lambda/api',
             'api.handler',
             {
-                'DEVICE_TABLE': self.device_table.table_name
+                'DYNAMODB_TABLE': self.device_table.table_name
             }
         )
 
@@ -116,11 +175,85 @@ class IoTMLStack(Stack):
             'lambda/ml_processor',
             'ml_processor.handler',
             {
-                'DEVICE_TABLE': self.device_table.table_name,
-                'ALERT_TOPIC': self.alert_topic.topic_arn
+                'DYNAMODB_TABLE': self.device_table.table_name,
+                'ALERT_TOPIC': self.alert_topic.topic_arn,
+                # The endpoint is deployed outside this stack (cdk -c sagemaker_endpoint=NAME)
+                'SAGEMAKER_ENDPOINT': self.node.try_get_context('sagemaker_endpoint')
+                or 'iot-ml-endpoint'
             }
         )
 
+        for function in (self.preprocessor_lambda, self.image_analysis_lambda,
+                         self.alert_lambda, self.api_lambda, self.ml_lambda):
+            self.device_table.grant_read_write_data(function)
+        for function in (self.image_analysis_lambda, self.alert_lambda):
+            self.alert_topic.grant_publish(function)
+        self.anomaly_topic.grant_publish(self.preprocessor_lambda)
+        self.raw_data_bucket.grant_read(self.preprocessor_lambda)
+        self.raw_data_bucket.grant_read(self.image_analysis_lambda)
+        self.image_analysis_lambda.add_to_role_policy(iam.PolicyStatement(
+            actions=['rekognition:DetectLabels'],
+            resources=['*']
+        ))
+        self.ml_lambda.add_to_role_policy(iam.PolicyStatement(
+            actions=['sagemaker:InvokeEndpoint'],
+            resources=[self.format_arn(
+                service='sagemaker', resource='endpoint',
+                resource_name=self.node.try_get_context('sagemaker_endpoint') or 'iot-ml-endpoint'
+            )]
+        ))
+
+        # Anomalies reach the ML processor in batches through a queue
+        ml_dlq = sqs.Queue(
+            self, 'MLDeadLetterQueue',
+            retention_period=Duration.days(14)
+        )
+        self.ml_queue = sqs.Queue(
+            self, 'MLQueue',
+            visibility_timeout=Duration.minutes(30),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=3, queue=ml_dlq)
+        )
+        self.anomaly_topic.add_subscription(subscriptions.SqsSubscription(
+            self.ml_queue,
+            raw_message_delivery=True
+        ))
+        self.ml_lambda.add_event_source(lambda_event_sources.SqsEventSource(
+            self.ml_queue,
+            **self.batching('ml_processor', 'sqs'),
+            max_concurrency=self.profiles['ml_processor'].get('reserved_concurrency'),
+            report_batch_item_failures=True
+        ))
+
+        # The preprocessor exports Parquet readings to the processed bucket
+        self.processed_data_bucket.grant_read_write(self.preprocessor_lambda)
+        # and compacts each hour's part files once the hour has closed
+        events.Rule(
+            self, 'ExportCompactionSchedule',
+            schedule=events.Schedule.cron(minute='10'),
+            targets=[targets.LambdaFunction(self.preprocessor_lambda)]
+        )
+
+        # Metric rollups of the minutes marked by ingest are rebuilt off the
+        # ingest path
+        events.Rule(
+            self, 'RollupRefreshSchedule',
+            schedule=events.Schedule.rate(Duration.minutes(1)),
+            targets=[targets.LambdaFunction(
+                self.preprocessor_lambda,
+                event=events.RuleTargetInput.from_object({
+                    'detail-type': 'Scheduled Event',
+                    'detail': {'task': 'rollups'}
+                })
+            )]
+        )
+
+        # Suppressed alert bursts are summarised once their window closes
+        events.Rule(
+            self, 'AlertDigestSchedule',
+            schedule=events.Schedule.rate(Duration.minutes(1)),
+            targets=[targets.LambdaFunction(self.alert_lambda)]
+        )
+
         # API Gateway
         api = apigateway.RestApi(
             self, 'IoTAPI',
@@ -145,6 +278,13 @@ class IoTMLStack(Stack):
         
         analysis = api.root.add_resource('analysis')
         analysis.add_method('GET', api_integration)
+        
+        alerts = api.root.add_resource('alerts')
+        alerts.add_method('GET', api_integration)
+        alerts.add_method('POST', api_integration)
+        
+        metrics = api.root.add_resource('metrics')
+        metrics.add_method('GET', api_integration)
 
         # IoT Rule
         iot_role = iam.Role(
@@ -152,20 +292,76 @@ class IoTMLStack(Stack):
             assumed_by=iam.ServicePrincipal('iot.amazonaws.com')
         )
 
+        # Messages go straight to the preprocessor, or through a buffer that
+        # batches them per invocation (cdk -c ingest_buffer=sqs|kinesis)
+        ingest_buffer = self.node.try_get_context('ingest_buffer')
+        if ingest_buffer == 'sqs':
+            ingest_dlq = sqs.Queue(
+                self, 'IngestDeadLetterQueue',
+                retention_period=Duration.days(14)
+            )
+            self.ingest_queue = sqs.Queue(
+                self, 'IngestQueue',
+                visibility_timeout=Duration.minutes(30),
+                dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=3, queue=ingest_dlq)
+            )
+            self.ingest_queue.grant_send_messages(iot_role)
+            self.preprocessor_lambda.add_event_source(lambda_event_sources.SqsEventSource(
+                self.ingest_queue,
+                **self.batching('preprocessor', 'sqs'),
+                max_concurrency=self.profiles['preprocessor'].get('reserved_concurrency'),
+                report_batch_item_failures=True
+            ))
+            ingest_action = iot.CfnTopicRule.ActionProperty(
+                sqs=iot.CfnTopicRule.SqsActionProperty(
+                    queue_url=self.ingest_queue.queue_url,
+                    role_arn=iot_role.role_arn,
+                    use_base64=False
+                )
+            )
+        elif ingest_buffer == 'kinesis':
+            self.ingest_stream = kinesis.Stream(
+                self, 'IngestStream',
+                stream_mode=kinesis.StreamMode.ON_DEMAND
+            )
+            self.ingest_stream.grant_write(iot_role)
+            self.preprocessor_lambda.add_event_source(lambda_event_sources.KinesisEventSource(
+                self.ingest_stream,
+                starting_position=lambda_.StartingPosition.LATEST,
+                **self.batching('preprocessor', 'kinesis'),
+                bisect_batch_on_error=True,
+                retry_attempts=3,
+                report_batch_item_failures=True
+            ))
+            ingest_action = iot.CfnTopicRule.ActionProperty(
+                kinesis=iot.CfnTopicRule.KinesisActionProperty(
+                    stream_name=self.ingest_stream.stream_name,
+                    role_arn=iot_role.role_arn,
+                    partition_key='${topic()}'
+                )
+            )
+        else:
+            ingest_action = iot.CfnTopicRule.ActionProperty(
+                lambda_=iot.CfnTopicRule.LambdaActionProperty(
+                    function_arn=self.preprocessor_lambda.function_arn
+                )
+            )
+
         iot_topic_rule = iot.CfnTopicRule(
             self, 'IoTIngestRule',
             topic_rule_payload=iot.CfnTopicRule.TopicRulePayloadProperty(
                 sql="SELECT * FROM 'manufacturing/sensors/#'",
-                actions=[
-                    iot.CfnTopicRule.ActionProperty(
-                        lambda_=iot.CfnTopicRule.LambdaActionProperty(
-                            function_arn=self.preprocessor_lambda.function_arn
-                        )
-                    )
-                ]
+                actions=[ingest_action]
             )
         )
 
+        if ingest_buffer not in ('sqs', 'kinesis'):
+            self.preprocessor_lambda.add_permission(
+                'IoTIngestInvoke',
+                principal=iam.ServicePrincipal('iot.amazonaws.com'),
+                source_arn=iot_topic_rule.attr_arn
+            )
+
         # CloudWatch Alarms
         error_alarm = cloudwatch.Alarm(
             self, 'ErrorAlarm',
@@ -184,15 +380,55 @@ class IoTMLStack(Stack):
 
     def create_lambda(self, id: str, code_path: str, handler: str, 
                      environment: dict) -> lambda_.Function:
-        """Helper method to create Lambda functions with consistent settings"""
+        """Helper method to create Lambda functions with the settings of their profile
+
+        The profile is the entry of the profiles file named after the handler module.
+        """
+        profile = self.profiles[handler.partition('.')[0]]
+        # Share of invocations emitting EMF timing metrics (cdk -c metrics_sample_rate=0.1)
+        sample_rate = self.node.try_get_context('metrics_sample_rate') or 0
         return lambda_.Function(
             self, id,
             runtime=lambda_.Runtime.PYTHON_3_9,
+            architecture=ARCHITECTURES[profile['architecture']],
             handler=handler,
             code=lambda_.Code.from_asset(code_path),
-            environment=environment,
-            timeout=Duration.minutes(5),
-            memory_size=1024,
+            layers=[self.shared_layer(profile['architecture'])],
+            environment=dict({'METRICS_SAMPLE_RATE': str(sample_rate)}, **environment),
+            timeout=Duration.seconds(profile['timeout']),
+            memory_size=profile['memory_size'],
+            reserved_concurrent_executions=profile.get('reserved_concurrency'),
             tracing=lambda_.Tracing.ACTIVE,
             retry_attempts=2
-        )
\ No newline at end of file
+        )
+
+    def shared_layer(self, architecture: str) -> lambda_.LayerVersion:
+        """Layer with lambda/shared and the functions' dependencies, one per architecture
+
+        Layers unpack under /opt/python, which is on the path of every function,
+        so handlers import the package as shared.
+        """
+        if architecture not in self.layers:
+            self.layers[architecture] = lambda_.LayerVersion(
+                self, f"SharedLayer{architecture.replace('_', '').capitalize()}",
+                code=lambda_.Code.from_asset(
+                    'lambda/shared',
+                    exclude=['__pycache__'],
+                    bundling=BundlingOptions(
+                        image=lambda_.Runtime.PYTHON_3_9.bundling_image,
+                        command=['bash', '-c', LAYER_BUNDLING.format(
+                            platform='aarch64' if architecture == 'arm64' else 'x86_64')]
+                    )
+                ),
+                compatible_runtimes=[lambda_.Runtime.PYTHON_3_9],
+                compatible_architectures=[ARCHITECTURES[architecture]]
+            )
+        return self.layers[architecture]
+
+    def batching(self, function: str, source: str) -> dict:
+        """Batch size and batching window of a function's event source from its profile"""
+        settings = self.profiles[function]['event_sources'][source]
+        return {
+            'batch_size': settings['batch_size'],
+            'max_batching_window': Duration.seconds(settings['max_batching_window'])
+        }
\ No newline at end of file
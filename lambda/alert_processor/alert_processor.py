@@ -1,29 +1,85 @@
 import json
-import boto3
+import math
 import os
+import uuid
 from datetime import datetime
+from shared.device_state import DeviceStateStore, registry_thresholds
+from shared.metrics import Metrics, count, span
+from shared.schema import alert_item
+from shared.notifications import NotificationDispatcher
+from shared.utils import calculate_severity, generate_alert_message, get_dynamodb_table
+from suppression import AlertSuppressor, fingerprint
 
-sns = boto3.client('sns')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
+# Kept at module level so suppression state survives warm invocations
+suppressor = AlertSuppressor()
 
+# Per-device thresholds from the device registry, NaN where none are set
+SEVERITY_METRICS = ('temperature', 'vibration')
+device_states = DeviceStateStore.from_env({
+    f"{metric}_{level}": 'd'
+    for metric in SEVERITY_METRICS for level in ('warning', 'critical')
+})
+
+instrumentation = Metrics('alert_processor')
+
+@instrumentation.invocation
 def handler(event, context):
     """Process and distribute alerts"""
     try:
+        # The digest schedule sends one notification per coalesced burst
+        if event.get('detail-type') == 'Scheduled Event':
+            with span('Digest'):
+                suppressor.flush(force=True)
+                digests = suppressor.due_digests()
+                notifier = NotificationDispatcher()
+                for digest in digests:
+                    send_digest(digest, notifier)
+                # Undelivered digests stay pending for the next sweep
+                failed = set(notifier.flush())
+                suppressor.remove_digests([d for d in digests if d['timestamp'] not in failed])
+            count('Digests', len(digests) - len(failed))
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'digests': len(digests) - len(failed)})
+            }
+
         alert_data = event['detail']
-        
+
         # Process alert
         processed_alert = process_alert(alert_data)
-        
-        # Store alert
-        store_alert(processed_alert)
-        
-        # Send notifications
-        send_notifications(processed_alert)
-        
+
+        # Repeats inside the suppression window are only counted
+        with span('Evaluate'):
+            decision = suppressor.evaluate(processed_alert)
+        count(decision.action.capitalize())
+        if decision.action == 'escalate':
+            processed_alert['escalatedFrom'] = decision.previous_severity
+
+        if decision.action != 'suppress':
+            # The window is already claimed, so a retry would be suppressed;
+            # give it back when the alert is not both stored and published
+            stored = False
+            try:
+                with span('Store'):
+                    store_alert(processed_alert)
+                stored = True
+                notifier = NotificationDispatcher()
+                send_notifications(processed_alert, notifier)
+                with span('Publish'):
+                    if notifier.flush():
+                        raise RuntimeError(f"Error publishing alert {processed_alert['alertId']}")
+            except Exception:
+                if stored:
+                    delete_alert(processed_alert)
+                suppressor.release(processed_alert, decision)
+                raise
+
+        with span('Flush'):
+            suppressor.flush()
+
         return {
             'statusCode': 200,
-            'body': json.dumps('Alert processed successfully')
+            'body': json.dumps({'action': decision.action, 'alertId': decision.alert_id})
         }
     except Exception as e:
         print(f"Error processing alert: {str(e)}")
@@ -31,12 +87,83 @@ def handler(event, context):
 
 def process_alert(data):
     """Process alert data"""
+    now = datetime.utcnow()
+    severity = calculate_severity(data, device_limits(data.get('deviceId')))
+    alert_type = data.get('type', 'unknown')
     return {
-        'alertId': f"alert_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}",
-        'timestamp': datetime.utcnow().isoformat(),
+        'alertId': f"alert_{now.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex}",
+        'timestamp': now.isoformat(),
         'deviceId': data.get('deviceId'),
-        'type': data.get('type', 'unknown'),
-        'severity': calculate_severity(data),
+        'type': alert_type,
+        'severity': severity,
+        'fingerprint': fingerprint(data.get('deviceId'), alert_type, severity),
         'message': generate_alert_message(data),
         'status': 'new'
-    }
\ No newline at end of file
+    }
+
+def device_limits(device_id):
+    """Get registry thresholds of a device as {metric: (warning, critical)}"""
+    if not device_id:
+        return {}
+    slot = device_states.load([device_id], lambda _, item: {
+        f"{metric}_{level}": value
+        for metric, limits in registry_thresholds(item).items()
+        for level, value in zip(('warning', 'critical'), limits)
+    })[0]
+    limits = {}
+    for metric in SEVERITY_METRICS:
+        warning = device_states.column(f"{metric}_warning")[slot]
+        critical = device_states.column(f"{metric}_critical")[slot]
+        if not (math.isnan(warning) or math.isnan(critical)):
+            limits[metric] = (warning, critical)
+    return limits
+
+def store_alert(alert):
+    """Store an alert under its device, indexed as open"""
+    get_dynamodb_table().put_item(Item=alert_item(alert))
+
+def delete_alert(alert):
+    """Remove an alert that could not be published, so a retry stores it once"""
+    item = alert_item(alert)
+    try:
+        get_dynamodb_table().delete_item(
+            Key={'deviceId': item['deviceId'], 'timestamp': item['timestamp']})
+    except Exception as e:
+        print(f"Error removing undelivered alert {alert['alertId']}: {str(e)}")
+
+def send_notifications(alert, notifier):
+    """Queue an alert for the alert topic"""
+    subject = f"[{alert['severity'].upper()}] {alert['type']} alert for {alert['deviceId']}"
+    if alert.get('escalatedFrom'):
+        subject += f" (escalated from {alert['escalatedFrom']})"
+    publish(notifier, alert, subject, alert['alertId'])
+
+def send_digest(digest, notifier):
+    """Publish one summary for the repeats suppressed during a window"""
+    suppressed = int(digest.get('suppressed', 0))
+    if suppressed == 0:
+        return
+    publish(notifier, {
+        'type': digest['alertType'],
+        'deviceId': digest['alertDeviceId'],
+        'severity': digest['severity'],
+        'alertId': digest['alertId'],
+        'suppressed': suppressed,
+        'message': f"{suppressed} repeated {digest['severity']} {digest['alertType']} alert(s) "
+                   f"for {digest['alertDeviceId']} were suppressed after {digest['alertId']}"
+    }, f"[DIGEST] {suppressed} suppressed {digest['alertType']} alerts for {digest['alertDeviceId']}",
+        digest['timestamp'])
+
+def publish(notifier, message, subject, record_id):
+    """Queue a message with the attributes subscriptions filter on"""
+    notifier.publish(
+        os.environ['ALERT_TOPIC'],
+        message,
+        attributes={
+            'severity': message['severity'],
+            'type': message['type'],
+            'deviceId': message['deviceId']
+        },
+        subject=subject,
+        record_id=record_id
+    )
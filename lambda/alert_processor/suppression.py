@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+
+from shared.cache import TTLCache
+from shared.utils import get_dynamodb_table, logger
+
+SEVERITY_RANK = {'info': 0, 'warning': 1, 'critical': 2}
+
+# One state item per device and alert type holds the open suppression window
+STATE_PREFIX = 'alertstate#'
+# Suppressed counts wait for the digest sweep in a single partition, sorted
+# by the end of their window
+DIGEST_PARTITION = 'alertdigest#pending'
+
+# Seconds after an alert during which repeats are suppressed, per severity
+SUPPRESSION_WINDOWS = dict({
+    'critical': 300,
+    'warning': 900,
+    'info': 3600
+}, **json.loads(os.environ.get('ALERT_SUPPRESSION_WINDOWS') or '{}'))
+
+# Seconds suppressed counts are held in memory before being added to the table
+COUNT_FLUSH_SECONDS = int(os.environ.get('ALERT_COUNT_FLUSH_SECONDS', '30'))
+
+# previous is the state item a claim replaced, None when there was none
+Decision = namedtuple('Decision', ['action', 'alert_id', 'previous_severity', 'previous'],
+                      defaults=(None,))
+
+def fingerprint(device_id, alert_type, severity):
+    """Identify repeats of the same alert"""
+    raw = f"{device_id}\0{alert_type}\0{severity}".encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+def state_key(device_id, alert_type):
+    return {'deviceId': f"{STATE_PREFIX}{device_id}", 'timestamp': alert_type}
+
+def digest_key(state):
+    window_end = datetime.fromtimestamp(int(state['windowEnd']), timezone.utc)
+    return {
+        'deviceId': DIGEST_PARTITION,
+        'timestamp': f"{window_end.strftime('%Y-%m-%dT%H:%M:%S')}#{state['alertId']}"
+    }
+
+class AlertSuppressor:
+    """Decide whether an alert is new, an escalation or a suppressed repeat
+
+    The first alert for a device and type opens a window (its length set by
+    severity) during which repeats of the same or a lower severity are only
+    counted; a higher severity escalates and restarts the window. Windows are
+    claimed with conditional writes so concurrent containers agree on a
+    single notification. State is cached between warm invocations and
+    suppressed counts are added to the table at most every flush_seconds, so
+    a storm costs neither a read nor a write per event. Counts still held by
+    a container that is shut down are lost, making digests a lower bound.
+    """
+
+    def __init__(self, table=None, windows=None, flush_seconds=COUNT_FLUSH_SECONDS,
+                 max_attempts=3, clock=time.time):
+        self.table = table
+        self.windows = windows or SUPPRESSION_WINDOWS
+        self.flush_seconds = flush_seconds
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self._states = TTLCache(max_size=4096, ttl=max(self.windows.values()), clock=clock)
+        self._counts = {}
+
+    def evaluate(self, alert):
+        """Classify an alert as 'new', 'escalate' or 'suppress'"""
+        self.table = self.table or get_dynamodb_table()
+        key = state_key(alert['deviceId'], alert['type'])
+        cache_key = (key['deviceId'], key['timestamp'])
+        now = self.clock()
+
+        state = self._states.get(cache_key)
+        if state is None or state['windowEnd'] <= now:
+            state = self._load(key)
+
+        for _ in range(self.max_attempts):
+            if state is None or state['windowEnd'] <= now:
+                action = 'new'
+            elif SEVERITY_RANK[alert['severity']] > int(state['rank']):
+                action = 'escalate'
+            else:
+                self._count(state, now)
+                return Decision('suppress', state['alertId'], state['severity'])
+
+            claimed = self._claim(key, alert, state, now)
+            if claimed is not None:
+                self._states.set(cache_key, claimed)
+                return Decision(action, alert['alertId'],
+                                state['severity'] if action == 'escalate' else None, state)
+            # Another container claimed the window first
+            state = self._load(key)
+
+        logger.warning(f"Suppressing {alert['alertId']} after {self.max_attempts} "
+                       f"contended attempts")
+        return Decision('suppress', state['alertId'] if state else None,
+                        state['severity'] if state else None)
+
+    def release(self, alert, decision):
+        """Give back the window claimed for an alert that was not delivered
+
+        The state the claim replaced is restored, or the claim deleted, unless
+        another container has claimed the window since; a retry of the alert
+        is then evaluated as the first attempt was.
+        """
+        self.table = self.table or get_dynamodb_table()
+        key = state_key(alert['deviceId'], alert['type'])
+        self._states.pop((key['deviceId'], key['timestamp']))
+        condition = Attr('alertId').eq(alert['alertId'])
+        try:
+            if decision.previous is None:
+                self.table.delete_item(Key=key, ConditionExpression=condition)
+            else:
+                self.table.put_item(Item=decision.previous, ConditionExpression=condition)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                logger.error(f"Error releasing the window of {alert['alertId']}: {str(e)}")
+
+    def flush(self, force=False):
+        """Add suppressed counts older than flush_seconds to their digests"""
+        now = self.clock()
+        for key, (count, since, state) in list(self._counts.items()):
+            if not force and now - since < self.flush_seconds and state['windowEnd'] > now:
+                continue
+            del self._counts[key]
+            try:
+                self.table.update_item(
+                    Key=dict(zip(('deviceId', 'timestamp'), key)),
+                    UpdateExpression='ADD suppressed :n SET alertDeviceId = :d, '
+                                     'alertType = :t, severity = :s, alertId = :a',
+                    ExpressionAttributeValues={
+                        ':n': count,
+                        ':d': state['alertDeviceId'],
+                        ':t': state['alertType'],
+                        ':s': state['severity'],
+                        ':a': state['alertId']
+                    }
+                )
+            except Exception as e:
+                logger.error(f"Error recording {count} suppressed alert(s): {str(e)}")
+
+    def due_digests(self, grace=None):
+        """Return digest items whose window ended, leaving time for late counts"""
+        self.table = self.table or get_dynamodb_table()
+        grace = self.flush_seconds if grace is None else grace
+        cutoff = datetime.fromtimestamp(self.clock() - grace, timezone.utc)
+        query = {
+            'KeyConditionExpression': Key('deviceId').eq(DIGEST_PARTITION) &
+            Key('timestamp').lt(cutoff.strftime('%Y-%m-%dT%H:%M:%S'))
+        }
+        items = []
+        while True:
+            response = self.table.query(**query)
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return items
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def remove_digests(self, items):
+        """Delete digest items once their notification went out"""
+        with self.table.batch_writer() as batch:
+            for item in items:
+                batch.delete_item(Key={'deviceId': item['deviceId'],
+                                       'timestamp': item['timestamp']})
+
+    def _load(self, key):
+        item = self.table.get_item(Key=key, ConsistentRead=True).get('Item')
+        if item is not None:
+            item['windowEnd'] = int(item['windowEnd'])
+            self._states.set((key['deviceId'], key['timestamp']), item)
+        return item
+
+    def _claim(self, key, alert, state, now):
+        window_end = int(now + self.windows.get(alert['severity'], 0))
+        claimed = dict(key, **{
+            'alertType': alert['type'],
+            'alertDeviceId': alert['deviceId'],
+            'severity': alert['severity'],
+            'rank': SEVERITY_RANK[alert['severity']],
+            'alertId': alert['alertId'],
+            'fingerprint': alert['fingerprint'],
+            'windowEnd': window_end,
+            'ttl': window_end + 86400
+        })
+        if state is None:
+            condition = Attr('deviceId').not_exists()
+        elif state['windowEnd'] <= now:
+            condition = Attr('alertId').eq(state['alertId'])
+        else:
+            condition = Attr('alertId').eq(state['alertId']) & \
+                Attr('rank').lt(claimed['rank'])
+        try:
+            self.table.put_item(Item=claimed, ConditionExpression=condition)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return None
+        return claimed
+
+    def _count(self, state, now):
+        key = tuple(digest_key(state).values())
+        count, since, _ = self._counts.get(key, (0, now, None))
+        self._counts[key] = (count + 1, since, state)
+        self.flush()
@@ -1,18 +1,65 @@
 import json
-import boto3
+import base64
+import hashlib
+import heapq
+import re
 import os
-from datetime import datetime, timedelta
-from boto3.dynamodb.conditions import Key
+from datetime import datetime, timedelta, timezone
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from shared import clients
+from shared.cache import TTLCache
+from shared.codec import dumps, loads
+from shared.metrics import Metrics, count, span
+from shared.rollups import (
+    RESOLUTIONS, ROLLUP_PREFIX, Bucket, bucket_start, decode_metrics, format_start,
+    parse_timestamp, plan_range
+)
+from shared.schema import (
+    ALERT_PREFIX, ALERT_STATUSES, DEVICE_ALERTS_INDEX, DEVICE_ENTITY, DEVICE_INDEX, INDEXES,
+    OPEN_ALERT_ATTRIBUTES, OPEN_ALERTS_INDEX, OPEN_STATUSES, REGISTRY_SORT_KEY, SEVERITIES,
+    alert_time, decode_reading, epoch_millis, reading_days, reading_partition,
+    write_shards
+)
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
+# Page size bounds for the limit query parameter
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '500'))
 
+# Longest range of raw readings one request may page through
+MAX_RAW_DAYS = int(os.environ.get('MAX_RAW_DAYS', '31'))
+
+FIELD_NAME = re.compile(r'^[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*$')
+
+# Query parameters that shape a page rather than select what is paged through
+PAGE_PARAMS = ('limit', 'nextToken', 'fields')
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+# Seconds a successful response is served from the in-process cache, per route
+ROUTE_TTLS = dict({
+    '/devices': 30,
+    '/alerts': 5,
+    '/analysis': 15,
+    '/metrics': 10
+}, **json.loads(os.environ.get('API_CACHE_TTLS') or '{}'))
+
+response_cache = TTLCache(max_size=int(os.environ.get('API_CACHE_SIZE', '512')))
+
+# Reading shard counts from device registration items
+shard_cache = TTLCache(max_size=int(os.environ.get('API_CACHE_SIZE', '512')), ttl=300)
+
+instrumentation = Metrics('api')
+
+@instrumentation.invocation
 def handler(event, context):
     """Handle API requests"""
     try:
         http_method = event['httpMethod']
         path = event.get('path', '/')
-        query_params = event.get('queryStringParameters', {})
+        query_params = event.get('queryStringParameters') or {}
         
         routes = {
             'GET': {
@@ -20,40 +67,563 @@ def handler(event, context):
                 '/alerts': get_alerts,
                 '/analysis': get_analysis,
                 '/metrics': get_metrics
+            },
+            'POST': {
+                '/alerts': update_alert
             }
         }
         
         # Route the request
-        if http_method in routes and path in routes[http_method]:
-            response = routes[http_method][path](query_params)
+        if http_method == 'GET' and path in routes['GET']:
+            response = cached_response(path, query_params, routes['GET'][path])
+            response = conditional_response(response, request_header(event, 'If-None-Match'))
+        elif http_method in routes and path in routes[http_method]:
+            response = write_response(event, path, routes[http_method][path])
         else:
             response = {
                 'statusCode': 404,
-                'body': json.dumps('Not Found')
+                'body': dumps('Not Found')
             }
         
         # Add CORS headers
-        response['headers'] = {
+        response['headers'] = dict(response.get('headers', {}), **{
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'GET,POST,OPTIONS',
             'Access-Control-Allow-Headers': 'Content-Type'
-        }
+        })
         
         return response
     except Exception as e:
         return {
             'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
+            'body': dumps({'error': str(e)})
+        }
+
+def cached_response(path, params, route):
+    """Serve a route from the response cache, calling it on a miss"""
+    key = (path, tuple(sorted(params.items())))
+    cached = response_cache.get(key)
+    if cached is not None:
+        count('CacheHits')
+        return dict(cached, headers=dict(cached['headers'], **{'X-Cache': 'Hit'}))
+    
+    count('CacheMisses')
+    try:
+        with span('Query'):
+            response = route(params)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': dumps({'error': str(e)})
+        }
+    
+    if response['statusCode'] == 200:
+        ttl = ROUTE_TTLS.get(path, 0)
+        response['headers'] = dict(response.get('headers', {}), **{
+            'ETag': compute_etag(response['body']),
+            'Cache-Control': f"max-age={ttl}"
+        })
+        if ttl > 0:
+            response_cache.set(key, response, ttl=ttl)
+    
+    return dict(response, headers=dict(response.get('headers', {}), **{'X-Cache': 'Miss'}))
+
+def write_response(event, path, route):
+    """Call a route that changes data with the JSON request body
+
+    Cached responses of the same path are dropped after a successful write,
+    so this container serves the change immediately; other containers serve
+    their cached responses until the route TTL expires.
+    """
+    try:
+        body = loads(event.get('body') or '{}')
+        if not isinstance(body, dict):
+            raise ValueError('Request body must be a JSON object')
+        response = route(body)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': dumps({'error': str(e)})
+        }
+    
+    if 200 <= response['statusCode'] < 300:
+        for key in response_cache.keys():
+            if key[0] == path:
+                response_cache.pop(key)
+    return response
+
+def conditional_response(response, if_none_match):
+    """Turn a response into a 304 when the client already has its ETag"""
+    etag = response.get('headers', {}).get('ETag')
+    if etag is None or not if_none_match:
+        return response
+    
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    if '*' in candidates or etag in candidates or f"W/{etag}" in candidates:
+        return {
+            'statusCode': 304,
+            'headers': {k: v for k, v in response['headers'].items()
+                        if k in ('ETag', 'Cache-Control', 'X-Cache')},
+            'body': ''
         }
+    return response
+
+def compute_etag(body):
+    """Compute a strong ETag for a response body"""
+    return '"' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:32] + '"'
+
+def request_header(event, name):
+    """Get a request header case-insensitively"""
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
 
 def get_devices(params):
     """Get device list and status"""
-    response = table.query(
-        IndexName='device-index',
-        KeyConditionExpression=Key('type').eq('device')
+    return paginated_query(
+        params, '/devices',
+        IndexName=DEVICE_INDEX,
+        KeyConditionExpression=Key('entity').eq(DEVICE_ENTITY)
     )
+
+def get_alerts(params):
+    """Get alerts filtered by device, severity, status and time range
+
+    Filters: deviceId, severity and status (comma-separated lists; status
+    also accepts 'open' and 'all'), and from/to (ISO 8601, [from, to) on
+    the time an alert was raised). Alerts come oldest first, newest first
+    with order=desc, paginated with limit and nextToken; count=true returns
+    only the number of matching alerts.
+
+    Open alerts are read from the sparse open alert indexes, so their cost
+    does not depend on how many closed alerts exist. Other statuses need a
+    deviceId and are read from the device's alert history between from and
+    to. The status defaults to 'all' with a deviceId and 'open' without.
+    """
+    device_id = params.get('deviceId')
+    severities = choices(params, 'severity', SEVERITIES)
+    status = params.get('status') or ('all' if device_id else 'open')
+    statuses = OPEN_STATUSES if status == 'open' else \
+        ALERT_STATUSES if status == 'all' else choices(params, 'status', ALERT_STATUSES)
+    
+    try:
+        start = parse_timestamp(params['from']) if params.get('from') else None
+        end = parse_timestamp(params['to']) if params.get('to') else None
+    except ValueError:
+        raise ValueError('from and to must be ISO 8601 timestamps')
+    lower = alert_time(start) if start else ''
+    # '~' sorts after every character of a timestamp and alert id
+    upper = alert_time(end) if end else '~'
+    
+    open_only = set(statuses) <= set(OPEN_STATUSES)
+    filter_severity = bool(severities) and set(severities) != set(SEVERITIES)
+    filter_status = set(statuses) != set(OPEN_STATUSES if open_only else ALERT_STATUSES)
+    
+    if open_only and device_id:
+        queries = {'device': {
+            'IndexName': DEVICE_ALERTS_INDEX,
+            'KeyConditionExpression': Key('openDeviceId').eq(device_id) &
+            Key('openedAt').between(lower, upper)
+        }}
+        sort_key = 'openedAt'
+    elif open_only:
+        # Severity is the partition key, so choosing partitions filters by it
+        queries = {severity: {
+            'IndexName': OPEN_ALERTS_INDEX,
+            'KeyConditionExpression': Key('openSeverity').eq(severity) &
+            Key('openedAt').between(lower, upper)
+        } for severity in severities or SEVERITIES}
+        sort_key = 'openedAt'
+        filter_severity = False
+    elif device_id:
+        queries = {'history': {
+            'KeyConditionExpression': Key('deviceId').eq(device_id) &
+            Key('timestamp').between(ALERT_PREFIX + lower, ALERT_PREFIX + upper)
+        }}
+        sort_key = 'timestamp'
+    else:
+        raise ValueError('deviceId is required unless status is open')
+    
+    filters = []
+    if filter_severity:
+        filters.append(Attr('severity').is_in(list(severities)))
+    if filter_status:
+        filters.append(Attr('status').is_in(list(statuses)))
+    if filters:
+        for query in queries.values():
+            query['FilterExpression'] = filters[0] & filters[1] if len(filters) > 1 \
+                else filters[0]
+    
+    if params.get('count') == 'true':
+        return {
+            'statusCode': 200,
+            'body': dumps({'count': sum(map(count_query, queries.values()))})
+        }
     
+    descending = params.get('order') == 'desc'
+    if descending:
+        for query in queries.values():
+            query['ScanIndexForward'] = False
+    scope = cursor_scope('/alerts', params)
+    cursor = decode_token(params['nextToken'], scope) if params.get('nextToken') else {}
+    if set(cursor) - set(queries):
+        raise ValueError('Invalid nextToken')
+    index = next(iter(queries.values())).get('IndexName')
+    items, after = merged_page(queries, page_size(params), cursor, sort_key,
+                               ('deviceId', 'timestamp') + INDEXES.get(index, ()),
+                               descending)
+    body = {
+        'items': [{k: v for k, v in item.items() if k not in OPEN_ALERT_ATTRIBUTES}
+                  for item in items],
+        'count': len(items)
+    }
+    if any(key is not None for key in after.values()):
+        body['nextToken'] = encode_token(after, scope)
     return {
         'statusCode': 200,
-        'body': json.dumps(response['Items'])
+        'body': dumps(body)
     }
+
+def update_alert(body):
+    """Change the status of an alert
+
+    The body names the alert by deviceId and timestamp, as listed by GET
+    /alerts, and gives the new status. Alerts leave the open alert indexes
+    when their status is no longer open and return when it is reopened.
+    """
+    device_id, timestamp, status = (body.get(name) for name in ('deviceId', 'timestamp', 'status'))
+    if not device_id or not isinstance(timestamp, str) or not timestamp.startswith(ALERT_PREFIX):
+        raise ValueError('deviceId and the timestamp of an alert are required')
+    if status not in ALERT_STATUSES:
+        raise ValueError(f"status must be one of: {', '.join(ALERT_STATUSES)}")
+    
+    key = {'deviceId': device_id, 'timestamp': timestamp}
+    values = {':s': status, ':t': datetime.utcnow().isoformat()}
+    if status in OPEN_STATUSES:
+        # The same attributes as schema.open_alert_attributes sets
+        expression = 'SET #s = :s, statusChangedAt = :t, openSeverity = severity, ' \
+                     'openDeviceId = deviceId, openedAt = :o'
+        values[':o'] = timestamp[len(ALERT_PREFIX):]
+    else:
+        expression = 'SET #s = :s, statusChangedAt = :t REMOVE ' + \
+            ', '.join(OPEN_ALERT_ATTRIBUTES)
+    try:
+        clients.table().update_item(
+            Key=key,
+            UpdateExpression=expression,
+            ExpressionAttributeNames={'#s': 'status'},
+            ExpressionAttributeValues=values,
+            ConditionExpression=Attr('deviceId').exists()
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return {
+            'statusCode': 404,
+            'body': dumps({'error': 'Alert not found'})
+        }
+    return {
+        'statusCode': 200,
+        'body': dumps(dict(key, status=status))
+    }
+
+def choices(params, name, allowed):
+    """Parse a comma-separated parameter restricted to allowed values"""
+    values = [v.strip() for v in (params.get(name) or '').split(',') if v.strip()]
+    invalid = [v for v in values if v not in allowed]
+    if invalid:
+        raise ValueError(f"{name} must be among: {', '.join(allowed)}")
+    return tuple(dict.fromkeys(values))
+
+def get_analysis(params):
+    """Get image analysis results for a camera"""
+    return paginated_query(
+        params, '/analysis',
+        KeyConditionExpression=Key('deviceId').eq(require(params, 'deviceId')) &
+        Key('timestamp').begins_with('analysis#')
+    )
+
+def get_metrics(params):
+    """Get metric summaries for a device within a time range
+
+    The summary for [from, to) (default: the last 24 hours) is merged from
+    the fewest pre-aggregated 1m/1h/1d rollup buckets that cover the range;
+    buckets are rebuilt every minute from ingest marks, so they trail the
+    raw readings by a minute or two.
+    With resolution=1m|1h|1d a page of per-bucket series is included;
+    resolution=raw pages through the raw readings instead.
+    """
+    device_id = require(params, 'deviceId')
+    
+    try:
+        end = parse_timestamp(params['to']) if params.get('to') else datetime.now(timezone.utc)
+        start = parse_timestamp(params['from']) if params.get('from') else end - timedelta(days=1)
+    except ValueError:
+        raise ValueError('from and to must be ISO 8601 timestamps')
+    
+    if params.get('resolution') == 'raw':
+        return {
+            'statusCode': 200,
+            'body': dumps(query_readings(params, device_id, start, end))
+        }
+    
+    summary = {}
+    for resolution, first, last in plan_range(start, end):
+        for item in query_all(
+            KeyConditionExpression=Key('deviceId').eq(f"{ROLLUP_PREFIX}{resolution}#{device_id}") &
+            Key('timestamp').between(format_start(first), format_start(last))
+        ):
+            for metric, bucket in decode_metrics(item).items():
+                summary.setdefault(metric, Bucket()).merge(bucket)
+    
+    body = {
+        'deviceId': device_id,
+        'from': format_start(start),
+        'to': format_start(end),
+        'summary': {metric: bucket.summary() for metric, bucket in summary.items()}
+    }
+    
+    resolution = params.get('resolution')
+    if resolution:
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"resolution must be one of: raw, {', '.join(RESOLUTIONS)}")
+        page = query_page(
+            params, '/metrics',
+            KeyConditionExpression=Key('deviceId').eq(f"{ROLLUP_PREFIX}{resolution}#{device_id}") &
+            Key('timestamp').between(format_start(bucket_start(start, resolution)),
+                                     format_start(end))
+        )
+        body['series'] = [
+            dict({'start': item['timestamp']},
+                 **{metric: bucket.summary() for metric, bucket in decode_metrics(item).items()})
+            for item in page['items']
+        ]
+        if 'nextToken' in page:
+            body['nextToken'] = page['nextToken']
+    
+    return {
+        'statusCode': 200,
+        'body': dumps(body)
+    }
+
+def query_readings(params, device_id, start, end):
+    """Run one page of a device's raw readings in [start, end], oldest first
+
+    Readings live in one partition per day and write shard. The shards of a
+    day are queried together and merged by timestamp; the cursor records
+    the day and, per shard, the last reading returned from it.
+    """
+    days = reading_days(start, end)
+    if len(days) > MAX_RAW_DAYS:
+        raise ValueError(f"Raw readings are limited to {MAX_RAW_DAYS} days per request")
+    limit = page_size(params)
+    shards = device_shards(device_id)
+    lower, upper = f"{epoch_millis(start):013d}", f"{epoch_millis(end):013d}"
+    
+    scope = cursor_scope('/metrics', params)
+    cursor = decode_token(params['nextToken'], scope) if params.get('nextToken') else {}
+    if cursor:
+        if cursor.get('day') not in days:
+            raise ValueError('Invalid nextToken')
+        days = days[days.index(cursor['day']):]
+    
+    projection = {}
+    if params.get('fields'):
+        expression, names = projection_expression(params['fields'] + ',deviceId,timestamp')
+        projection = {'ProjectionExpression': expression, 'ExpressionAttributeNames': names}
+    
+    items = []
+    for day in days:
+        after = cursor.get('after', {}) if day == cursor.get('day') else {}
+        queries = {str(shard): dict(
+            projection,
+            KeyConditionExpression=Key('deviceId').eq(reading_partition(device_id, day, shard)) &
+            Key('timestamp').between(lower, upper)
+        ) for shard in range(shards)}
+        taken, after = merged_page(queries, limit - len(items), after, 'timestamp',
+                                   ('deviceId', 'timestamp'))
+        items.extend(taken)
+        
+        if any(key is not None for key in after.values()):
+            return page_body(items, {'day': day, 'after': after}, scope)
+        if len(items) >= limit:
+            following = days.index(day) + 1
+            return page_body(items, {'day': days[following], 'after': {}}
+                             if following < len(days) else None, scope)
+    return page_body(items, None, scope)
+
+def merged_page(queries, limit, after, sort_key, key_names, descending=False):
+    """Read up to limit items from several partitions, merged by sort_key
+
+    queries maps a stream name to the query of one partition. after maps
+    stream names to the key to resume each one after ({} to start from the
+    beginning), or None once it is exhausted; the returned after does the
+    same for the next page, so the last page has only None values. Streams
+    whose items were all filtered out resume from their LastEvaluatedKey.
+    """
+    streams, ends = [], {}
+    for name, query in queries.items():
+        if name in after and after[name] is None:
+            continue
+        query = dict(query, Limit=limit)
+        if after.get(name):
+            query['ExclusiveStartKey'] = after[name]
+        response = clients.table().query(**query)
+        ends[name] = response.get('LastEvaluatedKey')
+        streams.append([(item[sort_key], name, item) for item in response['Items']])
+    
+    merged = list(heapq.merge(*streams, key=lambda entry: entry[0], reverse=descending))
+    # A filtered stream may stop short of limit items; nothing past where
+    # any stream stopped reading can be returned yet
+    stops = [end[sort_key] for end in ends.values() if end is not None]
+    if stops:
+        stop = max(stops) if descending else min(stops)
+        limit = min(limit, sum(1 for key, _, _ in merged
+                               if (key >= stop if descending else key <= stop)))
+    taken = merged[:limit]
+    last = {name: item for _, name, item in taken}
+    following = dict(after, **ends)
+    # Streams with items left over resume after the last one returned
+    for _, name, _ in merged[limit:]:
+        following[name] = {k: last[name][k] for k in key_names} if name in last \
+            else after.get(name, {})
+    return [item for _, _, item in taken], following
+
+def page_body(items, cursor, scope):
+    """Build a page of readings with the cursor of the next page"""
+    body = {
+        'items': [decode_reading(item) for item in items],
+        'count': len(items)
+    }
+    if cursor is not None:
+        body['nextToken'] = encode_token(cursor, scope)
+    return body
+
+def device_shards(device_id):
+    """Get how many write shards hold a device's readings per day"""
+    shards = shard_cache.get(device_id)
+    if shards is None:
+        item = clients.table().get_item(
+            Key={'deviceId': device_id, 'timestamp': REGISTRY_SORT_KEY}
+        ).get('Item')
+        shards = write_shards(item)
+        shard_cache.set(device_id, shards)
+    return shards
+
+def require(params, name):
+    """Get a mandatory query parameter"""
+    value = params.get(name)
+    if not value:
+        raise ValueError(f"Missing required parameter: {name}")
+    return value
+
+def paginated_query(params, route, **query):
+    """Run one page of a table query and return it as an API response"""
+    return {
+        'statusCode': 200,
+        'body': dumps(query_page(params, route, **query))
+    }
+
+def query_page(params, route, **query):
+    """Run one page of a table query
+
+    Supports limit (page size), fields (comma-separated attribute names,
+    turned into a ProjectionExpression) and nextToken (the opaque cursor
+    returned with the previous page of the same route and parameters).
+    Only one page is read per request.
+    """
+    query['Limit'] = page_size(params)
+    scope = cursor_scope(route, params)
+    
+    if params.get('nextToken'):
+        query['ExclusiveStartKey'] = decode_token(params['nextToken'], scope)
+    
+    if params.get('fields'):
+        projection, names = projection_expression(params['fields'])
+        query['ProjectionExpression'] = projection
+        query['ExpressionAttributeNames'] = names
+    
+    response = clients.table().query(**query)
+    
+    body = {
+        'items': response['Items'],
+        'count': response['Count']
+    }
+    if 'LastEvaluatedKey' in response:
+        body['nextToken'] = encode_token(response['LastEvaluatedKey'], scope)
+    
+    return body
+
+def query_all(**query):
+    """Yield every item of a query, following LastEvaluatedKey lazily"""
+    while True:
+        response = clients.table().query(**query)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def count_query(query):
+    """Count the items matching a query without reading them"""
+    query = dict(query, Select='COUNT')
+    total = 0
+    while True:
+        response = clients.table().query(**query)
+        total += response['Count']
+        if 'LastEvaluatedKey' not in response:
+            return total
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def page_size(params):
+    """Parse and clamp the limit query parameter"""
+    try:
+        limit = int(params.get('limit', DEFAULT_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise ValueError('limit must be an integer')
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def projection_expression(fields):
+    """Turn 'a,b.c' into a ProjectionExpression with attribute name placeholders"""
+    names = {}
+    paths = []
+    for field in dict.fromkeys(f.strip() for f in fields.split(',') if f.strip()):
+        if not FIELD_NAME.match(field):
+            raise ValueError(f"Invalid field: {field}")
+        parts = []
+        for part in field.split('.'):
+            placeholder = f"#f{len(names)}"
+            names[placeholder] = part
+            parts.append(placeholder)
+        paths.append('.'.join(parts))
+    return ', '.join(paths), names
+
+def cursor_scope(route, params):
+    """Identify the query a cursor pages through, by route and selecting parameters"""
+    selection = sorted((k, v) for k, v in params.items() if k not in PAGE_PARAMS)
+    raw = json.dumps([route, selection], separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()[:16]
+
+def encode_token(last_evaluated_key, scope):
+    """Encode a LastEvaluatedKey as an opaque URL-safe cursor for one query scope"""
+    key = {k: serializer.serialize(v) for k, v in last_evaluated_key.items()}
+    raw = json.dumps({'s': scope, 'k': key}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_token(token, scope):
+    """Decode a cursor produced by encode_token for the same scope
+
+    A cursor of another route or parameters would make the table query
+    fail, so it is rejected as invalid input instead.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        cursor = json.loads(raw)
+        valid = cursor['s'] == scope
+        key = {k: deserializer.deserialize(v) for k, v in cursor['k'].items()}
+    except Exception:
+        raise ValueError('Invalid nextToken')
+    if not valid:
+        raise ValueError('nextToken belongs to a different query')
+    return key
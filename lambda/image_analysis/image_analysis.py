@@ -1,50 +1,234 @@
 import json
-import boto3
 import os
 from datetime import datetime
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from phash import RecentHashes, dhash, dhash_image, hamming
+from preprocess import FramePreprocessor
+from shared import clients
+from shared.batch import BatchProcessor, record_id
+from shared.codec import to_decimal
+from shared.metrics import Metrics, count, span, timed
+from shared.notifications import NotificationDispatcher
+from shared.utils import BufferedWriter
 
-rekognition = boto3.client('rekognition')
-s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
 
+# Bounded worker pool for S3 downloads and Rekognition calls
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '4'))
+
+# Rekognition accepts at most 5 MB of inline image bytes
+MAX_INLINE_BYTES = 5 * 1024 * 1024
+
+# Frames within PHASH_MAX_DISTANCE bits of a recent frame from the same
+# camera reuse its analysis instead of calling Rekognition again
+recent_hashes = RecentHashes(
+    per_camera=int(os.environ.get('PHASH_CACHE_SIZE', '16')),
+    max_cameras=int(os.environ.get('PHASH_MAX_CAMERAS', '1000')),
+    max_distance=int(os.environ.get('PHASH_MAX_DISTANCE', '4')),
+    ttl=int(os.environ.get('PHASH_TTL_SECONDS', '300'))
+)
+
+# Optional crop/downscale/static-frame stage, enabled by IMAGE_PREPROCESS
+preprocessor = FramePreprocessor.from_env()
+
+# Labels that count as defects when detected with enough confidence
+DEFECT_LABELS = set(os.environ.get(
+    'DEFECT_LABELS', 'Crack,Scratch,Dent,Rust,Corrosion,Damage'
+).split(','))
+DEFECT_MIN_CONFIDENCE = float(os.environ.get('DEFECT_MIN_CONFIDENCE', '80'))
+
+instrumentation = Metrics('image_analysis')
+
+@instrumentation.invocation
 def handler(event, context):
     """Process images from IoT devices"""
     try:
-        records = event['Records']
+        batch = BatchProcessor(event['Records'])
+        writer = BufferedWriter()
+        notifier = NotificationDispatcher()
+        count('Records', len(event['Records']))
+        
+        # Skip images completed by an earlier attempt of this batch
+        for record, analysis, error in analyze_batch(batch.pending()):
+            try:
+                if error is not None:
+                    raise error
+                
+                # Store results
+                store_analysis_results(analysis, writer, record_id=record_id(record))
+                
+                # Check for defects
+                if has_defects(analysis):
+                    trigger_defect_alert(analysis, notifier, record_id=record_id(record))
+            except Exception as e:
+                print(f"Error analyzing {record_id(record)}: {str(e)}")
+                batch.fail(record_id(record), e)
+        
+        # Publish defect alerts of the images that were analyzed
+        notifier.discard(batch.failed)
+        with span('Publish'):
+            for rid in notifier.flush():
+                batch.fail(rid, 'notification failed')
+        
+        with span('Store'):
+            response = batch.finish(writer)
+        
+        return dict(response, statusCode=200, body=json.dumps(batch.summary()))
+    except Exception as e:
+        print(f"Error analyzing image: {str(e)}")
+        raise
+
+def analyze_batch(records):
+    """Analyze a batch of S3 images, calling Rekognition once per distinct frame
+
+    Images are downloaded, optionally cropped and downscaled, and hashed on a
+    worker pool. Frames that barely differ from the camera's last analyzed
+    frame, or are close to a recent frame from the same camera or an earlier
+    frame in this batch, reuse that analysis; the remaining frames go to
+    Rekognition concurrently. Yields (record, analysis, error) in record order.
+    """
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as executor:
+        frames = list(executor.map(load_frame, records))
         
-        for record in records:
-            # Get image from S3
-            bucket = record['s3']['bucket']['name']
-            key = record['s3']['object']['key']
+        # Decide which frames need their own analysis
+        sources = []
+        batch_hashes = {}
+        previous = {}
+        for i, frame in enumerate(frames):
+            if frame['error'] is not None:
+                sources.append(None)
+                continue
+            camera, value = frame['camera'], frame['hash']
+            source = None
             
-            # Analyze image
-            analysis = analyze_image(bucket, key)
+            thumbnail = frame['thumbnail']
+            if thumbnail is not None:
+                last = previous.get(camera) or preprocessor.last_frame(camera)
+                if last is not None and preprocessor.is_static(last[0], thumbnail):
+                    source = last[1]
             
-            # Store results
-            store_analysis_results(analysis)
+            if source is None and value is not None:
+                cached = recent_hashes.find(camera, value)
+                if cached is not None:
+                    source = ('cached', cached)
+                else:
+                    earlier = next((j for other, j in batch_hashes.get(camera, [])
+                                    if hamming(value, other) <= recent_hashes.max_distance), None)
+                    if earlier is not None:
+                        source = ('batch', earlier)
+                    else:
+                        batch_hashes.setdefault(camera, []).append((value, i))
             
-            # Check for defects
-            if has_defects(analysis):
-                trigger_defect_alert(analysis)
+            sources.append(source)
+            if source is not None:
+                count('ReusedAnalyses')
+            elif thumbnail is not None:
+                # Static checks compare with the last analyzed frame, so
+                # slow drift adds up until a frame is analyzed again
+                previous[camera] = (thumbnail, ('batch', i))
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Image analysis completed')
+        futures = {
+            i: executor.submit(analyze_frame, frame)
+            for i, frame in enumerate(frames)
+            if sources[i] is None and frame['error'] is None
         }
+        
+        for i, (record, frame) in enumerate(zip(records, frames)):
+            if frame['error'] is not None:
+                yield record, None, frame['error']
+                continue
+            try:
+                source = sources[i]
+                if source is None:
+                    analysis = futures[i].result()
+                    if frame['hash'] is not None:
+                        recent_hashes.add(frame['camera'], frame['hash'], analysis)
+                    if frame['thumbnail'] is not None:
+                        preprocessor.remember(frame['camera'], frame['thumbnail'],
+                                              ('cached', analysis))
+                elif source[0] == 'cached':
+                    analysis = reuse_analysis(source[1], frame['key'])
+                else:
+                    analysis = reuse_analysis(futures[source[1]].result(), frame['key'])
+                yield record, analysis, None
+            except Exception as e:
+                yield record, None, e
+
+@timed('Fetch')
+def load_frame(record):
+    """Download an image, preprocess it and compute its perceptual hash"""
+    bucket = record['s3']['bucket']['name']
+    key = record['s3']['object']['key']
+    frame = {
+        'bucket': bucket,
+        'key': key,
+        'camera': camera_id(key),
+        'bytes': None,
+        'hash': None,
+        'thumbnail': None,
+        'error': None
+    }
+    try:
+        frame['bytes'] = clients.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
     except Exception as e:
-        print(f"Error analyzing image: {str(e)}")
-        raise
+        frame['error'] = e
+        return frame
+    try:
+        if preprocessor is not None:
+            frame['bytes'], image, frame['thumbnail'] = preprocessor.prepare(
+                frame['camera'], frame['bytes']
+            )
+            frame['hash'] = dhash_image(image)
+        else:
+            frame['hash'] = dhash(frame['bytes'])
+    except Exception as e:
+        # Undecodable locally; still let Rekognition look at it
+        print(f"Error hashing {bucket}/{key}: {str(e)}")
+    return frame
+
+def camera_id(key):
+    """Derive the camera a frame came from from its key prefix"""
+    return key.rsplit('/', 1)[0] if '/' in key else 'default'
+
+@timed('Analyze')
+def analyze_frame(frame):
+    """Analyze a downloaded frame, passing small images inline"""
+    count('RekognitionCalls')
+    if len(frame['bytes']) <= MAX_INLINE_BYTES:
+        return analyze_image_bytes(frame['key'], frame['bytes'])
+    return analyze_image(frame['bucket'], frame['key'])
+
+def reuse_analysis(analysis, key):
+    """Copy an earlier analysis for a near-identical frame"""
+    return dict(
+        analysis,
+        imageKey=key,
+        timestamp=datetime.utcnow().isoformat(),
+        duplicateOf=analysis.get('duplicateOf', analysis['imageKey'])
+    )
+
+def analyze_image_bytes(key, image_bytes):
+    """Analyze in-memory image bytes using Rekognition"""
+    response = clients.client('rekognition').detect_labels(
+        Image={'Bytes': image_bytes},
+        MaxLabels=10,
+        MinConfidence=70
+    )
+    
+    return build_analysis(key, response)
 
 def analyze_image(bucket, key):
     """Analyze image using Rekognition"""
-    response = rekognition.detect_labels(
+    response = clients.client('rekognition').detect_labels(
         Image={'S3Object': {'Bucket': bucket, 'Name': key}},
         MaxLabels=10,
         MinConfidence=70
     )
     
+    return build_analysis(key, response)
+
+def build_analysis(key, response):
+    """Build an analysis result from a detect_labels response"""
     return {
         'imageKey': key,
         'timestamp': datetime.utcnow().isoformat(),
@@ -52,3 +236,43 @@ def analyze_image(bucket, key):
         'confidence': max([label['Confidence'] for label in response['Labels']], default=0),
         'analysisType': 'quality_control'
     }
+
+def store_analysis_results(analysis, writer, record_id=None):
+    """Queue an analysis result for a batched write under its camera
+
+    The item key is derived from the image, so a redelivered image
+    overwrites its earlier result instead of duplicating it.
+    """
+    item = {
+        'deviceId': camera_id(analysis['imageKey']),
+        'timestamp': f"analysis#{analysis['imageKey']}",
+        'analyzedAt': analysis['timestamp'],
+        'labels': json.dumps(analysis['labels']),
+        'confidence': to_decimal(float(analysis['confidence'])),
+        'analysisType': analysis['analysisType']
+    }
+    if 'duplicateOf' in analysis:
+        item['duplicateOf'] = analysis['duplicateOf']
+    writer.put(item, record_id=record_id)
+
+def trigger_defect_alert(analysis, notifier, record_id=None):
+    """Queue a defect alert for the alert topic"""
+    defects = [
+        label['Name'] for label in analysis['labels']
+        if label['Name'] in DEFECT_LABELS and label['Confidence'] >= DEFECT_MIN_CONFIDENCE
+    ]
+    camera = camera_id(analysis['imageKey'])
+    notifier.publish(
+        os.environ['ALERT_TOPIC'],
+        dict(analysis, deviceId=camera, defects=defects),
+        attributes={'type': 'defect', 'severity': 'critical', 'deviceId': camera},
+        subject=f"[CRITICAL] {', '.join(defects)} detected by {camera}",
+        record_id=record_id
+    )
+
+def has_defects(analysis):
+    """Check whether any confidently detected label indicates a defect"""
+    return any(
+        label['Name'] in DEFECT_LABELS and label['Confidence'] >= DEFECT_MIN_CONFIDENCE
+        for label in analysis['labels']
+    )
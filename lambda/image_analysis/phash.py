@@ -0,0 +1,82 @@
+import io
+import threading
+import time
+from collections import OrderedDict, deque
+
+from PIL import Image
+
+def dhash(image_bytes, size=8):
+    """Compute a difference hash of an image as an int of size * size bits
+
+    The image is reduced to a (size + 1) x size grayscale thumbnail and each
+    bit records whether a pixel is darker than its right-hand neighbour, so
+    near-identical frames produce hashes a few bits apart.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        # Let the JPEG decoder skip detail we are about to throw away
+        image.draft('L', ((size + 1) * 4, size * 4))
+        return dhash_image(image, size)
+
+def dhash_image(image, size=8):
+    """Compute the difference hash of an already decoded PIL image"""
+    pixels = image.convert('L').resize(
+        (size + 1, size), Image.Resampling.BILINEAR
+    ).tobytes()
+
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+def hamming(a, b):
+    """Count the differing bits between two hashes"""
+    return bin(a ^ b).count('1')
+
+class RecentHashes:
+    """Recent frame hashes per camera with the analysis made for each
+
+    Each camera keeps its last per_camera hashes, entries expire after ttl
+    seconds and the least recently seen cameras are dropped beyond
+    max_cameras, so memory stays bounded. Safe to share between threads.
+    """
+
+    def __init__(self, per_camera=16, max_cameras=1000, max_distance=4,
+                 ttl=300, clock=time.monotonic):
+        self.per_camera = per_camera
+        self.max_cameras = max_cameras
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._cameras = OrderedDict()
+        self._lock = threading.Lock()
+
+    def find(self, camera, value):
+        """Return the analysis of a recent frame within max_distance, if any"""
+        now = self.clock()
+        with self._lock:
+            entries = self._cameras.get(camera)
+            if entries:
+                self._cameras.move_to_end(camera)
+                for seen_at, other, analysis in reversed(entries):
+                    if now - seen_at <= self.ttl and \
+                       hamming(value, other) <= self.max_distance:
+                        self.hits += 1
+                        return analysis
+            self.misses += 1
+            return None
+
+    def add(self, camera, value, analysis):
+        """Remember the analysis made for a frame"""
+        with self._lock:
+            entries = self._cameras.get(camera)
+            if entries is None:
+                entries = self._cameras[camera] = deque(maxlen=self.per_camera)
+                while len(self._cameras) > self.max_cameras:
+                    self._cameras.popitem(last=False)
+            else:
+                self._cameras.move_to_end(camera)
+            entries.append((self.clock(), value, analysis))
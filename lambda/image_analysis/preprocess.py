@@ -0,0 +1,109 @@
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image, ImageChops
+
+# Side of the grayscale thumbnail used to compare consecutive frames
+THUMBNAIL_SIZE = 64
+
+class FramePreprocessor:
+    """Crop, downscale and compare frames before they are sent to Rekognition
+
+    Frames are cropped to the camera's region of interest, given as
+    [left, top, right, bottom] fractions of the frame, and shrunk so neither
+    side exceeds max_dimension. A frame is considered static when no pixel of
+    its grayscale thumbnail differs from the camera's last analyzed frame by
+    diff_threshold or more (0-255 scale). Using the largest difference rather
+    than the mean keeps small, localized changes such as a new scratch from
+    being skipped. The last analyzed frames of at most max_cameras cameras
+    are kept, dropping the least recently seen, and a frame's analysis is
+    reused for at most max_age seconds.
+    """
+
+    def __init__(self, max_dimension=1280, rois=None, diff_threshold=0.0,
+                 jpeg_quality=90, max_cameras=1000, max_age=300, clock=time.monotonic):
+        self.max_dimension = max_dimension
+        self.rois = rois or {}
+        self.diff_threshold = diff_threshold
+        self.jpeg_quality = jpeg_quality
+        self.max_cameras = max_cameras
+        self.max_age = max_age
+        self.clock = clock
+        self._last = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Build a preprocessor from IMAGE_* and CAMERA_ROI environment variables
+
+        Returns None unless IMAGE_PREPROCESS is enabled.
+        """
+        if os.environ.get('IMAGE_PREPROCESS', 'false').lower() not in ('1', 'true', 'yes'):
+            return None
+        return cls(
+            max_dimension=int(os.environ.get('IMAGE_MAX_DIMENSION', '1280')),
+            rois=json.loads(os.environ.get('CAMERA_ROI') or '{}'),
+            diff_threshold=float(os.environ.get('FRAME_DIFF_THRESHOLD', '12')),
+            jpeg_quality=int(os.environ.get('IMAGE_JPEG_QUALITY', '90')),
+            max_cameras=int(os.environ.get('IMAGE_MAX_CAMERAS', '1000')),
+            max_age=float(os.environ.get('FRAME_MAX_AGE_SECONDS', '300'))
+        )
+
+    def prepare(self, camera, image_bytes):
+        """Return (jpeg_bytes, image, thumbnail) for a frame"""
+        with Image.open(io.BytesIO(image_bytes)) as source:
+            roi = self.rois.get(camera)
+            if roi is None:
+                # Decode JPEGs directly at a reduced scale when possible
+                source.draft('RGB', (self.max_dimension, self.max_dimension))
+            image = source.convert('RGB')
+
+        if roi is not None:
+            width, height = image.size
+            left, top, right, bottom = roi
+            image = image.crop((int(left * width), int(top * height),
+                                int(right * width), int(bottom * height)))
+        image.thumbnail((self.max_dimension, self.max_dimension),
+                        Image.Resampling.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=self.jpeg_quality)
+        thumbnail = image.convert('L').resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE),
+                                              Image.Resampling.BILINEAR)
+        return output.getvalue(), image, thumbnail
+
+    def is_static(self, previous, thumbnail):
+        """Check whether a thumbnail barely differs from the previous one"""
+        if previous is None or self.diff_threshold <= 0:
+            return False
+        _, largest = ImageChops.difference(previous, thumbnail).getextrema()
+        return largest < self.diff_threshold
+
+    def last_frame(self, camera):
+        """Return (thumbnail, analysis) of the camera's last analyzed frame
+
+        Returns None when there is none, or it was analyzed more than
+        max_age seconds ago.
+        """
+        with self._lock:
+            last = self._last.get(camera)
+            if last is None:
+                return None
+            thumbnail, analysis, analyzed_at = last
+            if self.clock() - analyzed_at > self.max_age:
+                del self._last[camera]
+                return None
+            self._last.move_to_end(camera)
+            return thumbnail, analysis
+
+    def remember(self, camera, thumbnail, analysis):
+        """Record the camera's latest analyzed frame and its analysis"""
+        with self._lock:
+            self._last[camera] = (thumbnail, analysis, self.clock())
+            self._last.move_to_end(camera)
+            while len(self._last) > self.max_cameras:
+                self._last.popitem(last=False)
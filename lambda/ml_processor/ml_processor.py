@@ -1,51 +1,194 @@
 import json
-import boto3
 import os
-import numpy as np
 from datetime import datetime
+from prediction_cache import get_prediction_cache
+from shared import clients
+from shared.batch import BatchProcessor, record_id
+from shared.codec import loads
+from shared.metrics import Metrics, count, span
+from shared.utils import BufferedWriter
 
-sagemaker = boto3.client('sagemaker-runtime')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
 
+# Limits for a single batched invoke_endpoint request
+ML_BATCH_MAX_RECORDS = int(os.environ.get('ML_BATCH_MAX_RECORDS', '64'))
+ML_BATCH_MAX_BYTES = int(os.environ.get('ML_BATCH_MAX_BYTES', str(5 * 1024 * 1024)))
+
+# Feature value the model takes for a metric the reading does not carry
+MISSING_FEATURE = float(os.environ.get('ML_MISSING_FEATURE', '0'))
+
+instrumentation = Metrics('ml_processor')
+
+@instrumentation.invocation
 def handler(event, context):
     """Process data using ML models"""
     try:
-        records = event['Records']
+        batch = BatchProcessor(event['Records'])
+        writer = BufferedWriter()
+        count('Records', len(event['Records']))
         
-        for record in records:
-            # Get data
-            data = json.loads(record['body'])
-            
-            # Get predictions
-            predictions = get_predictions(data)
-            
-            # Process results
-            process_predictions(predictions, data)
+        # Get data and model inputs, skipping records completed by an earlier attempt
+        entries, payloads = [], []
+        for record in batch.pending():
+            try:
+                data = loads(record['body'])
+                payload = prepare_payload(data)
+            except Exception as e:
+                print(f"Error parsing {record_id(record)}: {str(e)}")
+                batch.fail(record_id(record), e)
+                continue
+            entries.append((record_id(record), data))
+            payloads.append(payload)
+        
+        # Serve repeated feature vectors from the prediction cache
+        cache = get_prediction_cache()
+        with span('Cache'):
+            batched = cache.get_many(payloads)
+        
+        # Get predictions for cache misses in batches
+        misses = [i for i, predictions in enumerate(batched) if predictions is None]
+        count('CacheHits', len(payloads) - len(misses))
+        count('CacheMisses', len(misses))
+        with span('Predict'):
+            for i, predictions in zip(misses, get_batch_predictions([payloads[i] for i in misses])):
+                batched[i] = predictions
+        
+        # Only predictions made in this run are cached; rewriting hits would
+        # queue shared-cache writes and keep extending their TTL
+        fresh = set(misses)
+        for i, ((rid, data), payload, predictions) in enumerate(zip(entries, payloads, batched)):
+            try:
+                if predictions is None:
+                    predictions = get_predictions(data)
+                # Process results
+                process_predictions(predictions, data)
+                if i in fresh:
+                    cache.set(payload, predictions)
+                
+                # Store results
+                store_results(predictions, data, writer, record_id=rid)
+            except Exception as e:
+                print(f"Error in ML processing of {rid}: {str(e)}")
+                batch.fail(rid, e)
+        
+        with span('Store'):
+            cache.flush()
             
-            # Store results
-            store_results(predictions, data)
+            # Report only failed messages so SQS redelivers just those
+            response = batch.finish(writer)
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps('ML processing completed')
-        }
+        return dict(response, statusCode=200, body=json.dumps(batch.summary()))
     except Exception as e:
         print(f"Error in ML processing: {str(e)}")
         raise
 
 def get_predictions(data):
     """Get predictions from SageMaker endpoint"""
-    endpoint_name = os.environ['SAGEMAKER_ENDPOINT']
-    
     # Prepare data for model
     payload = prepare_payload(data)
     
     # Get prediction
-    response = sagemaker.invoke_endpoint(
-        EndpointName=endpoint_name,
+    return invoke_endpoint(json.dumps(payload))
+
+def get_batch_predictions(payloads):
+    """Get predictions for many payloads with as few endpoint calls as possible
+
+    Payloads are sent as {"instances": [...]} requests bounded by
+    ML_BATCH_MAX_RECORDS and ML_BATCH_MAX_BYTES, and the "predictions" list
+    in each response is split back per payload. The result is aligned with
+    payloads and holds None wherever the batched call did not produce a
+    prediction, so callers can retry just those records.
+    """
+    results = [None] * len(payloads)
+    
+    for indexes, body in plan_batches(payloads):
+        try:
+            response = invoke_endpoint(body)
+            predictions = response.get('predictions', [])
+            if len(predictions) != len(indexes):
+                raise ValueError(
+                    f"Expected {len(indexes)} predictions, got {len(predictions)}"
+                )
+        except Exception as e:
+            print(f"Batched prediction of {len(indexes)} records failed: {str(e)}")
+            continue
+        
+        for i, prediction in zip(indexes, predictions):
+            if not (isinstance(prediction, dict) and 'error' in prediction):
+                results[i] = prediction
+    
+    return results
+
+def plan_batches(payloads):
+    """Group payloads into (indexes, request body) batches within the limits"""
+    indexes, parts, size = [], [], 0
+    
+    for i, payload in enumerate(payloads):
+        part = json.dumps(payload)
+        if indexes and (len(indexes) >= ML_BATCH_MAX_RECORDS or
+                        size + len(part) + 1 > ML_BATCH_MAX_BYTES):
+            yield indexes, '{"instances": [' + ','.join(parts) + ']}'
+            indexes, parts, size = [], [], 0
+        indexes.append(i)
+        parts.append(part)
+        size += len(part) + 1
+    
+    if indexes:
+        yield indexes, '{"instances": [' + ','.join(parts) + ']}'
+
+def invoke_endpoint(body):
+    """Invoke the SageMaker endpoint with a JSON request body"""
+    count('EndpointCalls')
+    response = clients.client('sagemaker-runtime').invoke_endpoint(
+        EndpointName=os.environ['SAGEMAKER_ENDPOINT'],
         ContentType='application/json',
-        Body=json.dumps(payload)
+        Body=body
     )
     
-    return json.loads(response['Body'].read().decode())
\ No newline at end of file
+    return loads(response['Body'].read())
+
+def prepare_payload(data):
+    """Build the model input for a processed sensor reading
+
+    A metric that is absent or has a None value, as the preprocessor stores
+    for a sensor missing from the reading, gets MISSING_FEATURE. Raises
+    ValueError for a body that is not a reading.
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a reading object, got {type(data).__name__}")
+    features = []
+    for metric in ('temperature', 'vibration'):
+        reading = data.get(metric, {})
+        if isinstance(reading, dict):
+            value = reading.get('value')
+            value = MISSING_FEATURE if value is None else value
+        else:
+            value = None
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"Expected {metric} as {{'value': number}}, got {reading!r}")
+        features.append(value)
+    return {
+        'deviceId': data.get('deviceId'),
+        'features': features
+    }
+
+def process_predictions(predictions, data):
+    """Check a prediction before it is stored"""
+    if not isinstance(predictions, dict):
+        raise ValueError(f"Unexpected prediction for {data.get('deviceId')}: {predictions!r}")
+    if 'error' in predictions:
+        raise ValueError(f"Model error for {data.get('deviceId')}: {predictions['error']}")
+    return predictions
+
+def store_results(predictions, data, writer, record_id=None):
+    """Queue prediction results for a batched write
+
+    The item key is derived from the reading, so a redelivered message
+    overwrites its earlier result instead of duplicating it.
+    """
+    writer.put({
+        'deviceId': data.get('deviceId'),
+        'timestamp': f"prediction#{data.get('timestamp', '')}",
+        'predictions': json.dumps(predictions),
+        'modelVersion': os.environ.get('MODEL_VERSION', 'latest'),
+        'processedAt': datetime.utcnow().isoformat()
+    }, record_id=record_id)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import time
+
+from shared import clients
+from shared.cache import TTLCache
+from shared.utils import BufferedWriter, batch_get_items
+
+_cache = None
+
+class PredictionCache:
+    """Content-addressed cache of model predictions
+
+    Keys hash the endpoint name, model version and canonical JSON payload, so
+    a new endpoint or model version never sees stale predictions. Lookups go
+    to an in-process LRU first and then, when a table is configured, to a
+    shared DynamoDB layer (partition key cacheKey, TTL attribute ttl).
+    """
+
+    def __init__(self, endpoint, model_version, ttl=300, max_size=10000, table=None):
+        self.endpoint = endpoint
+        self.model_version = model_version
+        self.ttl = ttl
+        self.local = TTLCache(max_size=max_size, ttl=ttl)
+        self.table = table
+        self.shared_hits = 0
+        self._pending = {}
+
+    def key(self, payload):
+        """Hash a payload into a cache key scoped to endpoint and model"""
+        canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+        digest = hashlib.sha256(
+            f"{self.endpoint}\0{self.model_version}\0{canonical}".encode('utf-8')
+        )
+        return digest.hexdigest()
+
+    def get_many(self, payloads):
+        """Look up predictions for payloads, returning None for misses"""
+        keys = [self.key(payload) for payload in payloads]
+        results = [self.local.get(key) for key in keys]
+
+        if self.table is not None:
+            missing = list(dict.fromkeys(k for k, r in zip(keys, results) if r is None))
+            if missing:
+                found = self._get_shared(missing)
+                for i, key in enumerate(keys):
+                    if results[i] is None and key in found:
+                        results[i] = found[key]
+                        self.local.set(key, found[key])
+                        self.shared_hits += 1
+
+        return results
+
+    def _get_shared(self, keys):
+        # The shared layer is an optimisation; never fail a lookup over it
+        try:
+            items = batch_get_items([{'cacheKey': k} for k in keys], table=self.table)
+        except Exception as e:
+            print(f"Error reading shared prediction cache: {str(e)}")
+            return {}
+        # DynamoDB TTL deletes lazily, so expired items can still be returned
+        now = int(time.time())
+        return {
+            item['cacheKey']: json.loads(item['prediction'])
+            for item in items if int(item.get('ttl', 0)) > now
+        }
+
+    def set(self, payload, prediction):
+        """Cache a prediction locally and queue it for the shared layer"""
+        key = self.key(payload)
+        self.local.set(key, prediction)
+        if self.table is not None:
+            self._pending[key] = prediction
+
+    def flush(self):
+        """Write queued predictions to the shared layer"""
+        if not self._pending:
+            return
+        writer = BufferedWriter(table=self.table, key_names=('cacheKey',))
+        expires_at = int(time.time()) + self.ttl
+        for key, prediction in self._pending.items():
+            writer.put({
+                'cacheKey': key,
+                'prediction': json.dumps(prediction),
+                'modelVersion': self.model_version,
+                'ttl': expires_at
+            })
+        self._pending = {}
+        writer.flush()
+
+    def stats(self):
+        """Return hit/miss/eviction counters for both layers"""
+        return dict(self.local.stats(), sharedHits=self.shared_hits)
+
+def get_prediction_cache():
+    """Get the module-level cache, rebuilding it when endpoint or model changes
+
+    Configured by SAGEMAKER_ENDPOINT, MODEL_VERSION, PREDICTION_CACHE_TTL,
+    PREDICTION_CACHE_TTLS (JSON of per-model-version TTLs),
+    PREDICTION_CACHE_SIZE and PREDICTION_CACHE_TABLE.
+    """
+    global _cache
+    endpoint = os.environ['SAGEMAKER_ENDPOINT']
+    model_version = os.environ.get('MODEL_VERSION', 'latest')
+
+    if _cache is None or _cache.endpoint != endpoint or \
+       _cache.model_version != model_version:
+        ttls = json.loads(os.environ.get('PREDICTION_CACHE_TTLS') or '{}')
+        ttl = int(ttls.get(model_version, os.environ.get('PREDICTION_CACHE_TTL', '300')))
+        table_name = os.environ.get('PREDICTION_CACHE_TABLE')
+        table = clients.table(table_name) if table_name else None
+        _cache = PredictionCache(
+            endpoint, model_version, ttl=ttl,
+            max_size=int(os.environ.get('PREDICTION_CACHE_SIZE', '10000')),
+            table=table
+        )
+    return _cache
@@ -0,0 +1,158 @@
+import base64
+import math
+import os
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+
+from shared.utils import batch_get_items
+
+METRICS = ('temperature', 'vibration')
+
+# Per metric: observation count, EWMA mean, EWMA variance, last value and
+# EWMA of the absolute step between consecutive readings
+FIELDS = 5
+STATE_SIZE = FIELDS * len(METRICS)
+
+# Sort key of the checkpoint item stored next to a device's readings
+STATE_SORT_KEY = 'state#anomaly'
+
+class RollingDetector:
+    """Per-device EWMA detector for z-score and rate-of-change outliers
+
+    Each device holds a fixed-size array of running statistics, so memory per
+    device is constant however long the stream, and the number of devices
+    kept in memory is capped with LRU eviction. Updates are O(1) per reading.
+    """
+
+    def __init__(self, alpha=0.05, z_threshold=4.0, roc_factor=6.0,
+                 min_samples=20, max_devices=50000):
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.roc_factor = roc_factor
+        self.min_samples = min_samples
+        self.max_devices = max_devices
+        self._states = OrderedDict()
+        self._dirty = {}
+
+    @classmethod
+    def from_env(cls):
+        """Build a detector configured from ANOMALY_* environment variables"""
+        return cls(
+            alpha=float(os.environ.get('ANOMALY_ALPHA', '0.05')),
+            z_threshold=float(os.environ.get('ANOMALY_Z_THRESHOLD', '4.0')),
+            roc_factor=float(os.environ.get('ANOMALY_ROC_FACTOR', '6.0')),
+            min_samples=int(os.environ.get('ANOMALY_MIN_SAMPLES', '20')),
+            max_devices=int(os.environ.get('ANOMALY_MAX_DEVICES', '50000'))
+        )
+
+    def __len__(self):
+        return len(self._states)
+
+    def update(self, device_id, values):
+        """Fold one reading into a device's state and return outlier reasons
+
+        values holds one number per entry in METRICS; None or NaN marks a
+        metric missing from the reading, which leaves its statistics as they
+        are. Reasons are strings such as 'temperature:zscore' or
+        'vibration:rate'.
+        """
+        state = self._state(device_id)
+        alpha = self.alpha
+        reasons = []
+
+        for m, metric in enumerate(METRICS):
+            x = values[m]
+            if x is None or x != x:
+                continue
+            o = m * FIELDS
+            count = state[o]
+            if count == 0:
+                state[o], state[o + 1], state[o + 3] = 1, x, x
+                continue
+
+            mean, var, last, step = state[o + 1], state[o + 2], state[o + 3], state[o + 4]
+            diff = x - mean
+            delta = abs(x - last)
+            if count >= self.min_samples:
+                if var > 0 and abs(diff) > self.z_threshold * math.sqrt(var):
+                    reasons.append(f"{metric}:zscore")
+                if step > 0 and delta > self.roc_factor * step:
+                    reasons.append(f"{metric}:rate")
+
+            incr = alpha * diff
+            state[o] = count + 1
+            state[o + 1] = mean + incr
+            state[o + 2] = (1 - alpha) * (var + diff * incr)
+            state[o + 3] = x
+            state[o + 4] = step + alpha * (delta - step)
+
+        self._dirty[device_id] = state
+        return reasons
+
+    def load(self, device_ids, table=None):
+        """Load checkpointed state for devices not already held in memory"""
+        missing = []
+        for device_id in dict.fromkeys(device_ids):
+            if device_id in self._states:
+                continue
+            if device_id in self._dirty:
+                # Evicted since the last checkpoint; its newest state is here
+                self._insert(device_id, self._dirty[device_id])
+            else:
+                missing.append(device_id)
+        if not missing:
+            return
+
+        items = batch_get_items(
+            [{'deviceId': d, 'timestamp': STATE_SORT_KEY} for d in missing],
+            table=table
+        )
+        for item in items:
+            self._insert(item['deviceId'], decode_state(item['state']))
+        # Devices without a checkpoint start from empty state
+        for device_id in missing:
+            if device_id not in self._states:
+                self._insert(device_id, new_state())
+
+    def checkpoint(self, writer):
+        """Queue state of devices updated since the last checkpoint"""
+        now = datetime.utcnow().isoformat()
+        for device_id, state in self._dirty.items():
+            writer.put({
+                'deviceId': device_id,
+                'timestamp': STATE_SORT_KEY,
+                'state': encode_state(state),
+                'updatedAt': now
+            })
+        self._dirty = {}
+
+    def _state(self, device_id):
+        state = self._states.get(device_id)
+        if state is None:
+            state = self._dirty.get(device_id) or new_state()
+            self._insert(device_id, state)
+        else:
+            self._states.move_to_end(device_id)
+        return state
+
+    def _insert(self, device_id, state):
+        self._states[device_id] = state
+        # Evicted devices that are still dirty stay referenced until checkpoint
+        while len(self._states) > self.max_devices:
+            self._states.popitem(last=False)
+
+def new_state():
+    return array('d', bytes(8 * STATE_SIZE))
+
+def encode_state(state):
+    """Pack a device state into a compact base64 string"""
+    return base64.b64encode(state.tobytes()).decode('ascii')
+
+def decode_state(encoded):
+    """Unpack a device state produced by encode_state"""
+    state = array('d')
+    state.frombytes(base64.b64decode(encoded))
+    if len(state) != STATE_SIZE:
+        return new_state()
+    return state
@@ -1,71 +1,462 @@
 import json
-import boto3
+import base64
+import gzip
 import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
 import numpy as np
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from shared import clients
+from shared.batch import BatchProcessor, record_id as get_record_id
+from shared.codec import loads
+from shared.device_state import DeviceStateStore, registry_thresholds
+from shared.export import ParquetExporter
+from shared.metrics import Metrics, count, span
+from shared.notifications import NotificationDispatcher
+from shared.rollups import RollupTracker, refresh_rollups
+from shared.schema import (
+    reading_codec, reading_key, reading_timestamp, registration_item, write_shards
+)
+from shared.utils import BufferedWriter, trigger_anomaly_processing
+from thresholds import CRITICAL, STATUS_NAMES, ThresholdTable, classify, classify_scalar
+from anomaly import RollingDetector
 
-s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
-bedrock = boto3.client('bedrock-runtime')
 
+# Caps for the concurrent S3 fetch stage
+S3_FETCH_CONCURRENCY = int(os.environ.get('S3_FETCH_CONCURRENCY', '8'))
+S3_FETCH_MAX_BYTES = int(os.environ.get('S3_FETCH_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Objects with these suffixes (optionally gzipped) hold one reading per line
+NDJSON_SUFFIXES = ('.ndjson', '.jsonl')
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', str(64 * 1024)))
+
+# Readings are classified in columnar chunks of this many rows
+CLASSIFY_BATCH_SIZE = int(os.environ.get('CLASSIFY_BATCH_SIZE', '1000'))
+
+# Seconds before the timeout at which a rollup refresh stops starting devices
+ROLLUP_SAFETY_SECONDS = 30
+
+thresholds = ThresholdTable.from_env()
+# Resolved thresholds per device, kept across warm invocations and
+# refreshed from the device registry once they expire
+device_states = DeviceStateStore.from_env(dict({
+    f"{metric}_{level}": 'd'
+    for metric in thresholds.defaults for level in ('warning', 'critical')
+}, write_shards='B'))
+# Devices seen without a registration item, registered after the batch
+unregistered = {}
+# Kept at module level so device statistics survive warm invocations
+detector = RollingDetector.from_env()
+
+# Columnar export to the processed bucket, None when disabled
+exporter = ParquetExporter.from_env()
+
+instrumentation = Metrics('preprocessor')
+
+@instrumentation.invocation
 def handler(event, context):
-    """Process incoming IoT data"""
+    """Process incoming IoT data
+
+    Accepts S3 object notifications for bulk uploads, SQS or Kinesis
+    batches buffered by the IoT rule, and direct IoT rule invocations whose
+    event is the device message itself.
+    """
     try:
+        # Schedules compact exported files and rebuild marked rollups
+        if isinstance(event, dict) and event.get('detail-type') == 'Scheduled Event':
+            return run_scheduled(event, context)
+
         # Extract records from IoT Core Rule
-        records = event['Records']
+        records = ingest_records(event, context)
+        batch = BatchProcessor(records)
+        writer = BufferedWriter()
+        rollups = RollupTracker()
+        notifier = NotificationDispatcher()
+        count('Records', len(records))
         
-        for record in records:
-            # Parse S3 event
-            bucket = record['s3']['bucket']['name']
-            key = record['s3']['object']['key']
-            
-            # Get data from S3
-            response = s3.get_object(Bucket=bucket, Key=key)
-            data = json.loads(response['Body'].read().decode('utf-8'))
-            
-            # Process the data
-            processed_data = process_sensor_data(data)
-            
-            # Store processed data
-            store_processed_data(processed_data)
+        # Skip records completed by an earlier attempt of this batch
+        for record_id, readings, error in load_readings(batch.pending()):
+            try:
+                if error is not None:
+                    raise error
+                
+                with span('Process'):
+                    for chunk in iter_chunks(readings, CLASSIFY_BATCH_SIZE):
+                        count('Readings', len(chunk))
+                        # Process the data
+                        for processed_data, anomalous, key in process_sensor_batch(chunk):
+                            # Queue processed data for a batched write
+                            writer.put(reading_codec.encode(processed_data, **key), record_id=record_id)
+                            rollups.add(processed_data, record_id=record_id)
+                            if exporter is not None:
+                                exporter.add(processed_data, record_id=record_id)
+                            
+                            # Check for anomalies
+                            if anomalous:
+                                count('Anomalies')
+                                trigger_anomaly_processing(processed_data, dispatcher=notifier,
+                                                           record_id=record_id)
+            except Exception as e:
+                print(f"Error processing {record_id}: {str(e)}")
+                batch.fail(record_id, e)
+        
+        # Publish anomaly notifications in the background while writing
+        notifier.discard(batch.failed)
+        notifier.flush(wait=False)
+        
+        with span('Store'):
+            # Checkpoint detector state alongside the processed readings
+            detector.checkpoint(writer)
             
-            # Check for anomalies
-            if is_anomaly(processed_data):
-                trigger_anomaly_processing(processed_data)
+            # Write remaining buffered items
+            for record_id in writer.flush():
+                batch.fail(record_id, 'write failed')
+            register_devices()
+        with span('Publish'):
+            for record_id in notifier.wait():
+                batch.fail(record_id, 'notification failed')
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Processing completed successfully')
-        }
+        # Export readings of successful records as Parquet
+        if exporter is not None:
+            exporter.discard(batch.failed)
+            with span('Export'):
+                for record_id in exporter.flush():
+                    batch.fail(record_id, 'export failed')
+        
+        # Mark the rollup buckets of stored readings for the next refresh
+        rollups.discard(batch.failed)
+        with span('Rollups'):
+            for record_id in rollups.flush():
+                batch.fail(record_id, 'rollup mark failed')
+        
+        # Report per-record failures
+        response = batch.finish()
+        
+        return dict(response, statusCode=200, body=json.dumps(batch.summary()))
     except Exception as e:
         print(f"Error processing data: {str(e)}")
         raise
 
+def run_scheduled(event, context=None):
+    """Run the task of a scheduled event: 'compact' (the default) or 'rollups'
+
+    Compaction merges the exported part files of recent hours; the rollup
+    refresh rebuilds the metric buckets marked by ingest, stopping short of
+    the function timeout and leaving the rest to the next run.
+    """
+    task = (event.get('detail') or {}).get('task', 'compact')
+    if task == 'compact':
+        with span('Compact'):
+            compacted = exporter.compact() if exporter is not None else []
+        count('CompactedPartitions', len(compacted))
+        return {'statusCode': 200, 'body': json.dumps({'compacted': compacted})}
+    if task == 'rollups':
+        options = {}
+        if hasattr(context, 'get_remaining_time_in_millis'):
+            # The lease outlives this invocation should it time out
+            remaining = context.get_remaining_time_in_millis() / 1000
+            options = {'deadline': time.time() + remaining - ROLLUP_SAFETY_SECONDS,
+                       'lease_seconds': remaining + 1}
+        with span('Rollups'):
+            result = refresh_rollups(**options)
+        count('RollupDevices', result['devices'])
+        count('RollupFailures', result['failed'])
+        return {'statusCode': 200, 'body': json.dumps(result)}
+    raise ValueError(f"Unknown scheduled task: {task}")
+
+def ingest_records(event, context=None):
+    """Return the records of an event, wrapping a direct IoT message as one
+
+    The IoT rule invokes the function asynchronously with the message as
+    the event, and async retries keep the request id, so it identifies the
+    message for completion markers.
+    """
+    if isinstance(event, dict) and 'Records' in event:
+        return event['Records']
+    return [{
+        'eventSource': 'aws:iot',
+        'eventID': getattr(context, 'aws_request_id', None) or str(uuid.uuid4()),
+        'readings': event
+    }]
+
+def load_readings(records):
+    """Yield (record_id, readings, error) for each record in order
+
+    S3 records are fetched from the bucket; SQS, Kinesis and direct IoT
+    records carry their readings in the event and are decoded in memory.
+    """
+    if records and 's3' in records[0]:
+        yield from fetch_objects(records)
+        return
+    for record in records:
+        try:
+            yield get_record_id(record), decode_payload(record), None
+        except Exception as e:
+            yield get_record_id(record), None, e
+
+def decode_payload(record):
+    """Get the readings carried by an SQS, Kinesis or IoT record
+
+    A message holds one reading, a list of readings, or an object with a
+    "readings" list for devices that publish several at once.
+    """
+    if 'kinesis' in record:
+        payload = loads(base64.b64decode(record['kinesis']['data']))
+    elif 'body' in record:
+        payload = loads(record['body'])
+    else:
+        payload = record['readings']
+
+    if isinstance(payload, dict) and isinstance(payload.get('readings'), list):
+        payload = payload['readings']
+    if isinstance(payload, dict):
+        return [payload]
+    if isinstance(payload, list):
+        return payload
+    raise ValueError(f"Unsupported payload type {type(payload).__name__}")
+
+def fetch_objects(records, max_workers=None, max_bytes=None):
+    """Fetch and decode S3 objects concurrently, yielding results in record order
+
+    At most max_workers objects, and roughly max_bytes of object data (by the
+    size reported in the S3 event), are in flight at once. Each result is a
+    (record_id, readings, error) tuple where readings is an iterable of
+    decoded sensor readings.
+    """
+    max_workers = max_workers or S3_FETCH_CONCURRENCY
+    max_bytes = max_bytes or S3_FETCH_MAX_BYTES
+    pending = deque()
+    inflight_bytes = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for record in records:
+            # Parse S3 event
+            bucket = record['s3']['bucket']['name']
+            key = record['s3']['object']['key']
+            size = record['s3']['object'].get('size', 0)
+
+            # Drain completed fetches in order until there is room
+            while pending and (len(pending) >= max_workers or
+                               inflight_bytes + size > max_bytes):
+                inflight_bytes -= pending[0][1]
+                yield _fetch_result(pending.popleft())
+
+            future = executor.submit(fetch_object, bucket, key)
+            pending.append((f"{bucket}/{key}", size, future))
+            inflight_bytes += size
+
+        while pending:
+            yield _fetch_result(pending.popleft())
+
+def _fetch_result(entry):
+    record_id, _, future = entry
+    try:
+        with span('Fetch'):
+            result = future.result()
+        return record_id, result, None
+    except Exception as e:
+        return record_id, None, e
+
+def fetch_object(bucket, key):
+    """Get the sensor readings held in an S3 object
+
+    Single-reading JSON objects are read and decoded eagerly. NDJSON objects
+    are returned as a lazy iterator over the response body so that large
+    files are never held in memory as a whole.
+    """
+    response = clients.client('s3').get_object(Bucket=bucket, Key=key)
+    body = response['Body']
+
+    name = key
+    compressed = response.get('ContentEncoding') == 'gzip'
+    if key.endswith('.gz'):
+        name = key[:-3]
+        compressed = True
+    if compressed:
+        body = gzip.GzipFile(fileobj=body)
+
+    if name.endswith(NDJSON_SUFFIXES) or \
+       response.get('ContentType') == NDJSON_CONTENT_TYPE:
+        return iter_readings(body, compressed)
+    return [loads(body.read())]
+
+def iter_readings(body, compressed=False):
+    """Yield readings from a newline-delimited JSON stream
+
+    Lines that are not valid JSON are skipped and counted as
+    MalformedReadings, so one bad line does not fail the whole object.
+    """
+    lines = body if compressed else body.iter_lines(chunk_size=STREAM_CHUNK_SIZE)
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            reading = loads(line)
+        except ValueError as e:
+            print(f"Skipping malformed line: {str(e)}")
+            count('MalformedReadings')
+            continue
+        yield reading
+
+def iter_chunks(iterable, size):
+    """Yield lists of up to size items from iterable"""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+def process_sensor_batch(readings):
+    """Process a list of raw readings with one vectorized threshold pass
+
+    Yields (processed_data, anomalous, key) in input order, where key is the
+    table key of the reading. The per-reading dicts are only built as the
+    caller consumes them. A reading is anomalous
+    when any metric is critical or the rolling detector flags it as an
+    outlier for its device; a warning status alone is not enough, so devices
+    that simply run hot do not alert on every reading. Readings without a
+    device id are skipped and counted as MalformedReadings.
+    """
+    received = len(readings)
+    readings = [data for data in readings if isinstance(data, dict) and
+                isinstance(data.get('device_id'), str) and data['device_id']]
+    if len(readings) < received:
+        print(f"Skipping {received - len(readings)} readings without a device id")
+        count('MalformedReadings', received - len(readings))
+    device_ids = [data['device_id'] for data in readings]
+    device_types = [data.get('device_type') for data in readings]
+    # Missing metrics stay None: NaN to classify, which leaves them normal,
+    # and skipped by the detector
+    temperatures = [data.get('temperature') for data in readings]
+    vibrations = [data.get('vibration') for data in readings]
+
+    slots = np.asarray(device_slots(device_ids, device_types))
+    temp_limits = device_states.values('temperature_warning', slots)
+    vib_limits = device_states.values('vibration_warning', slots)
+    temp_codes = classify(temperatures, temp_limits,
+                          device_states.values('temperature_critical', slots))
+    vib_codes = classify(vibrations, vib_limits,
+                         device_states.values('vibration_critical', slots))
+    critical = np.maximum(temp_codes, vib_codes) == CRITICAL
+    # Plain floats and ints for the items and keys built per reading
+    temp_limits, vib_limits = temp_limits.tolist(), vib_limits.tolist()
+    shards = device_states.values('write_shards', slots).tolist()
+
+    detector.load(device_ids)
+
+    now = datetime.utcnow().isoformat()
+    for i, data in enumerate(readings):
+        reasons = detector.update(device_ids[i], (temperatures[i], vibrations[i]))
+        processed_data = {
+            'deviceId': device_ids[i],
+            'timestamp': reading_timestamp(data['timestamp']) if 'timestamp' in data else now,
+            'temperature': {
+                'value': temperatures[i],
+                'status': STATUS_NAMES[temp_codes[i]],
+                'threshold': temp_limits[i]
+            },
+            'vibration': {
+                'value': vibrations[i],
+                'status': STATUS_NAMES[vib_codes[i]],
+                'threshold': vib_limits[i]
+            },
+            'processed': True,
+            'processedAt': now
+        }
+        if reasons:
+            processed_data['anomalies'] = reasons
+        key = reading_key(device_ids[i], processed_data['timestamp'], shards[i])
+        yield processed_data, bool(critical[i]) or bool(reasons), key
+
+def device_slots(device_ids, device_types):
+    """Get device state slots, resolving thresholds of devices not held
+
+    Thresholds from a device's registration item win over the configured
+    ones, and its registered type applies when readings omit device_type.
+    """
+    types = dict(zip(device_ids, device_types))
+    return device_states.load(
+        device_ids, lambda device_id, item: resolve_device(device_id, types[device_id], item)
+    )
+
+def resolve_device(device_id, device_type, item):
+    """Get the state store fields of a device from its registration item"""
+    if item is None:
+        unregistered[device_id] = device_type
+    state = thresholds.resolve(
+        device_id,
+        device_type or (item or {}).get('deviceType'),
+        registry_thresholds(item)
+    )
+    state['write_shards'] = write_shards(item)
+    return state
+
+def register_devices(table=None):
+    """Create registration items for devices first seen in this batch
+
+    The write is conditional, so a device registered meanwhile, or one
+    whose registry read failed, keeps its existing item.
+    """
+    table = table or clients.table()
+    pending = list(unregistered.items())
+    unregistered.clear()
+    for device_id, device_type in pending:
+        try:
+            table.put_item(
+                Item=registration_item(device_id, device_type),
+                ConditionExpression=Attr('deviceId').not_exists()
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print(f"Error registering {device_id}: {str(e)}")
+
+def device_limits(metric, device_id, device_type=None):
+    """Get the (warning, critical) pair of one device from the state store"""
+    slot = device_slots([device_id], [device_type])[0]
+    return (device_states.column(f"{metric}_warning")[slot],
+            device_states.column(f"{metric}_critical")[slot])
+
 def process_sensor_data(data):
     """Process raw sensor data"""
     return {
         'deviceId': data['device_id'],
-        'timestamp': data.get('timestamp', datetime.utcnow().isoformat()),
-        'temperature': analyze_temperature(data.get('temperature', 0)),
-        'vibration': analyze_vibration(data.get('vibration', 0)),
+        'timestamp': reading_timestamp(data['timestamp']) if 'timestamp' in data
+                     else datetime.utcnow().isoformat(),
+        'temperature': analyze_temperature(data.get('temperature'),
+                                           data['device_id'], data.get('device_type')),
+        'vibration': analyze_vibration(data.get('vibration'),
+                                       data['device_id'], data.get('device_type')),
         'processed': True,
         'processedAt': datetime.utcnow().isoformat()
     }
 
-def analyze_temperature(temp):
+def is_anomaly(processed_data):
+    """Check for a critical metric or a flagged statistical outlier"""
+    return processed_data['temperature']['status'] == 'critical' or \
+           processed_data['vibration']['status'] == 'critical' or \
+           bool(processed_data.get('anomalies'))
+
+def analyze_temperature(temp, device_id=None, device_type=None):
     """Analyze temperature readings"""
+    warning, critical = device_limits('temperature', device_id, device_type)
     return {
         'value': temp,
-        'status': 'critical' if temp > 85 else 'warning' if temp > 75 else 'normal',
-        'threshold': 75
+        'status': STATUS_NAMES[classify_scalar(temp, warning, critical)],
+        'threshold': warning
     }
 
-def analyze_vibration(vib):
+def analyze_vibration(vib, device_id=None, device_type=None):
     """Analyze vibration readings"""
+    warning, critical = device_limits('vibration', device_id, device_type)
     return {
         'value': vib,
-        'status': 'critical' if vib > 0.8 else 'warning' if vib > 0.5 else 'normal',
-        'threshold': 0.5
-    }
\ No newline at end of file
+        'status': STATUS_NAMES[classify_scalar(vib, warning, critical)],
+        'threshold': warning
+    }
@@ -0,0 +1,84 @@
+import json
+import os
+import numpy as np
+
+# Status codes produced by classify, indexed into STATUS_NAMES
+NORMAL, WARNING, CRITICAL = 0, 1, 2
+STATUS_NAMES = ('normal', 'warning', 'critical')
+
+# (warning, critical) thresholds per metric
+DEFAULT_THRESHOLDS = {
+    'temperature': (75.0, 85.0),
+    'vibration': (0.5, 0.8)
+}
+
+def classify(values, warning, critical):
+    """Classify an array of readings into status codes in one vectorized pass
+
+    warning and critical may be scalars or arrays broadcastable to values.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    codes = (values > warning).astype(np.int8)
+    codes += values > critical
+    return codes
+
+def classify_scalar(value, warning, critical):
+    """Classify a single reading into a status code, normal when it is missing"""
+    if value is None:
+        return NORMAL
+    if value > critical:
+        return CRITICAL
+    if value > warning:
+        return WARNING
+    return NORMAL
+
+class ThresholdTable:
+    """Warning/critical thresholds per metric, per device type and per device
+
+    Device overrides win over device type overrides, which win over the
+    defaults. The preprocessor resolves each device once into its device
+    state store and classifies batches against the gathered columns.
+    """
+
+    def __init__(self, defaults=None, by_type=None, by_device=None):
+        self.defaults = dict(DEFAULT_THRESHOLDS, **(defaults or {}))
+        self.by_type = by_type or {}
+        self.by_device = by_device or {}
+
+    @classmethod
+    def from_env(cls, name='THRESHOLDS'):
+        """Build a table from a JSON document in an environment variable
+
+        The document has optional "defaults", "types" and "devices" keys, each
+        mapping to {metric: [warning, critical]}.
+        """
+        config = json.loads(os.environ.get(name) or '{}')
+        return cls(
+            defaults={m: tuple(t) for m, t in config.get('defaults', {}).items()},
+            by_type={k: {m: tuple(t) for m, t in v.items()}
+                     for k, v in config.get('types', {}).items()},
+            by_device={k: {m: tuple(t) for m, t in v.items()}
+                       for k, v in config.get('devices', {}).items()}
+        )
+
+    def get(self, metric, device_id=None, device_type=None):
+        """Get the (warning, critical) pair for one device"""
+        if device_id in self.by_device and metric in self.by_device[device_id]:
+            return self.by_device[device_id][metric]
+        if device_type in self.by_type and metric in self.by_type[device_type]:
+            return self.by_type[device_type][metric]
+        return self.defaults[metric]
+
+    def resolve(self, device_id, device_type=None, overrides=None):
+        """Get {metric}_warning and {metric}_critical limits for one device
+
+        overrides maps metrics to (warning, critical) pairs, such as those of
+        the device registry, and wins over the configured thresholds.
+        """
+        limits = {}
+        for metric in self.defaults:
+            warning, critical = (overrides or {}).get(metric) or \
+                self.get(metric, device_id, device_type)
+            limits[f"{metric}_warning"] = warning
+            limits[f"{metric}_critical"] = critical
+        return limits
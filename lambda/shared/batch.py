@@ -0,0 +1,134 @@
+import os
+import time
+
+from shared.metrics import count
+from shared.utils import BufferedWriter, batch_get_items, get_dynamodb_table, logger
+
+# Completion markers live in the device table under their own partition
+DEDUPE_PREFIX = 'dedupe#'
+DEDUPE_SORT_KEY = 'done'
+DEDUPE_TTL_SECONDS = int(os.environ.get('DEDUPE_TTL_SECONDS', str(24 * 3600)))
+
+# Event sources that understand a batchItemFailures response
+POLLED_SOURCES = ('aws:sqs', 'aws:kinesis', 'aws:dynamodb')
+
+class PartialBatchError(Exception):
+    """Raised for async sources so that only failed records are reprocessed"""
+
+    def __init__(self, failed):
+        super().__init__(f"{len(failed)} record(s) failed: {', '.join(failed)}")
+        self.failed = failed
+
+def record_id(record):
+    """Identify a record the way Lambda expects in batchItemFailures"""
+    if 'messageId' in record:
+        return record['messageId']
+    if 'kinesis' in record:
+        return record['kinesis']['sequenceNumber']
+    if 'dynamodb' in record:
+        return record['dynamodb']['SequenceNumber']
+    if 's3' in record:
+        return f"{record['s3']['bucket']['name']}/{record['s3']['object']['key']}"
+    return record.get('eventID')
+
+def dedupe_key(record):
+    """Stable key for one version of a record's payload across redeliveries"""
+    if 's3' in record:
+        obj = record['s3']['object']
+        version = obj.get('versionId') or obj.get('sequencer') or obj.get('eTag', '')
+        return f"{record_id(record)}@{version}"
+    if 'kinesis' in record:
+        return record.get('eventID') or record_id(record)
+    return record_id(record)
+
+class BatchProcessor:
+    """Track per-record outcomes of a Lambda batch
+
+    Records that completed in an earlier attempt are skipped via completion
+    markers, failures are reported as batchItemFailures for polled sources,
+    and for async sources (S3) a PartialBatchError is raised after the
+    successful records are marked, so the retry only redoes the failures.
+    """
+
+    def __init__(self, records, table=None, dedupe=True):
+        self.records = records
+        self.table = table
+        self.dedupe = dedupe
+        self.failed = {}
+        self.skipped = []
+        self._attempted = []
+        self._keys = {record_id(r): dedupe_key(r) for r in records}
+
+    @property
+    def async_source(self):
+        return bool(self.records) and \
+            self.records[0].get('eventSource') not in POLLED_SOURCES
+
+    def pending(self):
+        """Return the records not already completed by an earlier attempt"""
+        done = set()
+        if self.dedupe and self.records:
+            self.table = self.table or get_dynamodb_table()
+            keys = [{'deviceId': DEDUPE_PREFIX + key, 'timestamp': DEDUPE_SORT_KEY}
+                    for key in dict.fromkeys(self._keys.values())]
+            try:
+                items = batch_get_items(keys, table=self.table)
+                done = {item['deviceId'][len(DEDUPE_PREFIX):] for item in items}
+            except Exception as e:
+                # Without markers every record is simply processed again
+                logger.error(f"Error reading completion markers: {str(e)}")
+
+        pending = []
+        for record in self.records:
+            rid = record_id(record)
+            if self._keys[rid] in done:
+                self.skipped.append(rid)
+            else:
+                self._attempted.append(rid)
+                pending.append(record)
+        return pending
+
+    def fail(self, rid, error=None):
+        """Mark a record as failed"""
+        if rid not in self.failed:
+            self.failed[rid] = str(error) if error is not None else 'failed'
+
+    def finish(self, writer=None):
+        """Flush writes, mark completed records and build the batch response
+
+        Records whose buffered writes failed in writer count as failures.
+        """
+        if writer is not None:
+            for rid in writer.flush():
+                self.fail(rid, 'write failed')
+
+        succeeded = [rid for rid in self._attempted if rid not in self.failed]
+        if self.dedupe and succeeded:
+            self._mark_done(succeeded)
+
+        failed = list(self.failed)
+        count('FailedRecords', len(failed))
+        count('SkippedRecords', len(self.skipped))
+        if failed and self.async_source:
+            raise PartialBatchError(failed)
+        return {'batchItemFailures': [{'itemIdentifier': rid} for rid in failed]}
+
+    def summary(self):
+        """Return counts of processed, skipped and failed records"""
+        return {
+            'processed': len(self._attempted) - len(self.failed),
+            'skipped': len(self.skipped),
+            'failed': len(self.failed)
+        }
+
+    def _mark_done(self, rids):
+        writer = BufferedWriter(table=self.table)
+        expires_at = int(time.time()) + DEDUPE_TTL_SECONDS
+        for rid in rids:
+            writer.put({
+                'deviceId': DEDUPE_PREFIX + self._keys[rid],
+                'timestamp': DEDUPE_SORT_KEY,
+                'ttl': expires_at
+            })
+        # A lost marker only means the record is reprocessed on retry
+        writer.flush()
@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+class TTLCache:
+    """Size-bounded LRU cache with per-entry expiry and hit/miss counters
+
+    Instances are meant to live at module level so that entries survive warm
+    Lambda invocations. Not thread-safe; guard with a lock if shared between
+    worker threads.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key, default=None, count=True):
+        """Get a live entry, refreshing its LRU position"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > self.clock():
+                self._entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            del self._entries[key]
+            self.expirations += 1
+        if count:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        """Store an entry, evicting the least recently used beyond max_size"""
+        ttl = self.ttl if ttl is None else ttl
+        self._entries[key] = (value, self.clock() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove an entry and return its value"""
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def keys(self):
+        """Return a snapshot of the cached keys, including expired ones"""
+        return list(self._entries)
+
+    def clear(self):
+        """Drop all entries, keeping the counters"""
+        self._entries.clear()
+
+    def stats(self):
+        """Return counters and the current hit rate"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hitRate': self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,67 @@
+import os
+import threading
+
+# Shared by every client: a connection pool large enough for the handlers'
+# thread pools, TCP keep-alive for warm containers, and adaptive retries
+MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '32'))
+CONNECT_TIMEOUT = float(os.environ.get('AWS_CONNECT_TIMEOUT', '2'))
+READ_TIMEOUT = float(os.environ.get('AWS_READ_TIMEOUT', '30'))
+MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+
+_config = None
+_instances = {}
+_overrides = {}
+_lock = threading.RLock()
+
+def client_config():
+    """Return the botocore Config shared by all clients"""
+    global _config
+    if _config is None:
+        from botocore.config import Config
+        _config = Config(
+            max_pool_connections=MAX_POOL_CONNECTIONS,
+            connect_timeout=CONNECT_TIMEOUT,
+            read_timeout=READ_TIMEOUT,
+            tcp_keepalive=True,
+            retries={'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS}
+        )
+    return _config
+
+def client(service):
+    """Get the client for a service, created on first use"""
+    return _get(('client', service), lambda boto3: boto3.client(service, config=client_config()))
+
+def resource(service):
+    """Get the resource for a service, created on first use"""
+    return _get(('resource', service), lambda boto3: boto3.resource(service, config=client_config()))
+
+def table(name=None):
+    """Get a DynamoDB table, DYNAMODB_TABLE by default"""
+    name = name or os.environ['DYNAMODB_TABLE']
+    return _get(('table', name), lambda boto3: resource('dynamodb').Table(name))
+
+def override(service, instance, kind='client'):
+    """Serve a stub in place of a service client, resource or table
+
+    For tables pass the table name as service and kind='table'.
+    """
+    with _lock:
+        _overrides[(kind, service)] = instance
+        _instances.pop((kind, service), None)
+
+def reset():
+    """Forget created clients and overrides"""
+    with _lock:
+        _instances.clear()
+        _overrides.clear()
+
+def _get(key, create):
+    instance = _overrides.get(key) or _instances.get(key)
+    if instance is not None:
+        return instance
+    import boto3
+    with _lock:
+        # Client creation is not thread-safe on a shared session
+        if key not in _instances:
+            _instances[key] = create(boto3)
+        return _instances[key]
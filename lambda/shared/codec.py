@@ -0,0 +1,134 @@
+import json
+import math
+import os
+from decimal import Decimal
+
+# orjson is used for API bodies and messages when it is installed;
+# JSON_BACKEND=json forces the standard library
+orjson = None
+if os.environ.get('JSON_BACKEND', 'orjson') == 'orjson':
+    try:
+        import orjson
+    except ImportError:
+        pass
+
+# Marks a numeric field in an item shape
+NUMBER = 'number'
+
+def to_decimal(value):
+    """Convert a float to the Decimal DynamoDB stores, None for NaN and infinities
+
+    The shortest repr round-trips, so the stored number reads back as the
+    same float; Decimal(value) would keep the full binary expansion and
+    exceed DynamoDB's 38 digits.
+    """
+    if not math.isfinite(value):
+        return None
+    return Decimal(repr(value))
+
+def from_decimal(value):
+    """Convert a stored number back to an int when integral, a float otherwise"""
+    integral = int(value)
+    return integral if integral == value else float(value)
+
+def to_item(value):
+    """Convert floats anywhere in a value to Decimal, for items of any shape"""
+    kind = type(value)
+    if kind is float:
+        return to_decimal(value)
+    if kind is dict:
+        return {key: to_item(item) for key, item in value.items()}
+    if kind is list or kind is tuple:
+        return [to_item(item) for item in value]
+    if isinstance(value, float):
+        # NumPy float scalars subclass float
+        return to_decimal(float(value))
+    return value
+
+def from_item(value):
+    """Convert Decimals anywhere in a value read from DynamoDB to int or float"""
+    kind = type(value)
+    if kind is Decimal:
+        return from_decimal(value)
+    if kind is dict:
+        return {key: from_item(item) for key, item in value.items()}
+    if kind is list:
+        return [from_item(item) for item in value]
+    return value
+
+class ItemCodec:
+    """Float <-> Decimal conversion for items of a known shape
+
+    shape maps attribute names to NUMBER or to the shape of a nested map.
+    The converters are generated as straight-line functions once per shape,
+    so converting an item touches only the declared fields instead of
+    walking and type-testing every value. Attributes outside the shape are
+    copied as they are and must not hold floats; missing ones are skipped.
+    encode() and decode() return new items and leave their argument
+    unchanged; keyword arguments are set on the result before conversion.
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self._encode = _compile(
+            shape, "D(repr({v})) if type({v}) is float and isfinite({v}) else convert({v})")
+        self._decode = _compile(shape, "number({v}) if type({v}) is D else {v}")
+
+    def encode(self, item, **extra):
+        """Build the item to write, with declared numbers as Decimal"""
+        return self._encode(dict(item, **extra) if extra else item)
+
+    def decode(self, item, **extra):
+        """Build the item as read, with declared numbers as int or float"""
+        return self._decode(dict(item, **extra) if extra else item)
+
+def _convert_number(value):
+    if type(value) is float:
+        return to_decimal(value)
+    return value if type(value) in (int, Decimal) else to_item(value)
+
+def _compile(shape, expression):
+    """Generate a converter that applies expression to each NUMBER of shape"""
+    lines = ['def converter(item):', '    out = dict(item)']
+
+    def emit(shape, target, depth):
+        indent = '    ' * depth
+        for i, (name, field) in enumerate(shape.items()):
+            value = f"v{depth}_{i}"
+            lines.append(f"{indent}{value} = {target}.get({name!r})")
+            lines.append(f"{indent}if {value} is not None:")
+            if field == NUMBER:
+                lines.append(f"{indent}    {target}[{name!r}] = {expression.format(v=value)}")
+            else:
+                # Nested maps are copied before their fields are replaced
+                lines.append(f"{indent}    {value} = {target}[{name!r}] = dict({value})")
+                emit(field, value, depth + 1)
+
+    emit(shape, 'out', 1)
+    lines.append('    return out')
+    namespace = {'D': Decimal, 'isfinite': math.isfinite, 'convert': _convert_number,
+                 'number': from_decimal}
+    exec('\n'.join(lines), namespace)
+    return namespace['converter']
+
+def json_default(value):
+    """Serialize the Decimals of DynamoDB items"""
+    if isinstance(value, Decimal):
+        return from_decimal(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(value):
+    """Serialize to a compact JSON string, accepting Decimals
+
+    The standard library is given orjson's separators and UTF-8 output, so
+    the backends agree on the text of ordinary values.
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=json_default).decode('utf-8')
+    return json.dumps(value, default=json_default, separators=(',', ':'), ensure_ascii=False)
+
+def loads(data):
+    """Parse JSON from a str or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,205 @@
+import heapq
+import math
+import os
+import time
+from array import array
+
+from shared.schema import REGISTRY_SORT_KEY
+from shared.utils import batch_get_items, logger
+
+# Rough per-device cost of the id index: dict entry, key string and reverse slot
+INDEX_BYTES_PER_DEVICE = 160
+
+# Columns grow by doubling from this many rows as devices arrive
+INITIAL_SLOTS = 1024
+
+class DeviceStateStore:
+    """Per-device state in typed array columns behind a deviceId -> slot index
+
+    Each field is one array column with a fixed typecode ('d' for floats,
+    'i' or 'b' for integers), so a device costs a few bytes per field plus
+    its index entry instead of a dict per device, and columns can be viewed
+    as NumPy arrays without copying. Lookups are O(1) per device: slots()
+    maps a batch of device ids to row numbers and values() gathers a column
+    for them in one NumPy indexing operation. The store holds at most capacity devices, the smaller of
+    max_devices and what fits in max_bytes; when full, the least recently
+    used eighth is evicted in one pass. Slots handed out by the current
+    slots() or load() call are never evicted, so a batch with more devices
+    than capacity grows the store past it. Rows older than ttl seconds are
+    reported missing so callers reload them.
+
+    Float columns start as NaN and integer columns as 0 for new devices.
+    Like TTLCache, instances are meant to live at module level and are not
+    thread-safe.
+    """
+
+    def __init__(self, fields, max_devices=250000, max_bytes=64 * 1024 * 1024,
+                 ttl=300, evict_fraction=0.125, clock=time.monotonic):
+        self._columns = {name: array(typecode) for name, typecode in fields.items()}
+        row_bytes = sum(column.itemsize for column in self._columns.values()) + 16 + \
+            INDEX_BYTES_PER_DEVICE
+        self.capacity = max(1, min(max_devices, max_bytes // row_bytes))
+        self.ttl = ttl
+        self.evict_count = max(1, int(self.capacity * evict_fraction))
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index = {}
+        self._ids = []
+        self._free = []
+        self._tick = 0
+        self._used = array('q')
+        self._loaded = array('d')
+
+    @classmethod
+    def from_env(cls, fields, prefix='DEVICE_STATE'):
+        """Build a store sized by <prefix>_MAX_DEVICES, _MAX_MB and _TTL_SECONDS"""
+        return cls(
+            fields,
+            max_devices=int(os.environ.get(f"{prefix}_MAX_DEVICES", '250000')),
+            max_bytes=int(float(os.environ.get(f"{prefix}_MAX_MB", '64')) * 1024 * 1024),
+            ttl=float(os.environ.get(f"{prefix}_TTL_SECONDS", '300'))
+        )
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, device_id):
+        return device_id in self._index
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by the columns and the index"""
+        columns = sum(len(column) * column.itemsize for column in self._columns.values())
+        return columns + 16 * len(self._used) + len(self._index) * INDEX_BYTES_PER_DEVICE
+
+    def column(self, name):
+        """Get a field's column, indexed by slot"""
+        return self._columns[name]
+
+    def values(self, name, slots):
+        """Gather a field for a list or integer array of slots as a NumPy array"""
+        # Imported here so handlers that only read single slots skip NumPy
+        import numpy as np
+        column = self._columns[name]
+        return np.frombuffer(column, dtype=column.typecode)[np.asarray(slots, dtype=np.intp)]
+
+    def slots(self, device_ids):
+        """Map device ids to slots, with -1 for missing or expired devices"""
+        self._tick += 1
+        tick = self._tick
+        index, used, loaded = self._index, self._used, self._loaded
+        oldest = -math.inf if self.ttl is None else self.clock() - self.ttl
+        slots = [index.get(device_id, -1) for device_id in device_ids]
+        hits = 0
+        for i, slot in enumerate(slots):
+            if slot >= 0 and loaded[slot] > oldest:
+                used[slot] = tick
+                hits += 1
+            else:
+                slots[i] = -1
+        self.hits += hits
+        self.misses += len(slots) - hits
+        return slots
+
+    def get(self, device_id):
+        """Get a device's fields as a dict, or None when it is not held"""
+        slot = self._index.get(device_id)
+        if slot is None:
+            return None
+        return {name: column[slot] for name, column in self._columns.items()}
+
+    def set(self, device_id, **values):
+        """Store a device's fields, resetting the others, and return its slot"""
+        slot = self._index.get(device_id)
+        if slot is None:
+            slot = self._allocate()
+            self._index[device_id] = slot
+            self._ids[slot] = device_id
+        for name, column in self._columns.items():
+            column[slot] = values.get(name, _blank(column.typecode))
+        self._used[slot] = self._tick
+        self._loaded[slot] = self.clock()
+        return slot
+
+    def load(self, device_ids, resolve, table=None):
+        """Get slots for device_ids, loading missing devices from the registry
+
+        Registration items of missing or expired devices are fetched in bulk
+        with BatchGetItem, and resolve(device_id, item) turns each into field
+        values; item is None for devices that are not registered.
+        """
+        slots = self.slots(device_ids)
+        pending = list(dict.fromkeys(d for d, slot in zip(device_ids, slots) if slot < 0))
+        if not pending:
+            return slots
+
+        items = {}
+        try:
+            for item in batch_get_items(
+                    [{'deviceId': d, 'timestamp': REGISTRY_SORT_KEY} for d in pending],
+                    table=table):
+                items[item['deviceId']] = item
+        except Exception as e:
+            # Resolve from defaults; the rows are reloaded once they expire
+            logger.error(f"Error reading device registry: {str(e)}")
+
+        assigned = {d: self.set(d, **resolve(d, items.get(d))) for d in pending}
+        return [assigned[d] if slot < 0 else slot for d, slot in zip(device_ids, slots)]
+
+    def stats(self):
+        """Return counters, size and approximate memory use"""
+        return {
+            'size': len(self._index),
+            'capacity': self.capacity,
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def _allocate(self):
+        if not self._free:
+            allocated = len(self._ids)
+            if allocated < self.capacity:
+                self._grow(min(self.capacity, max(INITIAL_SLOTS, allocated * 2)))
+            elif not self._evict():
+                self._grow(allocated + self.evict_count)
+        return self._free.pop()
+
+    def _grow(self, size):
+        added = size - len(self._ids)
+        for column in self._columns.values():
+            column.extend([_blank(column.typecode)] * added)
+        self._used.extend([0] * added)
+        self._loaded.extend([0.0] * added)
+        self._ids.extend([None] * added)
+        # Pop hands out the lowest new slot first
+        self._free.extend(range(size - 1, size - added - 1, -1))
+
+    def _evict(self):
+        """Free the least recently used slots not in use by the current call"""
+        used, tick = self._used, self._tick
+        victims = heapq.nsmallest(self.evict_count,
+                                  (slot for slot in range(len(used)) if used[slot] != tick),
+                                  key=used.__getitem__)
+        for slot in victims:
+            del self._index[self._ids[slot]]
+            self._ids[slot] = None
+        self._free.extend(victims)
+        self.evictions += len(victims)
+        return len(victims)
+
+def _blank(typecode):
+    return math.nan if typecode in 'fd' else 0
+
+def registry_thresholds(item):
+    """Get {metric: (warning, critical)} overrides from a registration item"""
+    if not item:
+        return {}
+    return {
+        metric: (float(limits[0]), float(limits[1]))
+        for metric, limits in (item.get('thresholds') or {}).items()
+        if isinstance(limits, (list, tuple)) and len(limits) == 2
+    }
@@ -0,0 +1,273 @@
+import hashlib
+import importlib.util
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from shared import clients
+from shared.rollups import parse_timestamp
+from shared.utils import logger
+
+# pyarrow is imported on first use; it is the largest import of the
+# preprocessor and the export is optional
+pa = pc = ds = pq = None
+
+# Readings are laid out as <prefix>/date=<YYYY-MM-DD>/hour=<HH>/part-*.parquet,
+# with the device as a column, so one batch writes one file per hour it spans
+EXPORT_PREFIX = 'readings'
+
+def load_arrow():
+    """Import pyarrow, raising ImportError when it is not installed"""
+    global pa, pc, ds, pq
+    if pa is None:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.dataset
+        import pyarrow.parquet
+        pc, ds, pq = pyarrow.compute, pyarrow.dataset, pyarrow.parquet
+        pa = pyarrow
+
+def reading_schema():
+    load_arrow()
+    return pa.schema([
+        ('deviceId', pa.string()),
+        ('timestamp', pa.timestamp('ms', tz='UTC')),
+        ('temperature', pa.float64()),
+        ('temperatureStatus', pa.string()),
+        ('vibration', pa.float64()),
+        ('vibrationStatus', pa.string()),
+        ('anomalies', pa.list_(pa.string()))
+    ])
+
+class ParquetExporter:
+    """Buffer processed readings and write them as partitioned Parquet files
+
+    Rows are grouped by UTC hour, sorted by device and timestamp and written
+    with compression and per-row-group statistics so readers can skip row
+    groups of other devices or outside a time range. Contributions are
+    tracked per record so the rows of failed records are never exported;
+    file names are derived from the records they contain, so rewriting the
+    same records is idempotent. Each invocation still adds a part file per
+    hour, which compact_partition merges on a schedule.
+    """
+
+    def __init__(self, bucket, prefix=EXPORT_PREFIX, compression='zstd',
+                 row_group_size=65536, max_workers=8, s3=None):
+        self.bucket = bucket
+        self.max_workers = max_workers
+        self.prefix = prefix
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.s3 = s3 or clients.client('s3')
+        self._groups = {}
+
+    @classmethod
+    def from_env(cls):
+        """Build an exporter for PROCESSED_BUCKET, or None when unavailable"""
+        bucket = os.environ.get('PROCESSED_BUCKET')
+        if not bucket or os.environ.get('EXPORT_ENABLED', 'true').lower() != 'true':
+            return None
+        if importlib.util.find_spec('pyarrow') is None:
+            logger.warning('pyarrow is not installed; Parquet export disabled')
+            return None
+        return cls(
+            bucket,
+            compression=os.environ.get('EXPORT_COMPRESSION', 'zstd'),
+            row_group_size=int(os.environ.get('EXPORT_ROW_GROUP_SIZE', '65536')),
+            max_workers=int(os.environ.get('EXPORT_WORKERS', '8'))
+        )
+
+    def add(self, processed_data, record_id=None):
+        """Buffer one processed reading"""
+        try:
+            moment = parse_timestamp(processed_data['timestamp'])
+        except (KeyError, TypeError, ValueError):
+            return
+        partition = (moment.strftime('%Y-%m-%d'), moment.strftime('%H'))
+        rows = self._groups.setdefault(record_id, {}).setdefault(partition, [])
+        rows.append((
+            processed_data['deviceId'],
+            moment,
+            processed_data.get('temperature', {}).get('value'),
+            processed_data.get('temperature', {}).get('status'),
+            processed_data.get('vibration', {}).get('value'),
+            processed_data.get('vibration', {}).get('status'),
+            processed_data.get('anomalies')
+        ))
+
+    def compact(self, hours=2, now=None):
+        """Compact the hour partitions this exporter wrote to recently"""
+        return compact_recent(self.bucket, hours=hours, now=now, prefix=self.prefix,
+                              s3=self.s3, compression=self.compression,
+                              row_group_size=self.row_group_size)
+
+    def discard(self, record_ids):
+        """Drop the rows of the given records"""
+        for record_id in record_ids:
+            self._groups.pop(record_id, None)
+
+    def flush(self):
+        """Write buffered rows, returning ids of records whose export failed"""
+        partitions = {}
+        for record_id, group in self._groups.items():
+            for partition, rows in group.items():
+                entry = partitions.setdefault(partition, ([], []))
+                entry[0].extend(rows)
+                entry[1].append(record_id)
+        self._groups = {}
+
+        failed = []
+        if not partitions:
+            return failed
+        load_arrow()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                partition: executor.submit(self._write, *partition, *entry)
+                for partition, entry in partitions.items()
+            }
+            for (date, hour), future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Error exporting {date} {hour}h: {str(e)}")
+                    failed.extend(partitions[(date, hour)][1])
+        return list(dict.fromkeys(failed))
+
+    def _write(self, date, hour, rows, record_ids):
+        rows.sort(key=lambda row: (row[0], row[1]))
+        columns = list(zip(*rows))
+        table = pa.Table.from_arrays(
+            [pa.array(column, type=field.type)
+             for column, field in zip(columns, reading_schema())],
+            schema=reading_schema()
+        )
+        digest = hashlib.sha1('\0'.join(sorted(map(str, record_ids))).encode('utf-8'))
+        key = f"{partition_dir(self.prefix, date, hour)}/part-{digest.hexdigest()[:16]}.parquet"
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=to_parquet(
+            table, self.compression, self.row_group_size
+        ))
+
+def to_parquet(table, compression='zstd', row_group_size=65536):
+    """Serialize an Arrow table to Parquet bytes with column statistics"""
+    output = io.BytesIO()
+    pq.write_table(table, output, compression=compression,
+                   row_group_size=row_group_size, write_statistics=True)
+    return output.getvalue()
+
+def partition_dir(root, date, hour):
+    return f"{root}/date={date}/hour={hour}"
+
+def partition_dirs(root, start, end):
+    """List the hour partition directories that hold readings in [start, end)"""
+    moment = start.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    dirs = []
+    while moment < end:
+        dirs.append(partition_dir(root, moment.strftime('%Y-%m-%d'), moment.strftime('%H')))
+        moment += timedelta(hours=1)
+    return dirs
+
+def read_readings(bucket, device_ids=None, start=None, end=None, columns=None,
+                  prefix=EXPORT_PREFIX, filesystem=None):
+    """Read exported readings with device and time-range pushdown
+
+    With both start and end only the hour partition directories of the range
+    are listed. The device and timestamp filters are pushed into the Parquet
+    scan, so row groups whose statistics exclude them are skipped. bucket is
+    a local directory when a local filesystem is passed. Returns an Arrow
+    table.
+    """
+    load_arrow()
+    from pyarrow import fs as pafs
+
+    filesystem = filesystem or pafs.S3FileSystem()
+    root = f"{bucket}/{prefix}"
+
+    if start is not None and end is not None:
+        files = []
+        for directory in partition_dirs(root, start, end):
+            selector = pafs.FileSelector(directory, allow_not_found=True, recursive=True)
+            files.extend(info.path for info in filesystem.get_file_info(selector)
+                         if info.type == pafs.FileType.File)
+        if not files:
+            return reading_schema().empty_table()
+        source = files
+    else:
+        source = root
+
+    dataset = ds.dataset(source, filesystem=filesystem, format='parquet',
+                         schema=reading_schema())
+
+    condition = None
+    for part in (
+        pc.field('deviceId').isin(device_ids) if device_ids is not None else None,
+        pc.field('timestamp') >= pa.scalar(start, pa.timestamp('ms', tz='UTC')) if start else None,
+        pc.field('timestamp') < pa.scalar(end, pa.timestamp('ms', tz='UTC')) if end else None
+    ):
+        if part is not None:
+            condition = part if condition is None else condition & part
+
+    return dataset.to_table(columns=columns, filter=condition)
+
+def compact_partition(bucket, date, hour, prefix=EXPORT_PREFIX, s3=None,
+                      compression='zstd', row_group_size=65536):
+    """Merge an hour partition's part files into one, dropping duplicate readings
+
+    Returns the key of the compacted file, or None when there was nothing to
+    merge. Parts written while this runs are left for the next pass.
+    """
+    load_arrow()
+    s3 = s3 or clients.client('s3')
+    directory = f"{partition_dir(prefix, date, hour)}/"
+    keys = [
+        obj['Key']
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=directory)
+        for obj in page.get('Contents', [])
+        if obj['Key'].endswith('.parquet')
+    ]
+    if len(keys) < 2:
+        return None
+
+    tables = [
+        pq.read_table(io.BytesIO(s3.get_object(Bucket=bucket, Key=key)['Body'].read()),
+                      schema=reading_schema())
+        for key in keys
+    ]
+    table = pa.concat_tables(tables).sort_by([('deviceId', 'ascending'),
+                                              ('timestamp', 'ascending')])
+    # Retried exports can repeat readings; keep the first of each device and timestamp
+    if len(table) > 1:
+        devices, timestamps = table['deviceId'], table['timestamp']
+        changed = pc.or_(
+            pc.not_equal(devices.slice(1), devices.slice(0, len(table) - 1)),
+            pc.not_equal(timestamps.slice(1), timestamps.slice(0, len(table) - 1))
+        )
+        table = table.filter(pa.concat_arrays(
+            [pa.array([True])] + changed.fill_null(True).chunks))
+
+    digest = hashlib.sha1('\0'.join(sorted(keys)).encode('utf-8')).hexdigest()[:16]
+    target = f"{directory}compacted-{digest}.parquet"
+    s3.put_object(Bucket=bucket, Key=target,
+                  Body=to_parquet(table, compression, row_group_size))
+    for start in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in keys[start:start + 1000]]
+        })
+    return target
+
+def compact_recent(bucket, hours=2, now=None, **kwargs):
+    """Compact the last closed hours, returning the keys of compacted files
+
+    Run on a schedule; going back more than one hour also merges parts that
+    arrived late for an hour compacted by the previous run.
+    """
+    now = now or datetime.now(timezone.utc)
+    current = now.replace(minute=0, second=0, microsecond=0)
+    compacted = []
+    for back in range(1, hours + 1):
+        moment = current - timedelta(hours=back)
+        target = compact_partition(bucket, moment.strftime('%Y-%m-%d'), moment.strftime('%H'),
+                                   **kwargs)
+        if target is not None:
+            compacted.append(target)
+    return compacted
@@ -0,0 +1,136 @@
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'IoTML')
+# Fraction of invocations that emit metrics; 0 turns instrumentation off
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0'))
+
+_active = None
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ('recorder', 'name', 'start')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.add_time(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+class Metrics:
+    """Per-invocation timing spans and counters, emitted as one EMF line
+
+    Wrap a handler with invocation(); inside it the module-level span(),
+    timed() and count() record into the sampled invocation, and cost a
+    single attribute check when the invocation is not sampled. Span times
+    are summed per name, so a stage entered once per chunk reports its total.
+    The line goes to stdout, where Lambda hands it to CloudWatch as Embedded
+    Metric Format, and where it can be read when running locally.
+    """
+
+    def __init__(self, service, namespace=None, sample_rate=None, out=None):
+        self.service = service
+        self.namespace = namespace or METRICS_NAMESPACE
+        self.sample_rate = METRICS_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.out = out
+        self.cold = True
+        self._lock = threading.Lock()
+        self._times = {}
+        self._counts = {}
+
+    def invocation(self, handler):
+        """Decorate a Lambda handler to record and emit its metrics"""
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _active
+            if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+                self.cold = False
+                return handler(event, context)
+
+            self._times, self._counts = {}, {}
+            _active = self
+            try:
+                with _Span(self, 'Handler'):
+                    return handler(event, context)
+            except Exception:
+                self.add_count('Errors')
+                raise
+            finally:
+                _active = None
+                self.emit()
+                self.cold = False
+        return wrapper
+
+    def add_time(self, name, ms):
+        with self._lock:
+            self._times[name] = self._times.get(name, 0.0) + ms
+
+    def add_count(self, name, value=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+    def record(self):
+        """Build the EMF document for the current invocation"""
+        metrics = [{'Name': f"{name}Time", 'Unit': 'Milliseconds'} for name in self._times]
+        metrics += [{'Name': name, 'Unit': 'Count'} for name in self._counts]
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['Service']],
+                    'Metrics': metrics
+                }]
+            },
+            'Service': self.service,
+            'ColdStart': self.cold
+        }
+        document.update({f"{name}Time": round(ms, 3) for name, ms in self._times.items()})
+        document.update(self._counts)
+        return document
+
+    def emit(self):
+        print(json.dumps(self.record(), separators=(',', ':')), file=self.out or sys.stdout)
+
+def span(name):
+    """Time a block as a stage of the current invocation"""
+    recorder = _active
+    return _NULL_SPAN if recorder is None else _Span(recorder, name)
+
+def timed(name):
+    """Decorate a function so each call is timed as a stage"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            recorder = _active
+            if recorder is None:
+                return fn(*args, **kwargs)
+            with _Span(recorder, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    """Add to a counter of the current invocation"""
+    recorder = _active
+    if recorder is not None:
+        recorder.add_count(name, value)
@@ -0,0 +1,160 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.codec import dumps
+from shared.metrics import count
+from shared.utils import get_sns_client, logger
+
+# PublishBatch accepts at most 10 entries and 256 KiB of payload per call
+PUBLISH_BATCH_SIZE = 10
+PUBLISH_BATCH_BYTES = 256 * 1024
+
+def message_attributes(attributes):
+    """Turn {'name': value} into SNS MessageAttributes"""
+    formatted = {}
+    for name, value in (attributes or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            formatted[name] = {'DataType': 'String', 'StringValue': str(value)}
+        else:
+            formatted[name] = {'DataType': 'Number', 'StringValue': str(value)}
+    return formatted
+
+class NotificationDispatcher:
+    """Buffer SNS messages and send them with PublishBatch
+
+    Messages are grouped per topic into calls of up to 10 entries. Entries
+    that fail with a service-side fault are retried with jittered backoff;
+    sender faults are not retried. Like BufferedWriter, messages are tagged
+    with the record that produced them and flush returns the ids of records
+    whose messages could not be delivered. flush(wait=False) sends in the
+    background so the caller can overlap other I/O before calling wait().
+    """
+
+    def __init__(self, client=None, max_retries=5, base_delay=0.05, max_workers=4):
+        self.client = client or get_sns_client()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_workers = max_workers
+        self.sent = 0
+        self._pending = {}
+        self._futures = []
+        self._executor = None
+        self._failed = []
+        self._lock = threading.Lock()
+
+    def publish(self, topic_arn, message, attributes=None, subject=None, record_id=None):
+        """Queue a message; message may be a string or a JSON-serializable object"""
+        entry = {
+            'Message': message if isinstance(message, str) else dumps(message)
+        }
+        if attributes:
+            entry['MessageAttributes'] = message_attributes(attributes)
+        if subject:
+            entry['Subject'] = subject[:100]
+        self._pending.setdefault(topic_arn, []).append((entry, record_id))
+
+    def discard(self, record_ids):
+        """Drop queued messages of the given records"""
+        record_ids = set(record_ids)
+        for topic_arn, entries in self._pending.items():
+            self._pending[topic_arn] = [(entry, record_id) for entry, record_id in entries
+                                        if record_id not in record_ids]
+
+    def flush(self, wait=True):
+        """Send queued messages, returning ids of records that failed
+
+        With wait=False the batches are submitted to a thread pool and None
+        is returned; call wait() before the handler returns.
+        """
+        pending, self._pending = self._pending, {}
+        batches = [(topic_arn, batch)
+                   for topic_arn, entries in pending.items()
+                   for batch in self._batches(entries)]
+
+        if wait and not self._futures:
+            for topic_arn, batch in batches:
+                self._send(topic_arn, batch)
+            return self._take_failed()
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._futures.extend(self._executor.submit(self._send, topic_arn, batch)
+                             for topic_arn, batch in batches)
+        return self.wait() if wait else None
+
+    def wait(self):
+        """Wait for a background flush and return ids of records that failed"""
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        return self._take_failed()
+
+    def _take_failed(self):
+        with self._lock:
+            failed, self._failed = self._failed, []
+        return [record_id for record_id in dict.fromkeys(failed) if record_id is not None]
+
+    def _batches(self, entries):
+        batch, size = [], 0
+        for entry, record_id in entries:
+            entry_size = len(entry['Message'].encode('utf-8')) + \
+                len(json.dumps(entry.get('MessageAttributes', {})))
+            if batch and (len(batch) == PUBLISH_BATCH_SIZE or
+                          size + entry_size > PUBLISH_BATCH_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append((entry, record_id))
+            size += entry_size
+        if batch:
+            yield batch
+
+    def _send(self, topic_arn, batch):
+        remaining = {str(i): (entry, record_id) for i, (entry, record_id) in enumerate(batch)}
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                count('PublishBatches')
+                response = self.client.publish_batch(
+                    TopicArn=topic_arn,
+                    PublishBatchRequestEntries=[
+                        dict(entry, Id=entry_id) for entry_id, (entry, _) in remaining.items()
+                    ]
+                )
+            except Exception as e:
+                logger.error(f"Error publishing batch to {topic_arn}: {str(e)}")
+                response = {'Failed': [{'Id': entry_id, 'SenderFault': False}
+                                       for entry_id in remaining]}
+
+            retry, rejected = {}, []
+            for failure in response.get('Failed', []):
+                entry, record_id = remaining[failure['Id']]
+                if failure.get('SenderFault'):
+                    logger.error(f"Rejected message for {topic_arn}: "
+                                 f"{failure.get('Code')} {failure.get('Message')}")
+                    rejected.append(record_id)
+                else:
+                    retry[failure['Id']] = (entry, record_id)
+            with self._lock:
+                self.sent += len(response.get('Successful', []))
+                self._failed.extend(rejected)
+            if not retry:
+                return
+            remaining = retry
+            count('PublishRetries')
+
+            if attempt < self.max_retries:
+                # Exponential backoff with full jitter
+                time.sleep(random.uniform(0, self.base_delay * (2 ** attempt)))
+
+        logger.error(f"Giving up on {len(remaining)} message(s) for {topic_arn} "
+                     f"after {self.max_retries} retries")
+        with self._lock:
+            self._failed.extend(record_id for _, record_id in remaining.values())
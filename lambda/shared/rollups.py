@@ -0,0 +1,424 @@
+import math
+import os
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+
+from shared.codec import dumps, loads
+from shared.utils import BufferedWriter, batch_get_items, get_dynamodb_table, logger
+
+# Bucket widths in seconds, finest first
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+
+ROLLUP_PREFIX = 'rollup#'
+METRICS = ('temperature', 'vibration')
+
+# Devices whose buckets are rebuilt at once
+ROLLUP_WORKERS = int(os.environ.get('ROLLUP_WORKERS', '8'))
+
+# Marks on changed minute buckets, spread over this many partitions
+ROLLUP_MARKER_PREFIX = 'rollupmark#'
+ROLLUP_MARKER_SHARDS = int(os.environ.get('ROLLUP_MARKER_SHARDS', '4'))
+# Held by the running refresh so that overlapping runs skip
+ROLLUP_LEASE_KEY = {'deviceId': 'rolluplease', 'timestamp': 'refresh'}
+
+class Sketch:
+    """Mergeable quantile sketch with bounded relative error (DDSketch-style)
+
+    Values fall into logarithmic bins of ratio gamma, so any quantile is
+    estimated within relative_accuracy and two sketches merge by adding bin
+    counts. The number of bins grows with the log of the value range, not
+    with the number of values.
+    """
+
+    def __init__(self, relative_accuracy=0.02):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+
+    @property
+    def count(self):
+        return self.zeros + sum(self.positive.values()) + sum(self.negative.values())
+
+    def add(self, value, count=1):
+        """Add a value to the sketch"""
+        if value > 0:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.positive[index] = self.positive.get(index, 0) + count
+        elif value < 0:
+            index = math.ceil(math.log(-value) / self.log_gamma)
+            self.negative[index] = self.negative.get(index, 0) + count
+        else:
+            self.zeros += count
+
+    def merge(self, other):
+        """Fold another sketch with the same accuracy into this one"""
+        for index, count in other.positive.items():
+            self.positive[index] = self.positive.get(index, 0) + count
+        for index, count in other.negative.items():
+            self.negative[index] = self.negative.get(index, 0) + count
+        self.zeros += other.zeros
+        return self
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 <= q <= 1), or None when empty"""
+        total = self.count
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        # Ascending order: most negative first, then zeros, then positives
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self.positive))
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def to_dict(self):
+        return {
+            'a': self.relative_accuracy,
+            'p': {str(k): v for k, v in self.positive.items()},
+            'n': {str(k): v for k, v in self.negative.items()},
+            'z': self.zeros
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['a'])
+        sketch.positive = {int(k): v for k, v in data['p'].items()}
+        sketch.negative = {int(k): v for k, v in data['n'].items()}
+        sketch.zeros = data['z']
+        return sketch
+
+class Bucket:
+    """count/sum/min/max and a quantile sketch for one metric over one interval"""
+
+    __slots__ = ('count', 'total', 'low', 'high', 'sketch')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.low = math.inf
+        self.high = -math.inf
+        self.sketch = Sketch()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.low = min(self.low, value)
+        self.high = max(self.high, value)
+        self.sketch.add(value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.low = min(self.low, other.low)
+        self.high = max(self.high, other.high)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def summary(self):
+        """Return count/min/max/mean/p95 for the bucket"""
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'min': self.low,
+            'max': self.high,
+            'mean': self.total / self.count,
+            'p95': self.sketch.quantile(0.95)
+        }
+
+    def to_dict(self):
+        return {'n': self.count, 's': self.total, 'lo': self.low,
+                'hi': self.high, 'q': self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        bucket = cls()
+        bucket.count = data['n']
+        bucket.total = data['s']
+        bucket.low = data['lo']
+        bucket.high = data['hi']
+        bucket.sketch = Sketch.from_dict(data['q'])
+        return bucket
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp into an aware UTC datetime"""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+def bucket_start(moment, resolution):
+    """Floor a datetime to the start of its bucket at a resolution"""
+    width = RESOLUTIONS[resolution]
+    epoch = int(moment.timestamp()) // width * width
+    return datetime.fromtimestamp(epoch, timezone.utc)
+
+def format_start(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%S')
+
+def rollup_key(device_id, resolution, start):
+    """Table key of a device's bucket at a resolution"""
+    return {
+        'deviceId': f"{ROLLUP_PREFIX}{resolution}#{device_id}",
+        'timestamp': format_start(start)
+    }
+
+def decode_metrics(item):
+    """Decode the per-metric buckets stored on a rollup item"""
+    return {metric: Bucket.from_dict(data)
+            for metric, data in loads(item['metrics']).items()}
+
+class RollupTracker:
+    """Mark the minute buckets that received readings, for refresh_rollups
+
+    The ingest path only records which (device, minute) buckets changed, as
+    marker items written in BatchWriteItem chunks once the readings they
+    cover are stored. Marks are grouped by the record that produced them so
+    the marks of failed records are dropped; a retried record marks its
+    buckets again, which is harmless since buckets are rebuilt, not
+    incremented.
+    """
+
+    def __init__(self, table=None):
+        self.table = table
+        self._groups = {}
+
+    def add(self, processed_data, record_id=None):
+        """Mark the minute bucket of a processed reading"""
+        try:
+            moment = parse_timestamp(processed_data['timestamp'])
+        except (KeyError, TypeError, ValueError):
+            return
+        self._groups.setdefault(record_id, set()).add(
+            (processed_data['deviceId'], bucket_start(moment, '1m')))
+
+    def discard(self, record_ids):
+        """Drop the marks of the given records"""
+        for record_id in record_ids:
+            self._groups.pop(record_id, None)
+
+    def flush(self):
+        """Write the marks, returning ids of records whose marks failed"""
+        groups, self._groups = self._groups, {}
+        if not groups:
+            return []
+        writer = BufferedWriter(table=self.table or get_dynamodb_table())
+        # A fresh token per flush lets refresh_rollups keep marks rewritten
+        # while it was rebuilding their buckets
+        token = uuid.uuid4().hex
+        for record_id, marks in groups.items():
+            for device_id, minute in marks:
+                writer.put(dict(marker_key(device_id, minute), token=token), record_id=record_id)
+        return writer.flush()
+
+def marker_key(device_id, minute):
+    """Table key of the mark on a device's minute bucket"""
+    shard = zlib.crc32(device_id.encode('utf-8')) % ROLLUP_MARKER_SHARDS
+    return {
+        'deviceId': f"{ROLLUP_MARKER_PREFIX}{shard}",
+        'timestamp': f"{format_start(minute)}#{device_id}"
+    }
+
+def refresh_rollups(table=None, max_workers=ROLLUP_WORKERS, deadline=None, lease_seconds=300):
+    """Rebuild the rollup buckets of marked minutes, returning counts of devices
+
+    Each marked 1m bucket is recomputed from the raw readings of its minute,
+    then the 1h and 1d buckets above it from the stored buckets one level
+    down, and written whole. Rebuilding is idempotent, so a device that
+    fails or is past the deadline (epoch seconds) keeps its marks and is
+    rebuilt by the next run; a mark rewritten meanwhile is kept as well.
+    A lease keeps runs that overlap from writing buckets over each other.
+    """
+    table = table or get_dynamodb_table()
+    owner = uuid.uuid4().hex
+    if not _acquire_lease(table, owner, lease_seconds):
+        return {'devices': 0, 'failed': 0, 'deferred': 0, 'leased': False}
+
+    try:
+        marks = {}
+        for shard in range(ROLLUP_MARKER_SHARDS):
+            for item in _query_all(table, KeyConditionExpression=Key('deviceId').eq(
+                    f"{ROLLUP_MARKER_PREFIX}{shard}"), ConsistentRead=True):
+                minute, _, device_id = item['timestamp'].partition('#')
+                marks.setdefault(device_id, {})[
+                    (item['deviceId'], item['timestamp'])] = (minute, item['token'])
+        if not marks:
+            return {'devices': 0, 'failed': 0, 'deferred': 0, 'leased': True}
+
+        # schema imports this module for parse_timestamp
+        from shared.schema import REGISTRY_SORT_KEY, write_shards
+        registrations = {
+            item['deviceId']: item
+            for item in batch_get_items(
+                [{'deviceId': d, 'timestamp': REGISTRY_SORT_KEY} for d in marks], table=table)
+        }
+
+        def refresh(device_id):
+            if deadline is not None and time.time() > deadline:
+                return None
+            try:
+                _refresh_device(table, device_id, marks[device_id],
+                                write_shards(registrations.get(device_id)))
+                return True
+            except Exception as e:
+                logger.error(f"Error refreshing rollups of {device_id}: {str(e)}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(marks)))) as pool:
+            outcomes = list(pool.map(refresh, marks))
+        return {
+            'devices': outcomes.count(True),
+            'failed': outcomes.count(False),
+            'deferred': outcomes.count(None),
+            'leased': True
+        }
+    finally:
+        _release_lease(table, owner)
+
+def _refresh_device(table, device_id, marks, shards):
+    from shared.schema import decode_reading, epoch_millis, reading_partition
+
+    minutes = sorted({parse_timestamp(minute) for minute, _ in marks.values()})
+    buckets = {minute: {} for minute in minutes}
+    # One query per day and write shard, spanning the marked minutes
+    for day, group in groupby(minutes, key=lambda minute: minute.strftime('%Y%m%d')):
+        group = list(group)
+        lower = f"{epoch_millis(group[0]):013d}"
+        upper = f"{epoch_millis(group[-1]) + 59999:013d}"
+        for shard in range(shards):
+            for item in _query_all(
+                    table, ConsistentRead=True,
+                    KeyConditionExpression=Key('deviceId').eq(
+                        reading_partition(device_id, day, shard)) &
+                    Key('timestamp').between(lower, upper)):
+                metrics = buckets.get(bucket_start(
+                    datetime.fromtimestamp(int(item['timestamp']) / 1000, timezone.utc), '1m'))
+                if metrics is None:
+                    continue
+                reading = decode_reading(item)
+                for metric in METRICS:
+                    value = (reading.get(metric) or {}).get('value')
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        metrics.setdefault(metric, Bucket()).add(value)
+
+    writer = BufferedWriter(table=table)
+    for minute, metrics in buckets.items():
+        writer.put(rollup_item(device_id, '1m', minute, metrics), record_id=device_id)
+    # Coarser buckets are rebuilt from the finer ones just written
+    for resolution, finer in (('1h', '1m'), ('1d', '1h')):
+        if writer.flush():
+            raise RuntimeError(f"{finer} buckets were not written")
+        width = timedelta(seconds=RESOLUTIONS[resolution])
+        for start in sorted({bucket_start(minute, resolution) for minute in minutes}):
+            merged = {}
+            for item in _query_all(
+                    table, ConsistentRead=True,
+                    KeyConditionExpression=Key('deviceId').eq(
+                        f"{ROLLUP_PREFIX}{finer}#{device_id}") &
+                    Key('timestamp').between(format_start(start),
+                                             format_start(start + width - timedelta(seconds=1)))):
+                for metric, bucket in decode_metrics(item).items():
+                    merged[metric] = merged[metric].merge(bucket) if metric in merged else bucket
+            writer.put(rollup_item(device_id, resolution, start, merged), record_id=device_id)
+    if writer.flush():
+        raise RuntimeError('1d buckets were not written')
+
+    for key, (_, token) in marks.items():
+        try:
+            table.delete_item(Key=dict(zip(('deviceId', 'timestamp'), key)),
+                              ConditionExpression=Attr('token').eq(token))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+def rollup_item(device_id, resolution, start, buckets):
+    """Table item of a device's bucket at a resolution"""
+    return dict(rollup_key(device_id, resolution, start), **{
+        'metrics': dumps({metric: bucket.to_dict() for metric, bucket in buckets.items()}),
+        'count': sum(bucket.count for bucket in buckets.values()),
+        'updatedAt': datetime.utcnow().isoformat()
+    })
+
+def _acquire_lease(table, owner, seconds):
+    now = int(time.time())
+    try:
+        table.put_item(
+            Item=dict(ROLLUP_LEASE_KEY, owner=owner, expiresAt=now + int(seconds)),
+            ConditionExpression=Attr('expiresAt').not_exists() | Attr('expiresAt').lt(now)
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+
+def _release_lease(table, owner):
+    try:
+        table.delete_item(Key=ROLLUP_LEASE_KEY, ConditionExpression=Attr('owner').eq(owner))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            logger.error(f"Error releasing rollup lease: {str(e)}")
+
+def _query_all(table, **query):
+    while True:
+        response = table.query(**query)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def plan_range(start, end):
+    """Cover [start, end) with as few aligned buckets as possible
+
+    Returns (resolution, first_start, last_start) ranges: minute buckets up to
+    the first hour boundary, hour buckets up to the first day boundary, whole
+    days, then hours and minutes for the tail.
+    """
+    start = bucket_start(start + timedelta(seconds=59), '1m')
+    end = bucket_start(end, '1m')
+    ranges = []
+
+    def cover(resolution, lo, hi):
+        if hi > lo:
+            width = timedelta(seconds=RESOLUTIONS[resolution])
+            ranges.append((resolution, lo, hi - width))
+
+    hour_lo = bucket_start(start + timedelta(seconds=3599), '1h')
+    hour_hi = bucket_start(end, '1h')
+    if hour_lo >= hour_hi:
+        cover('1m', start, end)
+        return ranges
+
+    day_lo = bucket_start(hour_lo + timedelta(seconds=86399), '1d')
+    day_hi = bucket_start(hour_hi, '1d')
+    cover('1m', start, hour_lo)
+    if day_lo >= day_hi:
+        cover('1h', hour_lo, hour_hi)
+    else:
+        cover('1h', hour_lo, day_lo)
+        cover('1d', day_lo, day_hi)
+        cover('1h', day_hi, hour_hi)
+    cover('1m', hour_hi, end)
+    return ranges
@@ -0,0 +1,219 @@
+"""Key layout of DeviceTable
+
+Every entity lives in the one table, keyed by deviceId (partition) and
+timestamp (sort), both strings. Per-device records that are written at a
+low rate share the device's own partition; high-volume and cross-device
+entities carry a prefix in the partition key, so they never collide with a
+device id and spread over partitions of their own:
+
+    entity              deviceId                            timestamp
+    registration        <device>                            device
+    detector state      <device>                            state#anomaly
+    alert               <device>                            alert#<raised iso>#<alertId>
+    prediction          <device>                            prediction#<iso>
+    image analysis      <camera>                            analysis#<imageKey>
+    reading             reading#<device>#<yyyymmdd>#<shard> <epoch ms, 13 digits>
+    rollup              rollup#<resolution>#<device>        <bucket start>
+    rollup mark         rollupmark#<shard>                  <minute start>#<device>
+    rollup lease        rolluplease                         refresh
+    alert state         alertstate#<device>                 <alert type>
+    alert digest        alertdigest#pending                 <window end>#<alertId>
+    completion marker   dedupe#<record key>                 done
+
+Readings are the only entity written per message, so each device's
+readings are bucketed per UTC day and, for chatty devices, sharded by
+timestamp over writeShards partitions (set on the registration item,
+default READING_WRITE_SHARDS). A redelivered reading maps to the same key.
+Shard counts may be raised at any time; lowering one hides the readings
+already written to the dropped shards.
+
+Open alerts (status new or acknowledged) also carry openSeverity,
+openDeviceId and openedAt (<raised iso>#<alertId>); closing an alert
+removes them, so the two alert indexes hold only open alerts and stay
+small however long the alert history grows.
+
+Access patterns:
+
+    device list           device-index GSI: entity = 'device'
+    open alerts           open-alerts GSI: openSeverity = <severity>, one
+                          query per severity merged by openedAt
+    open alerts of a      open-device-alerts GSI: openDeviceId = <device>,
+    device                openedAt in a range
+    alert history         Query <device> between alert#<from> and alert#<to>
+    device detail         GetItem <device> / device
+    readings in a range   Query reading#<device>#<day>#<shard> per day and
+                          shard, merged by timestamp
+    metric summaries      Query rollup#<resolution>#<device> between starts
+    changed buckets       Query rollupmark#<shard>, one per shard
+    alerts, analyses,     Query <device> with begins_with alert#,
+    predictions           analysis# or prediction#
+
+Only registration items carry the entity attribute, so device-index holds
+exactly one small item per device.
+
+Reading items are converted with reading_codec, which turns the float
+metric values into the Decimals DynamoDB accepts and back.
+"""
+import math
+import numbers
+import os
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from shared.codec import NUMBER, ItemCodec
+from shared.rollups import parse_timestamp
+
+READING_PREFIX = 'reading#'
+REGISTRY_SORT_KEY = 'device'
+DEVICE_ENTITY = 'device'
+DEVICE_INDEX = 'device-index'
+OPEN_ALERTS_INDEX = 'open-alerts'
+DEVICE_ALERTS_INDEX = 'open-device-alerts'
+
+# (partition, sort) attributes of each global secondary index
+INDEXES = {
+    DEVICE_INDEX: ('entity', 'deviceId'),
+    OPEN_ALERTS_INDEX: ('openSeverity', 'openedAt'),
+    DEVICE_ALERTS_INDEX: ('openDeviceId', 'openedAt')
+}
+
+ALERT_PREFIX = 'alert#'
+SEVERITIES = ('info', 'warning', 'critical')
+OPEN_STATUSES = ('new', 'acknowledged')
+ALERT_STATUSES = OPEN_STATUSES + ('resolved',)
+# Attributes that place an alert in the open alert indexes
+OPEN_ALERT_ATTRIBUTES = ('openSeverity', 'openDeviceId', 'openedAt')
+
+# Partitions each device's readings of a day are spread over by default
+READING_WRITE_SHARDS = int(os.environ.get('READING_WRITE_SHARDS', '1'))
+MAX_WRITE_SHARDS = 32
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Numeric timestamps from here on are milliseconds, below it seconds; as
+# seconds it is the year 5138, as milliseconds March 1973
+EPOCH_MILLIS_MIN = 10 ** 11
+
+reading_codec = ItemCodec({
+    metric: {'value': NUMBER, 'threshold': NUMBER}
+    for metric in ('temperature', 'vibration')
+})
+
+def epoch_millis(timestamp):
+    """Convert a timestamp to integer milliseconds since the epoch
+
+    Accepts ISO 8601 strings, datetimes, and epoch seconds or milliseconds
+    as numbers (see EPOCH_MILLIS_MIN). Raises ValueError for anything else.
+    """
+    if isinstance(timestamp, str):
+        moment = parse_timestamp(timestamp)
+    elif isinstance(timestamp, datetime):
+        moment = timestamp
+    elif isinstance(timestamp, numbers.Real) and not isinstance(timestamp, bool):
+        if not math.isfinite(timestamp):
+            raise ValueError(f"Invalid timestamp: {timestamp!r}")
+        return round(timestamp if abs(timestamp) >= EPOCH_MILLIS_MIN else timestamp * 1000)
+    else:
+        raise ValueError(f"Timestamp must be ISO 8601 or epoch seconds or milliseconds, "
+                         f"got {timestamp!r}")
+    return (moment - EPOCH) // timedelta(milliseconds=1)
+
+def reading_timestamp(timestamp):
+    """ISO 8601 form of a reading's timestamp, converting epoch numbers"""
+    if isinstance(timestamp, str):
+        return timestamp
+    return format_millis(epoch_millis(timestamp))
+
+def format_millis(millis):
+    """Convert epoch milliseconds back to an ISO 8601 UTC timestamp"""
+    moment = datetime.fromtimestamp(int(millis) / 1000, timezone.utc)
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.') + f"{int(millis) % 1000:03d}Z"
+
+def write_shards(item=None):
+    """Get the number of reading partitions per day from a registration item"""
+    shards = (item or {}).get('writeShards') or READING_WRITE_SHARDS
+    return max(1, min(int(shards), MAX_WRITE_SHARDS))
+
+def reading_partition(device_id, day, shard):
+    return f"{READING_PREFIX}{device_id}#{day}#{shard}"
+
+def reading_key(device_id, timestamp, shards=1):
+    """Table key of a reading
+
+    The shard is derived from the timestamp, so the key of a reading is
+    stable across redeliveries.
+    """
+    millis = epoch_millis(timestamp)
+    day = datetime.fromtimestamp(millis // 1000, timezone.utc).strftime('%Y%m%d')
+    sort_key = f"{millis:013d}"
+    # Hashed, since devices often report on whole seconds
+    shard = zlib.crc32(sort_key.encode('ascii')) % shards if shards > 1 else 0
+    return {
+        'deviceId': reading_partition(device_id, day, shard),
+        'timestamp': sort_key
+    }
+
+def reading_item(data, shards=1):
+    """Turn a processed reading into its table item"""
+    return reading_codec.encode(data, **reading_key(data['deviceId'], data['timestamp'], shards))
+
+def decode_reading(item):
+    """Turn a reading item back into a processed reading"""
+    return reading_codec.decode(item, deviceId=device_of(item['deviceId']),
+                                timestamp=format_millis(item['timestamp']))
+
+def reading_days(start, end):
+    """List the yyyymmdd buckets that hold readings in [start, end]"""
+    day = start.astimezone(timezone.utc).date()
+    last = end.astimezone(timezone.utc).date()
+    days = []
+    while day <= last:
+        days.append(day.strftime('%Y%m%d'))
+        day += timedelta(days=1)
+    return days
+
+def device_of(partition_key):
+    """Get the device id a partition key belongs to, None for shared partitions"""
+    prefix, sep, rest = partition_key.partition('#')
+    if not sep:
+        return partition_key
+    if prefix == 'reading':
+        return rest.rsplit('#', 2)[0]
+    if prefix == 'rollup':
+        return rest.partition('#')[2]
+    if prefix == 'alertstate':
+        return rest
+    return None
+
+def registration_item(device_id, device_type=None, first_seen=None):
+    """Registration item of a device, listed by the device-index GSI"""
+    item = {
+        'deviceId': device_id,
+        'timestamp': REGISTRY_SORT_KEY,
+        'entity': DEVICE_ENTITY,
+        'registeredAt': first_seen or datetime.utcnow().isoformat()
+    }
+    if device_type:
+        item['deviceType'] = device_type
+    return item
+
+def alert_time(moment):
+    """Format a moment like the raisedAt of alerts, for range bounds"""
+    return moment.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
+
+def alert_item(alert):
+    """Table item of an alert, in the open alert indexes while it is open"""
+    item = dict(alert, **{
+        'timestamp': f"{ALERT_PREFIX}{alert['timestamp']}#{alert['alertId']}",
+        'raisedAt': alert['timestamp']
+    })
+    if item.get('status') in OPEN_STATUSES:
+        item.update(open_alert_attributes(item))
+    return item
+
+def open_alert_attributes(item):
+    """Index attributes of an open alert, from its table item"""
+    return {
+        'openSeverity': item['severity'],
+        'openDeviceId': item['deviceId'],
+        'openedAt': item['timestamp'][len(ALERT_PREFIX):]
+    }
@@ -1,30 +1,49 @@
-import json
-import boto3
 import os
+import random
+import time
 from datetime import datetime
 import logging
+from botocore.exceptions import ClientError
+from shared import clients
+from shared.codec import dumps, to_item
+from shared.metrics import count
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# BatchWriteItem accepts at most 25 put/delete requests per call
+BATCH_WRITE_SIZE = 25
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
+# Errors that fail a whole chunk however it is sent
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                     'RequestLimitExceeded')
+
 def store_processed_data(data):
-    """Store processed data in DynamoDB"""
+    """Store processed data in DynamoDB, with floats converted to Decimal"""
     try:
         table = get_dynamodb_table()
-        table.put_item(Item=data)
+        table.put_item(Item=to_item(data))
     except Exception as e:
         logger.error(f"Error storing data: {str(e)}")
         raise
 
-def trigger_anomaly_processing(data):
-    """Trigger anomaly processing workflow"""
+def trigger_anomaly_processing(data, dispatcher=None, record_id=None):
+    """Trigger anomaly processing workflow
+
+    With a NotificationDispatcher the message is queued for a batched
+    publish and failures are reported by its flush.
+    """
+    topic_arn = os.environ['ANOMALY_TOPIC_ARN']
+    if dispatcher is not None:
+        dispatcher.publish(topic_arn, data, attributes={'type': 'anomaly'},
+                           record_id=record_id)
+        return
+    
     try:
-        sns = boto3.client('sns')
-        topic_arn = os.environ['ANOMALY_TOPIC_ARN']
-        
-        sns.publish(
+        get_sns_client().publish(
             TopicArn=topic_arn,
-            Message=json.dumps(data),
+            Message=dumps(data),
             MessageAttributes={
                 'type': {
                     'DataType': 'String',
@@ -37,17 +56,156 @@ def trigger_anomaly_processing(data):
         raise
 
 def get_dynamodb_table():
-    """Get DynamoDB table reference"""
-    dynamodb = boto3.resource('dynamodb')
-    return dynamodb.Table(os.environ['DYNAMODB_TABLE'])
-
-def calculate_severity(data):
-    """Calculate alert severity"""
-    if data.get('temperature', {}).get('status') == 'critical' or \
-       data.get('vibration', {}).get('status') == 'critical':
+    """Get DynamoDB table reference, reused across warm invocations"""
+    return clients.table()
+
+def get_sns_client():
+    """Get an SNS client, reused across warm invocations"""
+    return clients.client('sns')
+
+def batch_get_items(keys, table=None, max_retries=5, base_delay=0.05):
+    """Fetch items by key with BatchGetItem, retrying unprocessed keys"""
+    table = table or get_dynamodb_table()
+    client = table.meta.client
+    table_name = table.name
+    items = []
+
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {table_name: {'Keys': keys[start:start + BATCH_GET_SIZE]}}
+        for attempt in range(max_retries + 1):
+            response = client.batch_get_item(RequestItems=request)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+            unprocessed = response.get('UnprocessedKeys', {})
+            if not unprocessed.get(table_name):
+                break
+            request = unprocessed
+            count('DynamoDBRetries')
+            if attempt < max_retries:
+                time.sleep(random.uniform(0, base_delay * (2 ** attempt)))
+        else:
+            logger.error(
+                f"Giving up on {len(request[table_name]['Keys'])} unprocessed keys "
+                f"after {max_retries} retries"
+            )
+
+    return items
+
+class BufferedWriter:
+    """Buffer DynamoDB puts and write them in BatchWriteItem chunks
+
+    Items are tagged with the id of the record that produced them so that
+    callers can report per-record failures instead of failing the batch.
+    """
+
+    def __init__(self, table=None, key_names=('deviceId', 'timestamp'),
+                 max_retries=5, base_delay=0.05):
+        self.table = table or get_dynamodb_table()
+        self.key_names = key_names
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self._pending = {}
+        self._failed = []
+
+    def put(self, item, record_id=None):
+        """Queue an item, writing a chunk once BATCH_WRITE_SIZE is reached"""
+        key = self._key(item)
+        # BatchWriteItem rejects duplicate keys in one request; last write wins
+        if key in self._pending:
+            _, record_ids = self._pending.pop(key)
+        else:
+            record_ids = []
+        if record_id is not None:
+            record_ids.append(record_id)
+        self._pending[key] = (item, record_ids)
+
+        if len(self._pending) >= BATCH_WRITE_SIZE:
+            self._write_pending()
+
+    def flush(self):
+        """Write any buffered items and return ids of records that failed"""
+        if self._pending:
+            self._write_pending()
+        failed, self._failed = self._failed, []
+        return list(dict.fromkeys(failed))
+
+    def _key(self, item):
+        return tuple(item.get(name) for name in self.key_names)
+
+    def _write_pending(self):
+        chunk, self._pending = self._pending, {}
+        table_name = self.table.name
+        request = {
+            table_name: [{'PutRequest': {'Item': item}} for item, _ in chunk.values()]
+        }
+        client = self.table.meta.client
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                count('BatchWrites')
+                response = client.batch_write_item(RequestItems=request)
+            except ClientError as e:
+                if e.response['Error']['Code'] in THROTTLING_ERRORS:
+                    logger.error(f"Error writing batch: {str(e)}")
+                    self._mark_failed(chunk, request.get(table_name, []))
+                else:
+                    # One invalid item rejects the whole request; find it
+                    logger.warning(f"Batch write rejected, writing items singly: {str(e)}")
+                    self._put_each(chunk, request.get(table_name, []))
+                return
+            except Exception as e:
+                logger.error(f"Error writing batch: {str(e)}")
+                self._mark_failed(chunk, request.get(table_name, []))
+                return
+
+            unprocessed = response.get('UnprocessedItems', {})
+            if not unprocessed.get(table_name):
+                return
+            request = unprocessed
+            count('DynamoDBRetries')
+
+            if attempt < self.max_retries:
+                # Exponential backoff with full jitter
+                time.sleep(random.uniform(0, self.base_delay * (2 ** attempt)))
+
+        logger.error(
+            f"Giving up on {len(request[table_name])} unprocessed items "
+            f"after {self.max_retries} retries"
+        )
+        self._mark_failed(chunk, request[table_name])
+
+    def _put_each(self, chunk, requests):
+        for entry in requests:
+            try:
+                self.table.put_item(Item=entry['PutRequest']['Item'])
+            except Exception as e:
+                logger.error(f"Error writing item: {str(e)}")
+                self._mark_failed(chunk, [entry])
+
+    def _mark_failed(self, chunk, requests):
+        for entry in requests:
+            key = self._key(entry['PutRequest']['Item'])
+            if key in chunk:
+                self._failed.extend(chunk[key][1])
+
+def calculate_severity(data, limits=None):
+    """Calculate alert severity
+
+    limits optionally maps metrics to the device's (warning, critical)
+    thresholds; metrics with limits are classified from their value instead
+    of the status reported with the reading.
+    """
+    statuses = set()
+    for metric in ('temperature', 'vibration'):
+        reading = data.get(metric, {})
+        status = reading.get('status')
+        if limits and metric in limits and reading.get('value') is not None:
+            warning, critical = limits[metric]
+            value = float(reading['value'])
+            status = 'critical' if value > critical else 'warning' if value > warning else 'normal'
+        statuses.add(status)
+    if 'critical' in statuses:
         return 'critical'
-    elif data.get('temperature', {}).get('status') == 'warning' or \
-         data.get('vibration', {}).get('status') == 'warning':
+    elif 'warning' in statuses:
         return 'warning'
     return 'info'
 
@@ -79,5 +237,5 @@ def format_response(status_code, body):
             'Content-Type': 'application/json',
             'Access-Control-Allow-Origin': '*'
         },
-        'body': json.dumps(body)
+        'body': dumps(body)
     }
\ No newline at end of file
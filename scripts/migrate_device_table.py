@@ -0,0 +1,221 @@
+"""Move DeviceTable items to the key layout in lambda/shared/schema.py
+
+Usage:
+    python scripts/migrate_device_table.py --table NAME [--segments N] [--rate N]
+        [--register] [--delete-source] [--dry-run]
+
+Scans the table in --segments parallel segments and rewrites what the
+handlers no longer read:
+
+    legacy readings       <device> / <iso timestamp>, moved to
+                          reading#<device>#<yyyymmdd>#<shard> / <epoch ms>
+                          with the device's registered writeShards
+    legacy registrations  items with type = 'device', rewritten as
+                          <device> / device with entity = 'device' so the
+                          device-index GSI lists them
+    open alerts           alerts with status new or acknowledged, given the
+                          attributes of the open alert indexes
+
+--register also creates registration items for devices that have readings
+but none, as the preprocessor does for new devices. Writes are limited to
+--rate items per second across all segments, so the backfill can run next
+to live traffic; keep it below the table's spare write capacity. A reading
+is deleted from its old key with --delete-source only after its new item
+was written, and keys are deterministic, so an interrupted run can simply
+be started again. --dry-run counts what would change without writing.
+A JSON summary is printed at the end.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from shared import clients
+from shared.schema import (ALERT_PREFIX, DEVICE_ENTITY, OPEN_STATUSES, REGISTRY_SORT_KEY,
+                           open_alert_attributes, reading_item, registration_item,
+                           write_shards)
+from shared.utils import BufferedWriter, batch_get_items, logger
+
+# Sort keys of readings written before the redesign: ISO 8601 timestamps
+LEGACY_READING = re.compile(r'^\d{4}-\d{2}-\d{2}T')
+
+class RateLimiter:
+    """A token bucket shared by the segment workers"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count):
+        """Take count tokens, sleeping off any shortfall"""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+class Migration:
+    def __init__(self, table, args):
+        self.table = table
+        self.args = args
+        self.limiter = RateLimiter(args.rate)
+        self.registry = {}
+        self.lock = threading.Lock()
+        self.totals = dict.fromkeys(
+            ('scanned', 'readings', 'registrations', 'alerts', 'registered', 'deleted',
+             'failed'), 0)
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.totals[name] += value
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.args.segments) as pool:
+            list(pool.map(self.segment, range(self.args.segments)))
+        return self.totals
+
+    def segment(self, segment):
+        """Scan one segment page by page and migrate each page"""
+        request = {'Limit': self.args.page_size, 'Segment': segment,
+                   'TotalSegments': self.args.segments}
+        while True:
+            response = self.table.scan(**request)
+            self.migrate_page(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return
+            request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def migrate_page(self, items):
+        readings = [item for item in items if is_legacy_reading(item)]
+        registrations = [item for item in items if is_legacy_registration(item)]
+        alerts = [item for item in items if is_unindexed_alert(item)]
+        self.add(scanned=len(items), readings=len(readings),
+                 registrations=len(registrations), alerts=len(alerts))
+        if self.args.dry_run or not (readings or registrations or alerts):
+            return
+
+        shards = self.device_shards({item['deviceId'] for item in readings})
+        self.limiter.acquire(len(readings) + len(registrations) + len(alerts))
+        writer = BufferedWriter(self.table)
+        sources = {}
+        for item in readings:
+            source = (item['deviceId'], item['timestamp'])
+            sources[source] = item
+            writer.put(reading_item(item, shards[item['deviceId']]), record_id=source)
+        for item in registrations:
+            source = (item['deviceId'], item['timestamp'])
+            if item['timestamp'] != REGISTRY_SORT_KEY:
+                sources[source] = item
+            writer.put(registration(item), record_id=source)
+        failed = set(writer.flush())
+        self.add(failed=len(failed))
+        for item in alerts:
+            self.index_alert(item)
+
+        if self.args.delete_source:
+            moved = [source for source in sources if source not in failed]
+            self.limiter.acquire(len(moved))
+            with self.table.batch_writer() as batch:
+                for device_id, timestamp in moved:
+                    batch.delete_item(Key={'deviceId': device_id, 'timestamp': timestamp})
+            self.add(deleted=len(moved))
+
+    def device_shards(self, device_ids):
+        """Get writeShards per device, registering devices without an item"""
+        with self.lock:
+            missing = [d for d in device_ids if d not in self.registry]
+        found = {item['deviceId']: item for item in batch_get_items(
+            [{'deviceId': d, 'timestamp': REGISTRY_SORT_KEY} for d in missing],
+            table=self.table)} if missing else {}
+        for device_id in missing:
+            item = found.get(device_id)
+            if item is None and self.args.register:
+                self.register(device_id)
+            with self.lock:
+                self.registry[device_id] = write_shards(item)
+        return {d: self.registry[d] for d in device_ids}
+
+    def index_alert(self, item):
+        """Add the open alert index attributes unless the alert closed meanwhile"""
+        attributes = open_alert_attributes(item)
+        try:
+            self.table.update_item(
+                Key={'deviceId': item['deviceId'], 'timestamp': item['timestamp']},
+                UpdateExpression='SET ' + ', '.join(f"{name} = :{name}" for name in attributes),
+                ExpressionAttributeValues={f":{name}": value
+                                           for name, value in attributes.items()},
+                ConditionExpression=Attr('status').is_in(list(OPEN_STATUSES))
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                logger.error(f"Error indexing alert {item['timestamp']}: {str(e)}")
+                self.add(failed=1)
+
+    def register(self, device_id):
+        try:
+            self.table.put_item(Item=registration_item(device_id),
+                                ConditionExpression=Attr('deviceId').not_exists())
+            self.add(registered=1)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                logger.error(f"Error registering {device_id}: {str(e)}")
+
+def is_legacy_reading(item):
+    return '#' not in item['deviceId'] and item.get('type') != 'device' and \
+        bool(LEGACY_READING.match(item['timestamp']))
+
+def is_legacy_registration(item):
+    if item['timestamp'] == REGISTRY_SORT_KEY:
+        return item.get('entity') != DEVICE_ENTITY
+    return item.get('type') == 'device'
+
+def is_unindexed_alert(item):
+    return item['timestamp'].startswith(ALERT_PREFIX) and \
+        item.get('status') in OPEN_STATUSES and 'openedAt' not in item
+
+def registration(item):
+    """Rewrite a legacy registration item, keeping its attributes"""
+    migrated = {name: value for name, value in item.items() if name != 'type'}
+    first_seen = item.get('registeredAt')
+    if first_seen is None and item['timestamp'] != REGISTRY_SORT_KEY:
+        first_seen = item['timestamp']
+    migrated.update(registration_item(item['deviceId'], item.get('deviceType'), first_seen))
+    return migrated
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--table', default=os.environ.get('DYNAMODB_TABLE'),
+                        required='DYNAMODB_TABLE' not in os.environ)
+    parser.add_argument('--segments', type=int, default=4)
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=500,
+                        help='items written per second, 0 for no limit')
+    parser.add_argument('--register', action='store_true')
+    parser.add_argument('--delete-source', action='store_true')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    totals = Migration(clients.table(args.table), args).run()
+    totals['seconds'] = round(time.perf_counter() - start, 1)
+    print(json.dumps(totals, indent=2))
+    return 1 if totals['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAMBDA = os.path.join(ROOT, 'lambda')
+
+# Handlers import shared from the layer and their own modules from the
+# function directory; the stubs live with the benchmarks
+sys.path[:0] = [LAMBDA, os.path.join(ROOT, 'benchmarks')] + [
+    os.path.join(LAMBDA, name) for name in sorted(os.listdir(LAMBDA))
+    if name != 'shared' and os.path.isdir(os.path.join(LAMBDA, name))
+]
+
+ENVIRONMENT = {
+    'DYNAMODB_TABLE': 'test',
+    'ANOMALY_TOPIC_ARN': 'arn:aws:sns:us-east-1:000000000000:anomalies',
+    'ALERT_TOPIC': 'arn:aws:sns:us-east-1:000000000000:alerts',
+    'SAGEMAKER_ENDPOINT': 'test-endpoint',
+    'EXPORT_ENABLED': 'false',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test'
+}
+for name, value in ENVIRONMENT.items():
+    os.environ.setdefault(name, value)
+
+@pytest.fixture
+def stubs():
+    """In-process AWS stubs registered with shared.clients"""
+    import stubs as stub_module
+    from shared import clients
+
+    installed = stub_module.install(table_name=os.environ['DYNAMODB_TABLE'])
+    yield installed
+    clients.reset()
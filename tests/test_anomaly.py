@@ -0,0 +1,32 @@
+import json
+import uuid
+
+import preprocessor
+from anomaly import FIELDS, RollingDetector
+
+def test_missing_metrics_leave_their_statistics_alone():
+    detector = RollingDetector(min_samples=3)
+    for value in (70.0, 71.0, 70.5):
+        detector.update('device-1', (value, 0.3))
+    state = bytes(detector._state('device-1'))
+    assert detector.update('device-1', (None, float('nan'))) == []
+    assert bytes(detector._state('device-1')) == state
+
+def test_missing_metrics_are_stored_as_missing(stubs, monkeypatch):
+    detector = RollingDetector(min_samples=3)
+    monkeypatch.setattr(preprocessor, 'detector', detector)
+    readings = [{'device_id': 'device-1', 'timestamp': f"2024-05-01T00:0{i}:00",
+                 'temperature': 70.0 + i, 'vibration': 0.3} for i in range(4)]
+    readings.append({'device_id': 'device-1', 'timestamp': '2024-05-01T00:05:00',
+                     'temperature': 72.0})
+    record = {'eventSource': 'aws:sqs', 'messageId': str(uuid.uuid4()),
+              'body': json.dumps(readings)}
+    preprocessor.handler({'Records': [record]}, None)
+
+    state = detector._state('device-1')
+    assert state[0] == 5 and state[FIELDS] == 4
+    items = {item['timestamp']: item for item in stubs.table.scan()['Items']
+             if item['deviceId'].startswith('reading#')}
+    last = items[max(items)]
+    assert last['vibration']['value'] is None
+    assert last['vibration']['status'] == 'normal'
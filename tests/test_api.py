@@ -0,0 +1,100 @@
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import api
+from shared.schema import alert_item, reading_item, registration_item
+
+START = datetime(2024, 5, 1, 22, tzinfo=timezone.utc)
+
+@pytest.fixture
+def table(stubs):
+    api.response_cache.clear()
+    api.shard_cache.clear()
+    for device in range(7):
+        stubs.table.add_item(registration_item(f"device-{device}", 'press'))
+    # Readings on both sides of midnight, over the device's write shards
+    stubs.table.add_item(dict(registration_item('line-1', 'press'), writeShards=3))
+    for minute in range(0, 240, 10):
+        moment = START + timedelta(minutes=minute)
+        stubs.table.add_item(reading_item({
+            'deviceId': 'line-1', 'timestamp': moment.isoformat(),
+            'temperature': {'value': 70.0 + minute / 100, 'threshold': 80.0, 'status': 'normal'},
+            'vibration': {'value': 0.3, 'threshold': 0.8, 'status': 'normal'}
+        }, shards=3))
+    for i in range(5):
+        stubs.table.add_item(alert_item({
+            'alertId': uuid.uuid4().hex, 'timestamp': f"2024-05-01T0{i}:00:00",
+            'deviceId': 'line-1', 'type': 'sensor', 'severity': 'critical', 'status': 'new'
+        }))
+    yield stubs.table
+    api.response_cache.clear()
+
+def get(path, **params):
+    response = api.handler({'httpMethod': 'GET', 'path': path,
+                            'queryStringParameters': params}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+def pages(path, **params):
+    """Follow nextToken through every page, returning the items in order"""
+    items, token = [], None
+    while True:
+        status, body = get(path, **dict(params, **({'nextToken': token} if token else {})))
+        assert status == 200, body
+        items.extend(body['items'])
+        token = body.get('nextToken')
+        if token is None:
+            return items
+
+def test_device_pages_cover_every_device_once(table):
+    items = pages('/devices', limit='3')
+    assert sorted(item['deviceId'] for item in items) == \
+        sorted([f"device-{d}" for d in range(7)] + ['line-1'])
+
+def test_raw_reading_pages_are_ordered_across_days_and_shards(table):
+    items = pages('/metrics', deviceId='line-1', resolution='raw', limit='5',
+                  **{'from': '2024-05-01T22:00:00', 'to': '2024-05-02T02:00:00'})
+    timestamps = [item['timestamp'] for item in items]
+    assert len(timestamps) == 24
+    assert timestamps == sorted(timestamps)
+    assert timestamps[0] == '2024-05-01T22:00:00.000Z'
+
+def test_alert_pages_in_both_orders(table):
+    ascending = pages('/alerts', deviceId='line-1', limit='2')
+    descending = pages('/alerts', deviceId='line-1', limit='2', order='desc')
+    assert len(ascending) == 5
+    assert descending == ascending[::-1]
+
+def test_open_alert_pages_merge_severities(table):
+    items = pages('/alerts', limit='2')
+    assert [item['raisedAt'] for item in items] == [f"2024-05-01T0{i}:00:00" for i in range(5)]
+
+@pytest.mark.parametrize('path, params', [
+    ('/alerts', {'deviceId': 'line-1'}),
+    ('/devices', {}),
+    ('/metrics', {'deviceId': 'device-1', 'resolution': 'raw',
+                  'from': '2024-05-01T22:00:00', 'to': '2024-05-02T02:00:00'}),
+])
+def test_cursor_of_another_query_is_rejected(table, path, params):
+    _, body = get('/metrics', deviceId='line-1', resolution='raw', limit='5',
+                  **{'from': '2024-05-01T22:00:00', 'to': '2024-05-02T02:00:00'})
+    status, body = get(path, nextToken=body['nextToken'], **params)
+    assert status == 400
+    assert 'nextToken' in body['error']
+
+def test_garbled_cursor_is_rejected(table):
+    status, _ = get('/devices', nextToken='not-a-cursor')
+    assert status == 400
+
+def test_alert_update_is_served_immediately(table):
+    _, body = get('/alerts', deviceId='line-1', status='open')
+    assert len(body['items']) == 5
+    alert = body['items'][0]
+    response = api.handler({'httpMethod': 'POST', 'path': '/alerts', 'body': json.dumps({
+        'deviceId': alert['deviceId'], 'timestamp': alert['timestamp'], 'status': 'resolved'
+    })}, None)
+    assert response['statusCode'] == 200
+    _, body = get('/alerts', deviceId='line-1', status='open')
+    assert len(body['items']) == 4
@@ -0,0 +1,131 @@
+import json
+import uuid
+
+from botocore.exceptions import ClientError
+
+import ml_processor
+import preprocessor
+from shared.utils import BufferedWriter
+
+def sqs_record(body):
+    return {'eventSource': 'aws:sqs', 'messageId': str(uuid.uuid4()),
+            'body': body if isinstance(body, str) else json.dumps(body)}
+
+def reading(device_id='device-1', temperature=71.5, vibration=0.4):
+    return {'deviceId': device_id, 'timestamp': '2024-05-01T00:00:00',
+            'temperature': {'value': temperature, 'threshold': 80, 'status': 'normal'},
+            'vibration': {'value': vibration, 'threshold': 0.8, 'status': 'normal'}}
+
+def failed_ids(response):
+    return {failure['itemIdentifier'] for failure in response['batchItemFailures']}
+
+def test_ml_processor_fails_only_malformed_records(stubs):
+    good = [sqs_record(reading(f"device-{i}", temperature=60 + i)) for i in range(3)]
+    bad = [sqs_record('not json'), sqs_record([1, 2]), sqs_record('"text"'),
+           sqs_record(dict(reading(), temperature=75.0))]
+    response = ml_processor.handler({'Records': good[:2] + bad + good[2:]}, None)
+    assert failed_ids(response) == {record['messageId'] for record in bad}
+    assert stubs.sagemaker.calls['InvokeEndpoint'] >= 1
+
+def test_ml_processor_skips_records_completed_earlier(stubs):
+    records = [sqs_record(reading(f"device-{i}", temperature=50 + i)) for i in range(2)]
+    ml_processor.handler({'Records': records}, None)
+    invocations = stubs.sagemaker.calls['InvokeEndpoint']
+    response = ml_processor.handler({'Records': records}, None)
+    assert failed_ids(response) == set()
+    assert stubs.sagemaker.calls['InvokeEndpoint'] == invocations
+
+def raw_reading(device_id, timestamp, temperature=70.0, vibration=0.3):
+    return {'device_id': device_id, 'device_type': 'press', 'timestamp': timestamp,
+            'temperature': temperature, 'vibration': vibration}
+
+def test_preprocessor_fails_only_malformed_messages(stubs):
+    good = [sqs_record([raw_reading(f"device-{i}", f"2024-05-01T00:0{i}:00")]) for i in range(3)]
+    bad = sqs_record('{"device_id": ')
+    response = preprocessor.handler({'Records': good + [bad]}, None)
+    assert failed_ids(response) == {bad['messageId']}
+
+def test_preprocessor_fails_records_whose_rollup_marks_failed(stubs, monkeypatch):
+    def is_bad_mark(item):
+        return item['deviceId'].startswith('rollupmark#') and \
+            item['timestamp'].endswith('#device-bad')
+
+    def reject(operation):
+        return ClientError({'Error': {'Code': 'ValidationException', 'Message': 'rejected'}},
+                           operation)
+    batch_write_item, put_item = stubs.table.meta.client.batch_write_item, stubs.table.put_item
+
+    def failing_batch(RequestItems):
+        if any(is_bad_mark(request['PutRequest']['Item'])
+               for requests in RequestItems.values() for request in requests):
+            raise reject('BatchWriteItem')
+        return batch_write_item(RequestItems)
+
+    def failing_put(Item, **kwargs):
+        if is_bad_mark(Item):
+            raise reject('PutItem')
+        return put_item(Item, **kwargs)
+    monkeypatch.setattr(stubs.table.meta.client, 'batch_write_item', failing_batch)
+    monkeypatch.setattr(stubs.table, 'put_item', failing_put)
+
+    ok = sqs_record([raw_reading('device-ok', '2024-05-01T01:00:00')])
+    bad = sqs_record([raw_reading('device-bad', '2024-05-01T01:00:00')])
+    response = preprocessor.handler({'Records': [ok, bad]}, None)
+    assert failed_ids(response) == {bad['messageId']}
+
+def rejecting(stubs, monkeypatch, code):
+    """Make writes of device-bad items fail with code, as a whole batch would"""
+    def reject(operation):
+        return ClientError({'Error': {'Code': code, 'Message': 'rejected'}}, operation)
+    client, table = stubs.table.meta.client, stubs.table
+    batch_write_item, put_item = client.batch_write_item, table.put_item
+
+    def failing_batch(RequestItems):
+        if any(request['PutRequest']['Item']['deviceId'] == 'device-bad'
+               for requests in RequestItems.values() for request in requests):
+            raise reject('BatchWriteItem')
+        return batch_write_item(RequestItems)
+
+    def failing_put(Item, **kwargs):
+        if Item['deviceId'] == 'device-bad':
+            raise reject('PutItem')
+        return put_item(Item, **kwargs)
+    monkeypatch.setattr(client, 'batch_write_item', failing_batch)
+    monkeypatch.setattr(table, 'put_item', failing_put)
+
+def test_rejected_batch_write_fails_only_the_invalid_item(stubs, monkeypatch):
+    rejecting(stubs, monkeypatch, 'ValidationException')
+    writer = BufferedWriter(table=stubs.table)
+    for i in range(10):
+        writer.put({'deviceId': f"device-{i}", 'timestamp': '2024-05-01T00:00:00'},
+                   record_id=f"r{i}")
+    writer.put({'deviceId': 'device-bad', 'timestamp': '2024-05-01T00:00:00'}, record_id='bad')
+    assert writer.flush() == ['bad']
+    assert stubs.table.item_count() == 10
+
+def test_throttled_batch_write_fails_the_chunk(stubs, monkeypatch):
+    rejecting(stubs, monkeypatch, 'ProvisionedThroughputExceededException')
+    writer = BufferedWriter(table=stubs.table)
+    writer.put({'deviceId': 'device-1', 'timestamp': '2024-05-01T00:00:00'}, record_id='r1')
+    writer.put({'deviceId': 'device-bad', 'timestamp': '2024-05-01T00:00:00'}, record_id='bad')
+    assert writer.flush() == ['r1', 'bad']
+    assert stubs.table.calls['PutItem'] == 0
+
+def test_preprocessor_accepts_epoch_timestamps_and_fails_invalid_ones(stubs):
+    seconds = sqs_record([raw_reading('device-1', 1714521600)])
+    millis = sqs_record([raw_reading('device-2', 1714521600000)])
+    bad = sqs_record([raw_reading('device-3', {'at': 1714521600})])
+    response = preprocessor.handler({'Records': [seconds, millis, bad]}, None)
+    assert failed_ids(response) == {bad['messageId']}
+    readings = [item for item in stubs.table.scan()['Items']
+                if item['deviceId'].startswith('reading#')]
+    assert sorted(item['timestamp'] for item in readings) == ['1714521600000'] * 2
+
+def test_ml_processor_scores_readings_with_a_missing_metric(stubs):
+    missing = dict(reading('device-7'), vibration={'value': None, 'status': 'normal'})
+    absent = {k: v for k, v in reading('device-8').items() if k != 'vibration'}
+    records = [sqs_record(missing), sqs_record(absent)]
+    response = ml_processor.handler({'Records': records}, None)
+    assert failed_ids(response) == set()
+    assert ml_processor.prepare_payload(missing)['features'] == \
+        [71.5, ml_processor.MISSING_FEATURE]
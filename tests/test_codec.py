@@ -0,0 +1,68 @@
+import copy
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from shared.codec import NUMBER, ItemCodec, from_item, to_item
+
+SHAPE = {
+    'score': NUMBER,
+    'temperature': {'value': NUMBER, 'threshold': NUMBER},
+    'position': {'axis': {'x': NUMBER, 'y': NUMBER}}
+}
+codec = ItemCodec(SHAPE)
+
+ITEMS = [
+    {'deviceId': 'device-1', 'score': 0.1, 'temperature': {'value': 71.25, 'threshold': 80.0},
+     'position': {'axis': {'x': 1e-7, 'y': -3.5}, 'label': 'arm'}},
+    # Integers, missing fields and None values
+    {'deviceId': 'device-2', 'score': 3, 'temperature': {'value': None, 'status': 'normal'}},
+    {'deviceId': 'device-3', 'temperature': None, 'position': {}},
+    # Floats that DynamoDB cannot store, and NumPy scalars
+    {'deviceId': 'device-4', 'score': float('nan'),
+     'temperature': {'value': float('inf'), 'threshold': np.float64(80.5)}},
+    # Attributes outside the shape are copied as they are
+    {'deviceId': 'device-5', 'score': 1.5, 'tags': ['a', 'b'], 'count': 7, 'ok': True,
+     'note': None}
+]
+
+@pytest.mark.parametrize('item', ITEMS)
+def test_encode_matches_to_item(item):
+    before = copy.deepcopy(item)
+    assert codec.encode(item) == to_item(item)
+    # The argument and its nested maps are left unchanged
+    assert repr(item) == repr(before)
+
+@pytest.mark.parametrize('item', ITEMS)
+def test_decode_matches_from_item(item):
+    stored = to_item(item)
+    before = copy.deepcopy(stored)
+    assert codec.decode(stored) == from_item(stored)
+    assert stored == before
+
+def test_round_trip_restores_floats_and_integers():
+    item = ITEMS[0]
+    decoded = codec.decode(codec.encode(item))
+    assert decoded == item
+    assert type(decoded['temperature']['value']) is float
+    # Integral numbers read back as int, as from_item returns them
+    assert type(decoded['temperature']['threshold']) is int
+    assert type(codec.decode(codec.encode(ITEMS[1]))['score']) is int
+
+def test_declared_numbers_are_stored_as_decimal():
+    encoded = codec.encode(ITEMS[0])
+    assert encoded['score'] == Decimal('0.1')
+    assert encoded['position']['axis']['x'] == Decimal('1e-07')
+    assert encoded['position']['label'] == 'arm'
+
+def test_keyword_arguments_are_set_before_conversion():
+    encoded = codec.encode({'score': 1.0}, deviceId='device-1', temperature={'value': 2.5})
+    assert encoded == {'deviceId': 'device-1', 'score': Decimal('1.0'),
+                       'temperature': {'value': Decimal('2.5')}}
+    decoded = codec.decode(encoded, deviceId='device-2')
+    assert decoded == {'deviceId': 'device-2', 'score': 1, 'temperature': {'value': 2.5}}
+
+def test_unknown_attributes_are_not_converted():
+    stored = {'score': Decimal('2.5'), 'extra': Decimal('1.5')}
+    assert codec.decode(stored) == {'score': 2.5, 'extra': Decimal('1.5')}
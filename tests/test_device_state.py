@@ -0,0 +1,25 @@
+from shared.device_state import DeviceStateStore
+
+FIELDS = {'limit': 'd', 'shards': 'b'}
+
+def resolve(device_id, item):
+    return {'limit': float(device_id.rsplit('-', 1)[1]), 'shards': 1}
+
+def store(capacity):
+    return DeviceStateStore(FIELDS, max_devices=capacity, evict_fraction=0.5)
+
+def test_load_never_evicts_slots_of_the_same_call(stubs):
+    states = store(4)
+    devices = [f"device-{i}" for i in range(10)]
+    slots = states.load(devices, resolve)
+    assert len(set(slots)) == 10
+    assert states.values('limit', slots).tolist() == [float(i) for i in range(10)]
+
+def test_least_recently_used_devices_are_evicted_first(stubs):
+    states = store(4)
+    states.load(['device-0', 'device-1', 'device-2', 'device-3'], resolve)
+    states.load(['device-0', 'device-1'], resolve)
+    slots = states.load(['device-4', 'device-0'], resolve)
+    assert states.values('limit', slots).tolist() == [4.0, 0.0]
+    assert 'device-1' in states
+    assert 'device-2' not in states and 'device-3' not in states
@@ -0,0 +1,49 @@
+import io
+from datetime import datetime, timezone
+
+import pytest
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+from shared.export import ParquetExporter
+
+def processed(device_id, timestamp, temperature=70.0):
+    return {'deviceId': device_id, 'timestamp': timestamp,
+            'temperature': {'value': temperature, 'status': 'normal'},
+            'vibration': {'value': 0.3, 'status': 'normal'}, 'anomalies': []}
+
+def parquet_keys(stubs):
+    return sorted(key for _, key in stubs.s3.objects)
+
+def read(stubs, key):
+    return pq.read_table(io.BytesIO(stubs.s3.objects[('processed', key)][0]))
+
+def test_flush_writes_one_file_per_hour_with_device_as_a_column(stubs):
+    exporter = ParquetExporter('processed', s3=stubs.s3)
+    for i in range(20):
+        exporter.add(processed(f"device-{i % 5}", f"2024-05-01T00:{i:02d}:00"), record_id=f"r{i}")
+    exporter.add(processed('device-0', '2024-05-01T01:00:00'), record_id='r20')
+    assert exporter.flush() == []
+
+    keys = parquet_keys(stubs)
+    assert [key.rsplit('/', 1)[0] for key in keys] == [
+        'readings/date=2024-05-01/hour=00', 'readings/date=2024-05-01/hour=01']
+    table = read(stubs, keys[0])
+    assert table.num_rows == 20
+    rows = list(zip(table['deviceId'].to_pylist(), table['timestamp'].to_pylist()))
+    assert rows == sorted(rows)
+
+def test_compaction_merges_parts_and_drops_duplicates(stubs):
+    exporter = ParquetExporter('processed', s3=stubs.s3)
+    for batch in range(3):
+        for i in range(4):
+            # The last batch repeats a reading of the first, as a retry would
+            exporter.add(processed(f"device-{i}", f"2024-05-01T00:0{batch % 2}:00"),
+                         record_id=f"b{batch}-{i}")
+        exporter.flush()
+    assert len(parquet_keys(stubs)) == 3
+
+    compacted = exporter.compact(now=datetime(2024, 5, 1, 1, 30, tzinfo=timezone.utc))
+    assert parquet_keys(stubs) == compacted
+    assert read(stubs, compacted[0]).num_rows == 8
+    assert exporter.compact(now=datetime(2024, 5, 1, 1, 30, tzinfo=timezone.utc)) == []
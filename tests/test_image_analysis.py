@@ -0,0 +1,50 @@
+import io
+
+import pytest
+from PIL import Image
+
+import image_analysis
+from phash import RecentHashes
+from preprocess import FramePreprocessor
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(image_analysis, 'preprocessor',
+                        FramePreprocessor(diff_threshold=12, max_age=60, clock=clock))
+    # Flat frames all hash alike; leave the reuse decisions to the static check
+    monkeypatch.setattr(image_analysis, 'recent_hashes', RecentHashes(max_distance=-1))
+    return clock
+
+def frame(stubs, key, brightness):
+    output = io.BytesIO()
+    Image.new('RGB', (32, 32), (brightness,) * 3).save(output, format='PNG')
+    stubs.s3.add_object('frames', key, output.getvalue())
+    return {'s3': {'bucket': {'name': 'frames'}, 'object': {'key': key}}}
+
+def analyzed(stubs, frames):
+    """Return, per frame, the key of the frame whose analysis it got"""
+    results = list(image_analysis.analyze_batch([frame(stubs, *f) for f in frames]))
+    assert all(error is None for _, _, error in results)
+    return [analysis.get('duplicateOf', analysis['imageKey']) for _, analysis, _ in results]
+
+def test_slow_drift_is_compared_with_the_last_analyzed_frame(stubs, clock):
+    # Each frame is within the threshold of the one before it, not of the first
+    assert analyzed(stubs, [('cam/0', 100), ('cam/1', 108), ('cam/2', 116)]) == \
+        ['cam/0', 'cam/0', 'cam/2']
+    assert analyzed(stubs, [('cam/3', 124), ('cam/4', 132)]) == ['cam/2', 'cam/4']
+
+def test_analysis_is_not_reused_past_max_age(stubs, clock):
+    assert analyzed(stubs, [('cam/0', 100)]) == ['cam/0']
+    clock.now = 30
+    assert analyzed(stubs, [('cam/1', 100)]) == ['cam/0']
+    clock.now = 61
+    assert analyzed(stubs, [('cam/2', 100)]) == ['cam/2']
+    assert stubs.rekognition.calls['DetectLabels'] == 2
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from shared.metrics import Metrics, count, span, timed
+
+def emitted(capsys):
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    return json.loads(lines[0])
+
+def test_sampled_invocation_prints_one_emf_document(capsys):
+    metrics = Metrics('preprocessor', namespace='Test', sample_rate=1)
+
+    @timed('Fetch')
+    def fetch():
+        return 'data'
+
+    @metrics.invocation
+    def handler(event, context):
+        for _ in range(2):
+            with span('Store'):
+                fetch()
+        count('Records', 3)
+        count('Records')
+        return 'done'
+
+    assert handler({}, None) == 'done'
+    document = emitted(capsys)
+    directive = document['_aws']
+    assert isinstance(directive['Timestamp'], int)
+    [declaration] = directive['CloudWatchMetrics']
+    assert declaration['Namespace'] == 'Test'
+    assert declaration['Dimensions'] == [['Service']]
+    assert sorted((m['Name'], m['Unit']) for m in declaration['Metrics']) == [
+        ('FetchTime', 'Milliseconds'), ('HandlerTime', 'Milliseconds'),
+        ('Records', 'Count'), ('StoreTime', 'Milliseconds')]
+    assert document['Service'] == 'preprocessor'
+    assert document['ColdStart'] is True
+    assert document['Records'] == 4
+    # Every declared metric has a value at the top level
+    for metric in declaration['Metrics']:
+        assert isinstance(document[metric['Name']], (int, float))
+    assert document['HandlerTime'] >= document['StoreTime'] >= document['FetchTime'] >= 0
+
+    handler({}, None)
+    assert emitted(capsys)['ColdStart'] is False
+
+def test_failed_invocation_counts_an_error(capsys):
+    metrics = Metrics('api', sample_rate=1)
+
+    @metrics.invocation
+    def handler(event, context):
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        handler({}, None)
+    document = emitted(capsys)
+    assert document['Errors'] == 1
+    assert {'Name': 'Errors', 'Unit': 'Count'} in \
+        document['_aws']['CloudWatchMetrics'][0]['Metrics']
+
+def test_unsampled_invocation_prints_nothing(capsys):
+    metrics = Metrics('api', sample_rate=0)
+
+    @metrics.invocation
+    def handler(event, context):
+        count('Records')
+        with span('Store'):
+            return 'done'
+
+    assert handler({}, None) == 'done'
+    assert capsys.readouterr().out == ''
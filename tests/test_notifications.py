@@ -0,0 +1,73 @@
+from shared.notifications import NotificationDispatcher
+
+TOPIC = 'arn:aws:sns:us-east-1:000000000000:alerts'
+
+class ScriptedSNS:
+    """Fails entries by message, per attempt, and records every call
+
+    faults maps a message to the SenderFault flag of each failed attempt;
+    the attempt after the last one succeeds.
+    """
+
+    def __init__(self, faults=None, error=None):
+        self.faults = {message: list(flags) for message, flags in (faults or {}).items()}
+        self.error = error
+        self.calls = []
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.calls.append([entry['Message'] for entry in PublishBatchRequestEntries])
+        if self.error is not None:
+            raise self.error
+        successful, failed = [], []
+        for entry in PublishBatchRequestEntries:
+            flags = self.faults.get(entry['Message'])
+            if flags:
+                failed.append({'Id': entry['Id'], 'SenderFault': flags.pop(0),
+                               'Code': 'Failure', 'Message': 'failed'})
+            else:
+                successful.append({'Id': entry['Id'], 'MessageId': entry['Id']})
+        return {'Successful': successful, 'Failed': failed}
+
+def dispatcher(client, **kwargs):
+    return NotificationDispatcher(client=client, base_delay=0, **kwargs)
+
+def publish(dispatcher, count):
+    for i in range(count):
+        dispatcher.publish(TOPIC, {'n': i}, record_id=f"r{i}")
+
+def test_partial_failures_retry_only_the_failed_entries():
+    # One entry fails twice on the service side, one is rejected
+    client = ScriptedSNS({'{"n":1}': [False, False], '{"n":2}': [True]})
+    notifier = dispatcher(client)
+    publish(notifier, 4)
+    assert notifier.flush() == ['r2']
+    assert [len(call) for call in client.calls] == [4, 1, 1]
+    assert notifier.sent == 3
+
+def test_gives_up_after_max_retries():
+    client = ScriptedSNS({'{"n":3}': [False] * 10})
+    notifier = dispatcher(client, max_retries=2)
+    publish(notifier, 12)
+    assert notifier.flush() == ['r3']
+    # 12 messages take two batches; the failing entry is sent three times
+    assert [len(call) for call in client.calls] == [10, 1, 1, 2]
+    assert notifier.sent == 11
+
+def test_failed_calls_fail_every_record_of_the_batch_once():
+    client = ScriptedSNS(error=RuntimeError('unavailable'))
+    notifier = dispatcher(client, max_retries=1)
+    notifier.publish(TOPIC, 'a', record_id='r0')
+    notifier.publish(TOPIC, 'b', record_id='r0')
+    notifier.publish(TOPIC, 'c', record_id='r1')
+    notifier.publish(TOPIC, 'd')
+    notifier.flush(wait=False)
+    assert notifier.wait() == ['r0', 'r1']
+    assert len(client.calls) == 2
+
+def test_discarded_records_are_not_sent():
+    client = ScriptedSNS()
+    notifier = dispatcher(client)
+    publish(notifier, 3)
+    notifier.discard(['r1'])
+    assert notifier.flush() == []
+    assert client.calls == [['{"n":0}', '{"n":2}']]
@@ -0,0 +1,31 @@
+import json
+import uuid
+
+import ml_processor
+import prediction_cache
+from prediction_cache import PredictionCache
+from stubs import TableStub
+
+def sqs_record(device_id, temperature):
+    return {'eventSource': 'aws:sqs', 'messageId': str(uuid.uuid4()), 'body': json.dumps({
+        'deviceId': device_id, 'timestamp': f"2024-05-01T00:00:{uuid.uuid4().int % 60:02d}",
+        'temperature': {'value': temperature}, 'vibration': {'value': 0.3}})}
+
+def test_cache_hits_are_not_written_back(stubs, monkeypatch):
+    shared = TableStub('predictions', key_names=('cacheKey',))
+    cache = PredictionCache('test-endpoint', 'latest', table=shared)
+    monkeypatch.setattr(prediction_cache, '_cache', cache)
+
+    ml_processor.handler({'Records': [sqs_record('device-1', 70.0),
+                                      sqs_record('device-2', 71.0)]}, None)
+    assert shared.calls['BatchWriteItem'] == 1
+    assert shared.item_count() == 2
+    calls = stubs.sagemaker.calls['InvokeEndpoint']
+
+    # The same features again, from the local layer and then the shared one
+    for _ in range(2):
+        ml_processor.handler({'Records': [sqs_record('device-1', 70.0),
+                                          sqs_record('device-2', 71.0)]}, None)
+        assert stubs.sagemaker.calls['InvokeEndpoint'] == calls
+        assert shared.calls['BatchWriteItem'] == 1
+        cache.local.clear()
@@ -0,0 +1,94 @@
+import base64
+import gzip
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import preprocessor
+
+def raw_reading(device_id, second, temperature=70.0):
+    return {'device_id': device_id, 'device_type': 'press',
+            'timestamp': f"2024-05-01T00:00:{second:02d}", 'temperature': temperature,
+            'vibration': 0.3}
+
+def ndjson(lines):
+    return b''.join((line if isinstance(line, bytes) else json.dumps(line).encode()) + b'\n'
+                    for line in lines)
+
+def s3_record(stubs, key, data, encoding=None):
+    stubs.s3.put_object(Bucket='uploads', Key=key, Body=data, ContentEncoding=encoding)
+    return {'eventSource': 'aws:s3', 's3': {'bucket': {'name': 'uploads'},
+                                            'object': {'key': key, 'size': len(data)}}}
+
+def stored(stubs):
+    return sorted(item['timestamp'] for item in stubs.table.scan()['Items']
+                  if item['deviceId'].startswith('reading#'))
+
+@pytest.fixture
+def metrics(monkeypatch):
+    """Sample every invocation, returning the counters of the last one"""
+    out = io.StringIO()
+    monkeypatch.setattr(preprocessor.instrumentation, 'sample_rate', 1)
+    monkeypatch.setattr(preprocessor.instrumentation, 'out', out)
+    return lambda: json.loads(out.getvalue().splitlines()[-1])
+
+@pytest.mark.parametrize('key, encoding', [
+    ('readings.ndjson', None), ('readings.ndjson.gz', None), ('readings.jsonl', 'gzip')
+])
+def test_ndjson_objects_are_read_line_by_line(stubs, key, encoding):
+    data = ndjson([raw_reading('device-1', second) for second in range(5)])
+    if key.endswith('.gz') or encoding:
+        data = gzip.compress(data)
+    record = s3_record(stubs, key, data, encoding)
+    response = preprocessor.handler({'Records': [record]}, None)
+    assert response['batchItemFailures'] == []
+    assert len(stored(stubs)) == 5
+
+def test_malformed_lines_and_readings_are_skipped(stubs, metrics):
+    data = ndjson([raw_reading('device-1', 0), b'{"device_id": ', raw_reading('device-1', 1),
+                   {'temperature': 70.0}, [1, 2], raw_reading('device-1', 2)])
+    record = s3_record(stubs, 'readings.ndjson.gz', gzip.compress(data))
+    response = preprocessor.handler({'Records': [record]}, None)
+    assert response['batchItemFailures'] == []
+    assert len(stored(stubs)) == 3
+    assert metrics()['MalformedReadings'] == 3
+
+def kinesis_record(sequence, payload):
+    data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+    return {'eventSource': 'aws:kinesis', 'eventID': f"shardId-000000000000:{sequence}",
+            'kinesis': {'sequenceNumber': sequence, 'data': base64.b64encode(data).decode()}}
+
+def test_kinesis_records_are_base64_decoded(stubs):
+    records = [kinesis_record('1', raw_reading('device-1', 0)),
+               kinesis_record('2', {'readings': [raw_reading('device-2', 1),
+                                                 raw_reading('device-2', 2)]}),
+               kinesis_record('3', [raw_reading('device-3', 3)])]
+    response = preprocessor.handler({'Records': records}, None)
+    assert response['batchItemFailures'] == []
+    assert len(stored(stubs)) == 4
+
+def test_bad_kinesis_record_is_reported_by_sequence_number(stubs):
+    records = [kinesis_record('1', raw_reading('device-1', 0)),
+               kinesis_record('2', b'{"device_id": '),
+               kinesis_record('3', b'"text"'),
+               kinesis_record('4', raw_reading('device-1', 1))]
+    response = preprocessor.handler({'Records': records}, None)
+    assert response['batchItemFailures'] == [{'itemIdentifier': '2'}, {'itemIdentifier': '3'}]
+    assert len(stored(stubs)) == 2
+
+@pytest.mark.parametrize('event', [
+    raw_reading('device-1', 0),
+    {'readings': [raw_reading('device-1', 0), raw_reading('device-1', 1)]}
+])
+def test_iot_rule_events_are_the_device_message(stubs, event):
+    context = SimpleNamespace(aws_request_id='request-1')
+    response = preprocessor.handler(event, context)
+    assert response['batchItemFailures'] == []
+    assert len(stored(stubs)) == len(event.get('readings', [event]))
+    # An async retry keeps the request id, so the completed message is skipped
+    writes = stubs.table.calls['BatchWriteItem']
+    assert writes > 0
+    preprocessor.handler(event, context)
+    assert stubs.table.calls['BatchWriteItem'] == writes
@@ -0,0 +1,88 @@
+import json
+import uuid
+
+import preprocessor
+from shared.rollups import (
+    ROLLUP_LEASE_KEY, decode_metrics, parse_timestamp, refresh_rollups, rollup_key
+)
+from stubs import _partition_value
+
+def sqs_record(readings):
+    return {'eventSource': 'aws:sqs', 'messageId': str(uuid.uuid4()), 'body': json.dumps(readings)}
+
+def raw_reading(device_id, timestamp, temperature):
+    return {'device_id': device_id, 'timestamp': timestamp,
+            'temperature': temperature, 'vibration': 0.3}
+
+READINGS = [raw_reading('device-1', f"2024-05-01T10:0{i // 2}:{i % 2 * 30:02d}", 70.0 + i)
+            for i in range(6)]
+
+def bucket(stubs, device_id, resolution, start):
+    item = stubs.table.get_item(Key=rollup_key(device_id, resolution, parse_timestamp(start)))
+    return {metric: b.summary() for metric, b in decode_metrics(item['Item']).items()}
+
+def marks(stubs):
+    return [item for item in stubs.table.scan()['Items']
+            if item['deviceId'].startswith('rollupmark#')]
+
+def test_refresh_builds_every_resolution(stubs):
+    preprocessor.handler({'Records': [sqs_record(READINGS)]}, None)
+    assert len(marks(stubs)) == 3
+    assert refresh_rollups(table=stubs.table)['devices'] == 1
+
+    assert bucket(stubs, 'device-1', '1m', '2024-05-01T10:01:00')['temperature']['count'] == 2
+    hour = bucket(stubs, 'device-1', '1h', '2024-05-01T10:00:00')['temperature']
+    day = bucket(stubs, 'device-1', '1d', '2024-05-01T00:00:00')['temperature']
+    assert hour == day
+    assert (hour['count'], hour['min'], hour['max']) == (6, 70.0, 75.0)
+    assert marks(stubs) == []
+
+def test_redelivered_readings_are_not_counted_twice(stubs):
+    for _ in range(2):
+        # A new message id each time, so completion markers do not skip it
+        preprocessor.handler({'Records': [sqs_record(READINGS)]}, None)
+        refresh_rollups(table=stubs.table)
+    preprocessor.handler({'Records': [sqs_record(READINGS[:2])]}, None)
+    refresh_rollups(table=stubs.table)
+    assert bucket(stubs, 'device-1', '1d', '2024-05-01T00:00:00')['temperature']['count'] == 6
+
+def test_failed_device_keeps_its_marks(stubs, monkeypatch):
+    readings = READINGS + [raw_reading('device-2', '2024-05-01T10:00:00', 60.0)]
+    preprocessor.handler({'Records': [sqs_record(readings)]}, None)
+    query = stubs.table.query
+
+    def failing_query(**kwargs):
+        partition = _partition_value(kwargs['KeyConditionExpression'], 'deviceId')
+        if partition.startswith('reading#device-2#'):
+            raise RuntimeError('boom')
+        return query(**kwargs)
+    monkeypatch.setattr(stubs.table, 'query', failing_query)
+    result = refresh_rollups(table=stubs.table)
+    assert (result['devices'], result['failed']) == (1, 1)
+    assert [item['timestamp'] for item in marks(stubs)] == ['2024-05-01T10:00:00#device-2']
+
+    monkeypatch.undo()
+    assert refresh_rollups(table=stubs.table)['devices'] == 1
+    assert bucket(stubs, 'device-2', '1h', '2024-05-01T10:00:00')['temperature']['count'] == 1
+
+def test_overlapping_refresh_is_skipped(stubs):
+    preprocessor.handler({'Records': [sqs_record(READINGS)]}, None)
+    stubs.table.put_item(Item=dict(ROLLUP_LEASE_KEY, owner='other', expiresAt=2 ** 40))
+    assert refresh_rollups(table=stubs.table)['leased'] is False
+    assert len(marks(stubs)) == 3
+
+def test_marks_rewritten_during_a_refresh_are_kept(stubs, monkeypatch):
+    preprocessor.handler({'Records': [sqs_record(READINGS[:1])]}, None)
+    delete_item = stubs.table.delete_item
+
+    def ingest_then_delete(Key, **kwargs):
+        if Key['deviceId'].startswith('rollupmark#'):
+            # A reading of the same minute lands while the bucket is rebuilt
+            preprocessor.handler({'Records': [sqs_record(READINGS[1:2])]}, None)
+        return delete_item(Key, **kwargs)
+    monkeypatch.setattr(stubs.table, 'delete_item', ingest_then_delete)
+    refresh_rollups(table=stubs.table)
+    monkeypatch.undo()
+    assert len(marks(stubs)) == 1
+    refresh_rollups(table=stubs.table)
+    assert bucket(stubs, 'device-1', '1m', '2024-05-01T10:00:00')['temperature']['count'] == 2
@@ -0,0 +1,57 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from shared.schema import (
+    decode_reading, device_of, epoch_millis, format_millis, reading_item, reading_key,
+    reading_timestamp
+)
+
+MOMENT = datetime(2024, 5, 1, 12, 30, 15, 250000, tzinfo=timezone.utc)
+MILLIS = 1714566615250
+
+def processed(timestamp, device_id='line#4'):
+    return {'deviceId': device_id, 'timestamp': timestamp,
+            'temperature': {'value': 71.5, 'threshold': 80.0, 'status': 'normal'},
+            'vibration': {'value': 0.4, 'threshold': 0.8, 'status': 'normal'}}
+
+@pytest.mark.parametrize('timestamp', [
+    '2024-05-01T12:30:15.250', '2024-05-01T12:30:15.250Z', '2024-05-01T14:30:15.250+02:00',
+    MOMENT, MILLIS, MILLIS / 1000
+])
+def test_epoch_millis_accepts_iso_datetimes_and_epoch_numbers(timestamp):
+    assert epoch_millis(timestamp) == MILLIS
+
+@pytest.mark.parametrize('timestamp', [None, True, float('nan'), {'seconds': 1}])
+def test_epoch_millis_rejects_other_values(timestamp):
+    with pytest.raises(ValueError):
+        epoch_millis(timestamp)
+
+def test_reading_timestamp_converts_epoch_numbers():
+    assert reading_timestamp(1714566615) == '2024-05-01T12:30:15.000Z'
+    assert reading_timestamp('2024-05-01T12:30:15') == '2024-05-01T12:30:15'
+
+@pytest.mark.parametrize('shards', [1, 4, 32])
+def test_reading_key_round_trips(shards):
+    key = reading_key('line#4', '2024-05-01T12:30:15.250Z', shards)
+    assert key['timestamp'] == f"{MILLIS:013d}"
+    assert key['deviceId'].startswith('reading#line#4#20240501#')
+    assert 0 <= int(key['deviceId'].rsplit('#', 1)[1]) < shards
+    assert device_of(key['deviceId']) == 'line#4'
+    assert format_millis(key['timestamp']) == '2024-05-01T12:30:15.250Z'
+    # Redeliveries map to the same key, whatever form the timestamp takes
+    assert reading_key('line#4', MILLIS, shards) == key
+
+def test_reading_item_decodes_to_the_reading():
+    data = processed('2024-05-01T12:30:15.250Z')
+    reading = decode_reading(reading_item(data, shards=4))
+    assert reading['deviceId'] == 'line#4'
+    assert epoch_millis(reading['timestamp']) == MILLIS
+    assert reading['temperature'] == data['temperature']
+    assert reading['vibration'] == data['vibration']
+
+def test_readings_of_a_day_stay_in_its_partitions():
+    midnight = reading_key('device-1', '2024-05-01T00:00:00Z')
+    before = reading_key('device-1', '2024-04-30T23:59:59.999Z')
+    assert midnight['deviceId'].endswith('#20240501#0')
+    assert before['deviceId'].endswith('#20240430#0')
@@ -0,0 +1,117 @@
+import json
+import uuid
+
+import pytest
+
+import alert_processor
+from suppression import AlertSuppressor, fingerprint, state_key
+
+class Clock:
+    def __init__(self, now=1_700_000_000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def make_alert(severity='warning', device_id='device-1', alert_type='sensor'):
+    return {
+        'alertId': f"alert_{uuid.uuid4().hex}",
+        'timestamp': '2024-05-01T00:00:00',
+        'deviceId': device_id,
+        'type': alert_type,
+        'severity': severity,
+        'fingerprint': fingerprint(device_id, alert_type, severity),
+        'status': 'new'
+    }
+
+@pytest.fixture
+def suppressor(stubs):
+    return AlertSuppressor(table=stubs.table, clock=Clock())
+
+def test_repeats_in_window_are_suppressed(suppressor):
+    first = suppressor.evaluate(make_alert())
+    assert first.action == 'new'
+    repeat = suppressor.evaluate(make_alert())
+    assert repeat.action == 'suppress'
+    assert repeat.alert_id == first.alert_id
+
+def test_higher_severity_escalates(suppressor):
+    suppressor.evaluate(make_alert('warning'))
+    decision = suppressor.evaluate(make_alert('critical'))
+    assert decision.action == 'escalate'
+    assert decision.previous_severity == 'warning'
+    assert suppressor.evaluate(make_alert('warning')).action == 'suppress'
+
+def test_window_expiry_opens_a_new_window(suppressor):
+    suppressor.evaluate(make_alert('critical'))
+    suppressor.clock.now += suppressor.windows['critical'] + 1
+    assert suppressor.evaluate(make_alert('critical')).action == 'new'
+
+def test_release_deletes_a_first_claim(stubs, suppressor):
+    alert = make_alert()
+    decision = suppressor.evaluate(alert)
+    suppressor.release(alert, decision)
+    assert 'Item' not in stubs.table.get_item(Key=state_key('device-1', 'sensor'))
+    assert suppressor.evaluate(make_alert()).action == 'new'
+
+def test_release_restores_the_replaced_state(stubs, suppressor):
+    first = make_alert('warning')
+    suppressor.evaluate(first)
+    escalation = make_alert('critical')
+    decision = suppressor.evaluate(escalation)
+    suppressor.release(escalation, decision)
+    state = stubs.table.get_item(Key=state_key('device-1', 'sensor'))['Item']
+    assert state['alertId'] == first['alertId']
+    assert suppressor.evaluate(make_alert('critical')).action == 'escalate'
+
+def test_release_keeps_a_newer_claim(stubs, suppressor):
+    alert = make_alert()
+    decision = suppressor.evaluate(alert)
+    # Another container claimed the window meanwhile
+    other = AlertSuppressor(table=stubs.table, clock=suppressor.clock)
+    suppressor.clock.now += suppressor.windows['warning'] + 1
+    newer = make_alert()
+    assert other.evaluate(newer).action == 'new'
+    suppressor.release(alert, decision)
+    state = stubs.table.get_item(Key=state_key('device-1', 'sensor'))['Item']
+    assert state['alertId'] == newer['alertId']
+
+def sensor_event():
+    return {'detail-type': 'Sensor Alert', 'detail': {
+        'deviceId': 'device-1', 'type': 'sensor',
+        'temperature': {'value': 95.0, 'threshold': 80, 'status': 'critical'}}}
+
+@pytest.fixture
+def handler_suppressor(stubs, monkeypatch):
+    suppressor = AlertSuppressor(table=stubs.table)
+    monkeypatch.setattr(alert_processor, 'suppressor', suppressor)
+    return suppressor
+
+def alert_items(stubs):
+    return [item for item in stubs.table.scan()['Items'] if item['timestamp'].startswith('alert#')]
+
+def test_failed_publish_releases_the_window(stubs, handler_suppressor, monkeypatch):
+    def fail(TopicArn, PublishBatchRequestEntries):
+        return {'Successful': [], 'Failed': [
+            {'Id': entry['Id'], 'Code': 'InvalidParameter', 'SenderFault': True}
+            for entry in PublishBatchRequestEntries]}
+    monkeypatch.setattr(stubs.sns, 'publish_batch', fail)
+    with pytest.raises(RuntimeError):
+        alert_processor.handler(sensor_event(), None)
+    assert alert_items(stubs) == []
+
+    # The retry is delivered instead of being suppressed
+    monkeypatch.undo()
+    monkeypatch.setattr(alert_processor, 'suppressor', handler_suppressor)
+    response = alert_processor.handler(sensor_event(), None)
+    assert json.loads(response['body'])['action'] == 'new'
+    assert len(alert_items(stubs)) == 1
+
+def test_failed_store_releases_the_window(stubs, handler_suppressor, monkeypatch):
+    def fail(alert):
+        raise RuntimeError('table unavailable')
+    monkeypatch.setattr(alert_processor, 'store_alert', fail)
+    with pytest.raises(RuntimeError):
+        alert_processor.handler(sensor_event(), None)
+    assert stubs.sns.calls == {}
+    assert 'Item' not in stubs.table.get_item(Key=state_key('device-1', 'sensor'))